@@ -1,86 +1,1075 @@
 #!/usr/bin/env python
 
+import bisect
+import contextlib
+import cProfile
 import json
+import mmap
+import multiprocessing
 import os
+import pstats
+import queue
+import random
 import codecs
+import collections
+import gzip
+import hashlib
+import heapq
+import importlib
+import itertools
 import re
 import shutil
+import signal
+import sqlite3
+import subprocess
 import sys
 import threading
+import time
 import traceback
+import unicodedata
+import urllib.parse
 from dataclasses import dataclass
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from multiprocessing.pool import ThreadPool
 from typing import *
 
 import click
 import yaml
 from pprint import pprint
-from pixivpy3 import AppPixivAPI
+
+if TYPE_CHECKING:
+    from pixivpy3 import AppPixivAPI
 
 __version__ = '0.0.2'
 
 
-class SyncDB(object):
+class Metrics(object):
+    """
+    Counters, latency histograms and phase timers of a run.
+
+    The metrics can be exported as a JSON report by :meth:`to_json`, or
+    in the Prometheus text format by :meth:`to_prometheus`.
+    """
+
+    LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.,
+                       30., 60.)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters: Dict[str, float] = collections.defaultdict(float)
+            self.histograms: Dict[str, List[float]] = {}
+            self.histogram_sums: Dict[str, float] = collections.defaultdict(float)
+            self.phases: Dict[str, float] = collections.defaultdict(float)
+            self.start_time = time.time()
+
+    def inc(self, name: str, value: float = 1.):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            buckets = self.histograms.get(name)
+            if buckets is None:
+                buckets = self.histograms[name] = \
+                    [0] * (len(self.LATENCY_BUCKETS) + 1)
+            buckets[bisect.bisect_left(self.LATENCY_BUCKETS, value)] += 1
+            self.histogram_sums[name] += value
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        """Observe the duration of the context into the histogram `name`."""
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start_time)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Add the duration of the context to the phase `name`."""
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start_time
+            with self._lock:
+                self.phases[name] += duration
+
+    def _quantile(self, buckets: List[int], q: float) -> Optional[float]:
+        count = sum(buckets)
+        if not count:
+            return None
+        rank = q * count
+        for i, n in enumerate(buckets):
+            rank -= n
+            if rank <= 0:
+                if i < len(self.LATENCY_BUCKETS):
+                    return self.LATENCY_BUCKETS[i]
+                return float('inf')
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            histograms = {}
+            for name, buckets in self.histograms.items():
+                count = sum(buckets)
+                histograms[name] = {
+                    'count': count,
+                    'sum': self.histogram_sums[name],
+                    'mean': self.histogram_sums[name] / count,
+                    'p50': self._quantile(buckets, .5),
+                    'p90': self._quantile(buckets, .9),
+                    'p99': self._quantile(buckets, .99),
+                    'buckets': dict(zip(
+                        [str(b) for b in self.LATENCY_BUCKETS] + ['+Inf'],
+                        buckets
+                    )),
+                }
+            wall_time = time.time() - self.start_time
+            return {
+                'start_time': datetime.fromtimestamp(self.start_time).isoformat(),
+                'wall_time': wall_time,
+                'counters': dict(self.counters),
+                'rates': {f'{k}_per_second': v / wall_time
+                          for k, v in self.counters.items()},
+                'histograms': histograms,
+                'phases': dict(self.phases),
+            }
+
+    def to_prometheus(self, prefix: str = 'pixivsync_') -> str:
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {prefix}{name} counter')
+                lines.append(f'{prefix}{name} {value}')
+            for name, buckets in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {prefix}{name} histogram')
+                cumulative = 0
+                for le, n in zip([str(b) for b in self.LATENCY_BUCKETS] +
+                                 ['+Inf'], buckets):
+                    cumulative += n
+                    lines.append(f'{prefix}{name}_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}{name}_sum {self.histogram_sums[name]}')
+                lines.append(f'{prefix}{name}_count {cumulative}')
+            if self.phases:
+                lines.append(f'# TYPE {prefix}phase_seconds gauge')
+                for name, value in sorted(self.phases.items()):
+                    lines.append(f'{prefix}phase_seconds{{phase="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+@contextlib.contextmanager
+def profile_run(path: str):
+    """
+    Profile the context by cProfile, including the threads started within
+    it, and dump the merged stats to `path`.
+
+    Since Python 3.12 only one profiler may be active at a time, so only
+    the calling thread is profiled.
+    """
+    profiles = []
+    lock = threading.Lock()
+    per_thread = sys.version_info < (3, 12)
+
+    def thread_hook(frame, event, arg):
+        # called by the first profiled event of each new thread, which
+        # then replaces this hook by a profiler of its own
+        p = cProfile.Profile()
+        with lock:
+            profiles.append(p)
+        p.enable()
+
+    main_profile = cProfile.Profile()
+    if per_thread:
+        threading.setprofile(thread_hook)
+    main_profile.enable()
+    try:
+        yield
+    finally:
+        main_profile.disable()
+        if per_thread:
+            threading.setprofile(None)
+        stats = pstats.Stats(main_profile)
+        with lock:
+            for p in profiles:
+                p.disable()
+                stats.add(p)
+        stats.dump_stats(path)
+        print(f'Profile saved to: {path}')
+
+
+def save_metrics(metrics: Metrics,
+                 json_file: Optional[str] = None,
+                 prometheus_file: Optional[str] = None):
+    if json_file:
+        with codecs.open(json_file, 'wb', 'utf-8') as f:
+            f.write(json.dumps(metrics.to_json(), indent=2))
+    if prometheus_file:
+        # write and rename, such that the file is never read half-written
+        # by the Prometheus textfile collector
+        tmp_path = f'{prometheus_file}.tmp'
+        with codecs.open(tmp_path, 'wb', 'utf-8') as f:
+            f.write(metrics.to_prometheus())
+        os.replace(tmp_path, prometheus_file)
+
+
+SYNC_DB_COLLECTIONS = ('illusts', 'users', 'hashes')
+
+
+_MISSING = object()
+
+
+class TagTable(object):
+    """
+    The distinct tags of all the illusts, such that each illust only holds
+    the ids of its tags.
+    """
+
+    def __init__(self):
+        self.tags: List[Tuple[str, Optional[str]]] = []
+        self.ids: Dict[Tuple[str, Optional[str]], int] = {}
+        self.lock = threading.Lock()
+
+    def get_id(self, tag: Mapping[str, str]) -> int:
+        key = (tag['name'], tag.get('translation'))
+        tag_id = self.ids.get(key)
+        if tag_id is None:
+            with self.lock:
+                tag_id = self.ids.get(key)
+                if tag_id is None:
+                    tag_id = self.ids[key] = len(self.tags)
+                    self.tags.append(key)
+        return tag_id
+
+    def get(self, tag_id: int) -> Dict[str, str]:
+        name, translation = self.tags[tag_id]
+        if translation is None:
+            return {'name': name}
+        return {'name': name, 'translation': translation}
+
+
+TAGS = TagTable()
+
+
+class CompactRecord(MutableMapping):
+    """
+    A record of the sync DB with less memory than a dict: the keys in
+    `FIELDS` are stored in slots (an unset slot being a missing key), and
+    the other keys (if any) in a dict created on demand.  Subclasses may
+    store the fields in `ENCODED` encoded, by overriding :meth:`_encode`
+    and :meth:`_decode`.
+    """
+
+    FIELDS: Tuple[str, ...] = ()
+    ENCODED: FrozenSet[str] = frozenset()
+    __slots__ = ('_extra',)
+
+    def __init__(self, val: Optional[Mapping[str, Any]] = None):
+        self._extra = None
+        if val is not None:
+            for k, v in val.items():
+                self[k] = v
+
+    def _encode(self, key: str, val):
+        return val
+
+    def _decode(self, key: str, val):
+        return val
+
+    def __getitem__(self, key: str):
+        if key in self.FIELDS:
+            val = getattr(self, key, _MISSING)
+            if val is _MISSING:
+                raise KeyError(key)
+            if key in self.ENCODED:
+                val = self._decode(key, val)
+            return val
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key: str, val):
+        if key in self.FIELDS:
+            if key in self.ENCODED:
+                val = self._encode(key, val)
+            setattr(self, key, val)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = val
+
+    def __delitem__(self, key: str):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+
+    def __iter__(self):
+        for k in self.FIELDS:
+            if getattr(self, k, _MISSING) is not _MISSING:
+                yield k
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        ret = {}
+        for k in self.FIELDS:
+            val = getattr(self, k, _MISSING)
+            if val is not _MISSING:
+                ret[k] = self._decode(k, val) if k in self.ENCODED else val
+        if self._extra:
+            ret.update(self._extra)
+        return ret
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class CompactImage(CompactRecord):
+    """An image of an illust, with the directories of its url and path interned."""
+
+    FIELDS = ('url', 'fetched', 'size', 'digest', 'path', 'shared',
+              'processed')
+    ENCODED = frozenset(['url', 'path'])
+    DIR_SLOTS = {'url': '_url_dir', 'path': '_path_dir'}
+    __slots__ = FIELDS + ('_url_dir', '_path_dir')
+
+    def _encode(self, key: str, val):
+        # the pages of an illust share the same directories
+        dir_name, sep, val = val.rpartition('/')
+        setattr(self, self.DIR_SLOTS[key], sys.intern(dir_name + sep))
+        return val
+
+    def _decode(self, key: str, val):
+        return getattr(self, self.DIR_SLOTS[key]) + val
+
+
+class CompactIllust(CompactRecord):
+    """
+    An illust, with the author interned, and the tags stored as ids in
+    :data:`TAGS`.
+    """
+
+    FIELDS = ('id', 'title', 'create_time', 'author_id', 'author_name',
+              'tags', 'width', 'height', 'images', '_deleted',
+              'refreshed_at', 'fingerprint', 'bookmarked')
+    ENCODED = frozenset(['author_id', 'author_name', 'tags', 'images'])
+    __slots__ = FIELDS
+
+    def _encode(self, key: str, val):
+        if key == 'tags':
+            return tuple([TAGS.get_id(t) for t in val])
+        if key == 'images':
+            return tuple([CompactImage(image) for image in val])
+        if isinstance(val, str):
+            return sys.intern(val)
+        return val
+
+    def _decode(self, key: str, val):
+        if key == 'tags':
+            return [TAGS.get(t) for t in val]
+        if key == 'images':
+            return list(val)
+        return val
+
+
+# the record types of the collections stored as compact records
+SYNC_DB_RECORD_TYPES: Dict[str, Type[CompactRecord]] = {
+    'illusts': CompactIllust,
+}
+
+
+def to_record(coll: str, val: Any) -> Any:
+    """Convert a collection item loaded from the DB into a compact record."""
+    record_type = SYNC_DB_RECORD_TYPES.get(coll)
+    if record_type is None or not isinstance(val, Mapping):
+        return val
+    return record_type(val)
+
+
+def json_default(o):
+    """Serialize the compact records by :func:`json.dumps`."""
+    if isinstance(o, CompactRecord):
+        return o.to_dict()
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+class SyncDBStorage(object):
+    """Base class of the storage engines of :class:`SyncDB`."""
 
     path: str
-    data: Dict[str, Any]
-    lock: threading.RLock
+    read_only: bool
+    # whether a save only writes the changed items, instead of the whole DB
+    saves_rows: bool = False
+
+    def __init__(self, path: str, read_only: bool = False):
+        self.path = os.path.abspath(path)
+        self.read_only = read_only
+
+    def load(self) -> Dict[str, Any]:
+        """
+        Load the database.
+
+        Returns:
+            The top-level values, with each collection in
+            ``SYNC_DB_COLLECTIONS`` as a (mutable) mapping from id to item.
+        """
+        raise NotImplementedError()
+
+    def save(self, data: Dict[str, Any], dirty: Set[Tuple[str, str]],
+             max_backup: int = 10, backup: bool = True):
+        """
+        Save the database.
+
+        Args:
+            data: The top-level values, as returned by :meth:`load`.
+            dirty: The ``(collection, id)`` of items changed since the
+                last save.  Ids no longer in the collection are deleted.
+            max_backup: Maximum number of backups to keep.
+            backup: Whether or not to back up the previous database.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
 
-    def __init__(self, path: str):
-        if os.path.exists(path):
-            with codecs.open(path, 'rb', 'utf-8') as f:
+
+class JsonStorage(SyncDBStorage):
+    """Stores the whole database in one JSON file."""
+
+    def load(self) -> Dict[str, Any]:
+        if os.path.exists(self.path):
+            with codecs.open(self.path, 'rb', 'utf-8') as f:
                 cnt = f.read()
             data = json.loads(cnt)
             if not isinstance(data, dict):
-                raise IOError(f'DB malformed: {path}')
+                raise IOError(f'DB malformed: {self.path}')
         else:
             data = {}
+        return data
+
+    def save(self, data: Dict[str, Any], dirty: Set[Tuple[str, str]],
+             max_backup: int = 10, backup: bool = True):
+        output_content = json.dumps(data, default=json_default)
+
+        parent_dir, file_name = os.path.split(self.path)
+        if not os.path.isdir(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+
+        # write to a temporary file first, such that a crash during the
+        # save never leaves a truncated db
+        tmp_path = f'{self.path}.tmp'
+        with codecs.open(tmp_path, 'wb', 'utf-8') as f:
+            f.write(output_content)
+
+        if backup and os.path.exists(self.path):
+            # move the previous db to a new backup
+            new_suffix = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+            new_backup_name = f'{file_name}-{new_suffix}'
+            shutil.move(self.path, os.path.join(parent_dir, new_backup_name))
+
+            # cleanup old backups
+            backup_list = []
+            e_prefix = f'{file_name}-'
+            for e in os.listdir(parent_dir):
+                if e.startswith(e_prefix) and e != file_name:
+                    backup_list.append(e)
+            backup_list.sort()
+            for old_backup in backup_list[:len(backup_list) - max_backup]:
+                os.remove(os.path.join(parent_dir, old_backup))
+
+        os.replace(tmp_path, self.path)
+
+
+class SQLiteCollection(MutableMapping):
+    """
+    A collection stored in a SQLite table, with items loaded on demand.
+
+    Loaded and modified items are kept in memory until the next
+    :meth:`flush`, which writes only the given ids.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, table: str):
+        self.conn = conn
+        self.table = table
+        self._cache: Dict[str, Any] = {}
+        self._deleted: Set[str] = set()
+
+    def _load(self, key: str):
+        row = self.conn.execute(
+            f'SELECT data FROM "{self.table}" WHERE id = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        val = self._cache[key] = to_record(self.table, json.loads(row[0]))
+        return val
+
+    def _stored_ids(self) -> List[str]:
+        return [r[0] for r in self.conn.execute(
+            f'SELECT id FROM "{self.table}" ORDER BY rowid')]
+
+    def __getitem__(self, key: str):
+        if key in self._cache:
+            return self._cache[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        return self._load(key)
+
+    def __setitem__(self, key: str, val):
+        self._cache[key] = val
+        self._deleted.discard(key)
+
+    def __delitem__(self, key: str):
+        _ = self[key]
+        self._cache.pop(key)
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        try:
+            _ = self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        stored_ids = self._stored_ids()
+        stored_id_set = set(stored_ids)
+        for key in stored_ids:
+            if key not in self._deleted:
+                yield key
+        for key in list(self._cache):
+            if key not in stored_id_set:
+                yield key
+
+    def __len__(self):
+        if not self._cache and not self._deleted:
+            return self.conn.execute(
+                f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+        return sum(1 for _ in self)
+
+    def items_batch(self, after: int, limit: int
+                    ) -> Tuple[List[Tuple[str, Any]], int]:
+        """
+        Get the items of at most `limit` rows after the rowid `after`,
+        without caching them, and the rowid to get the next batch after.
+        The items not stored yet are returned by the last (empty) batch.
+        """
+        ret = []
+        rows = self.conn.execute(
+            f'SELECT rowid, id, data FROM "{self.table}" WHERE rowid > ? '
+            f'ORDER BY rowid LIMIT ?', (after, limit)).fetchall()
+        for rowid, key, cnt in rows:
+            after = rowid
+            if key in self._deleted:
+                continue
+            val = self._cache.get(key)
+            if val is None:
+                val = to_record(self.table, json.loads(cnt))
+            ret.append((key, val))
+        if not rows:
+            for key, val in self._cache.items():
+                if self.conn.execute(f'SELECT 1 FROM "{self.table}" WHERE id = ?',
+                                     (key,)).fetchone() is None:
+                    ret.append((key, val))
+            after = -1
+        return ret, after
+
+    def items(self) -> List[Tuple[str, Any]]:
+        # load all the missing items with one query, instead of one per id
+        ret = []
+        stored_id_set = set()
+        for key, cnt in self.conn.execute(
+                f'SELECT id, data FROM "{self.table}" ORDER BY rowid'):
+            stored_id_set.add(key)
+            if key in self._deleted:
+                continue
+            if key not in self._cache:
+                self._cache[key] = to_record(self.table, json.loads(cnt))
+            ret.append((key, self._cache[key]))
+        for key, val in list(self._cache.items()):
+            if key not in stored_id_set:
+                ret.append((key, val))
+        return ret
+
+    def flush(self, ids: Iterable[str]):
+        ids = set(ids)
+        # write in the order of the cache, such that new items keep the
+        # order they were added to the collection
+        for key, val in self._cache.items():
+            if key in ids:
+                self.conn.execute(
+                    f'INSERT INTO "{self.table}" (id, data) VALUES (?, ?) '
+                    f'ON CONFLICT (id) DO UPDATE SET data = excluded.data',
+                    (key, json.dumps(val, default=json_default))
+                )
+        for key in self._deleted & ids:
+            self.conn.execute(
+                f'DELETE FROM "{self.table}" WHERE id = ?', (key,))
+        self._deleted -= ids
+
+
+class SQLiteStorage(SyncDBStorage):
+    """
+    Stores the database in a SQLite file, one row per collection item,
+    so that saving only writes the changed rows.
+    """
+
+    conn: Optional[sqlite3.Connection] = None
+    saves_rows = True
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None and self.read_only:
+            # neither the schema nor the journal mode can be set without
+            # writing, and a missing DB is not created
+            uri = f'file:{urllib.parse.quote(self.path)}?mode=ro'
+            self.conn = sqlite3.connect(uri, uri=True,
+                                        check_same_thread=False)
+        if self.conn is None:
+            parent_dir = os.path.split(self.path)[0]
+            if not os.path.isdir(parent_dir):
+                os.makedirs(parent_dir, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            for coll in SYNC_DB_COLLECTIONS:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{coll}" '
+                             f'(id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    def load(self) -> Dict[str, Any]:
+        if self.read_only and not os.path.exists(self.path):
+            return {}
+        conn = self._connect()
+        data = {k: json.loads(v)
+                for k, v in conn.execute('SELECT key, value FROM meta')}
+        for coll in SYNC_DB_COLLECTIONS:
+            data[coll] = SQLiteCollection(conn, coll)
+        return data
+
+    def save(self, data: Dict[str, Any], dirty: Set[Tuple[str, str]],
+             max_backup: int = 10, backup: bool = True):
+        conn = self._connect()
+        with conn:
+            meta = {k: v for k, v in data.items()
+                    if k not in SYNC_DB_COLLECTIONS}
+            conn.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                [(k, json.dumps(v)) for k, v in meta.items()]
+            )
+            for k, in conn.execute('SELECT key FROM meta').fetchall():
+                if k not in meta:
+                    conn.execute('DELETE FROM meta WHERE key = ?', (k,))
+            for coll in SYNC_DB_COLLECTIONS:
+                data[coll].flush(i for c, i in dirty if c == coll)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+SYNC_DB_ENGINES: Dict[str, Type[SyncDBStorage]] = {
+    'json': JsonStorage,
+    'sqlite': SQLiteStorage,
+}
+
+
+def guess_sync_db_engine(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.sqlite', '.sqlite3', '.db'):
+        return 'sqlite'
+    return 'json'
 
-        for key in ('illusts', 'users'):
+
+SYNC_DB_BACKUP_MODES = ('full', 'delta', 'off')
+
+
+class DeltaBackups(object):
+    """
+    Incremental backups of a sync DB, in the directory `<db>.backups`.
+
+    A backup chain starts with a compressed snapshot of the whole DB (the
+    base), followed by the compressed records changed by each later save
+    (the deltas).  Each base or delta is a restore point.  A new chain is
+    started after `keep` restore points, and the oldest chains are removed
+    as long as `keep` restore points are left.
+
+    Each file holds one JSON header line (the time, the DB generation and
+    the top-level values), then one ``[collection, id, item]`` line per
+    record, with a null item for a removed record.
+    """
+
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, db_path: str, keep: int = 10):
+        self.path = f'{db_path}.backups'
+        self.keep = keep
+
+    def list_points(self) -> List[str]:
+        """Get the names of the restore points, from the oldest."""
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(e[:-len('.jsonl.gz')] for e in os.listdir(self.path)
+                      if e.endswith('.jsonl.gz'))
+
+    def _read_header(self, point: str) -> Dict[str, Any]:
+        with gzip.open(os.path.join(self.path, f'{point}.jsonl.gz'),
+                       'rt', encoding='utf-8') as f:
+            return json.loads(f.readline())
+
+    def save(self, data: Dict[str, Any], dirty: Set[Tuple[str, str]],
+             last_generation: Optional[int]):
+        """
+        Add a restore point for `data`, which has been saved over the DB at
+        generation `last_generation` with the changes in `dirty`.  If this
+        is not the generation of the last restore point (e.g., the last
+        process did not make a backup), a new chain is started.
+        """
+        points = self.list_points()
+        chain_size = 0
+        for point in reversed(points):
+            chain_size += 1
+            if point.endswith('-base'):
+                break
+        is_delta = (
+            points and chain_size < self.keep and last_generation is not None
+            and self._read_header(points[-1]).get('generation') == last_generation
+        )
+
+        seq = int(points[-1].split('-', 1)[0]) + 1 if points else 1
+        time_str = datetime.now().strftime('%Y%m%d_%H%M%S')
+        point = f'{seq:06d}-{time_str}-{"delta" if is_delta else "base"}'
+        os.makedirs(self.path, exist_ok=True)
+        file_path = os.path.join(self.path, f'{point}.jsonl.gz')
+        tmp_path = f'{file_path}.tmp'
+
+        with gzip.open(tmp_path, 'wt', encoding='utf-8',
+                       compresslevel=self.COMPRESS_LEVEL) as f:
+            f.write(json.dumps({
+                'time': datetime.now().isoformat(),
+                'generation': data.get('db_generation'),
+                'meta': {k: v for k, v in data.items()
+                         if k not in SYNC_DB_COLLECTIONS},
+            }) + '\n')
+            if is_delta:
+                for coll, item_id in sorted(dirty):
+                    if coll in SYNC_DB_COLLECTIONS:
+                        item = data[coll].get(item_id)
+                        f.write(json.dumps([coll, item_id, item],
+                                           default=json_default) + '\n')
+            else:
+                for coll in SYNC_DB_COLLECTIONS:
+                    for item_id, item in data[coll].items():
+                        f.write(json.dumps([coll, item_id, item],
+                                           default=json_default) + '\n')
+        os.replace(tmp_path, file_path)
+
+        # cleanup the oldest chains, as long as `keep` points are left
+        chains: List[List[str]] = []
+        for p in points + [point]:
+            if p.endswith('-base') or not chains:
+                chains.append([])
+            chains[-1].append(p)
+        n_points = len(points) + 1
+        while len(chains) > 1 and n_points - len(chains[0]) >= self.keep:
+            for old_point in chains.pop(0):
+                os.remove(os.path.join(self.path, f'{old_point}.jsonl.gz'))
+                n_points -= 1
+        return point
+
+    def load(self, point: str) -> Dict[str, Any]:
+        """Load the DB at the restore point `point`."""
+        points = self.list_points()
+        if point not in points:
+            raise ValueError(f'Unknown restore point: {point}')
+        end = points.index(point)
+        start = end
+        while not points[start].endswith('-base'):
+            if start == 0:
+                raise IOError(f'Backup chain broken: {point}')
+            start -= 1
+
+        data = {coll: {} for coll in SYNC_DB_COLLECTIONS}
+        for p in points[start: end + 1]:
+            with gzip.open(os.path.join(self.path, f'{p}.jsonl.gz'),
+                           'rt', encoding='utf-8') as f:
+                header = json.loads(f.readline())
+                for line in f:
+                    coll, item_id, item = json.loads(line)
+                    if item is None:
+                        data[coll].pop(item_id, None)
+                    else:
+                        data[coll][item_id] = item
+        data.update(header['meta'])
+        return data
+
+
+class SyncDB(object):
+    """
+    The sync database.
+
+    Unless `read_only`, the changes are saved on exit, if there are any.
+    A `read_only` DB cannot be changed, nor are its SQLite collections ever
+    written.  The items of a read-only JSON DB are not converted into
+    compact records (those of SQLite are, as they are loaded on demand).
+    """
+
+    path: str
+    read_only: bool
+    data: Dict[str, Any]
+    lock: threading.RLock
+    storage: SyncDBStorage
+    dirty: Set[Tuple[str, str]]
+    journal_path: str
+    journal_compact_every: int
+    journal_fsync: bool
+    backup: str
+    backups: Optional[DeltaBackups]
+    search_index: Optional['SearchIndex']
+
+    def __init__(self, path: str, engine: Optional[str] = None,
+                 journal_compact_every: int = 1000,
+                 journal_fsync: bool = False,
+                 backup: str = 'full',
+                 backup_keep: int = 10,
+                 read_only: bool = False):
+        if engine is None:
+            engine = guess_sync_db_engine(path)
+        if engine not in SYNC_DB_ENGINES:
+            raise ValueError(f'Unknown sync DB engine: {engine}')
+        if backup not in SYNC_DB_BACKUP_MODES:
+            raise ValueError(f'Unknown sync DB backup mode: {backup}')
+        if backup == 'full' and engine != 'json':
+            # only a JSON DB is backed up by copying its file
+            backup = 'delta'
+        storage = SYNC_DB_ENGINES[engine](path, read_only=read_only)
+        with METRICS.timer('db_load_seconds'):
+            data = storage.load()
+
+        for key in SYNC_DB_COLLECTIONS:
             if key not in data:
                 data[key] = {}
-            elif not isinstance(data[key], dict):
+            elif not isinstance(data[key], MutableMapping):
                 raise IOError(f'DB malformed: {path}')
+            elif isinstance(data[key], dict) and not read_only:
+                coll = data[key]
+                for item_id, item in coll.items():
+                    coll[item_id] = to_record(key, item)
 
-        self.path = os.path.abspath(path)
+        self.path = storage.path
+        self.read_only = read_only
         self.data = data
         self.lock = threading.RLock()
+        self.storage = storage
+        self.dirty = set()
+        self._checkpointed = False
+        self.journal_path = f'{self.path}.journal'
+        self.journal_compact_every = journal_compact_every
+        self.journal_fsync = journal_fsync
+        self._journal_file = None
+        self._journal_size = 0
+        self._journal_bytes = 0
+        self._db_bytes = None
+        self._bulk = 0
+        self._closed = False
+        self.backup = backup
+        self.backup_keep = backup_keep
+        self.backups = None
+        if backup == 'delta':
+            self.backups = DeltaBackups(self.path, keep=backup_keep)
+        # the changes since the last backup, which are not cleared by the
+        # checkpoints, and the DB generation of the last backup
+        self._backup_dirty = set()
+        self._backup_generation = data.get('db_generation')
+        self.search_index = None
+        self._replay_journal()
+
+    # ---- journal of cheap incremental changes ----
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        METRICS.inc('db_journal_replays_total')
+        with codecs.open(self.journal_path, 'rb', 'utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be truncated if the process was
+                    # killed while writing it
+                    continue
+                self._apply_journal_entry(entry)
+                self._journal_size += 1
+                self._journal_bytes += len(line)
+
+    def _apply_journal_entry(self, entry: List[Any]):
+        op, args = entry[0], entry[1:]
+        if op == 'fetched':
+            illust_id, image_id, fetched = args
+            self._update_image(illust_id, image_id, {'fetched': fetched})
+        elif op == 'image':
+            illust_id, image_id, val = args
+            self._update_image(illust_id, image_id, val)
+        elif op == 'hash':
+            digest, val = args
+            self._set_hash(digest, val)
+        elif op == 'illust':
+            illust_id, val = args
+            self._update_dict('illusts', illust_id, val)
+        elif op == 'user':
+            user_id, val = args
+            self._update_dict('users', user_id, val)
+        else:
+            raise IOError(f'Unknown journal entry: {entry!r}')
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f'The sync DB is opened read-only: {self.path}')
+        if self._closed:
+            raise RuntimeError(f'The sync DB has been closed: {self.path}')
+
+    def _write_journal(self, entry: List[Any]):
+        # e.g., by a download finished after the DB is closed on exit
+        if self._closed:
+            raise RuntimeError(f'The sync DB has been closed: {self.path}')
+        if self._journal_file is None:
+            # the first change of a new DB may come before its first save
+            os.makedirs(os.path.split(self.journal_path)[0], exist_ok=True)
+            self._journal_file = codecs.open(self.journal_path, 'ab', 'utf-8')
+        line = json.dumps(entry, default=json_default) + '\n'
+        self._journal_file.write(line)
+        self._journal_file.flush()
+        if self.journal_fsync:
+            os.fsync(self._journal_file.fileno())
+        self._journal_size += 1
+        self._journal_bytes += len(line)
+
+        if not self._bulk and self._should_compact():
+            self.checkpoint()
+
+    def _should_compact(self) -> bool:
+        if self.journal_compact_every <= 0 or self.read_only:
+            return False
+        if self.storage.saves_rows:
+            return self._journal_size >= self.journal_compact_every
+        # a save rewrites the whole DB, which is amortized by compacting
+        # only a journal grown as large as the DB
+        if self._db_bytes is None:
+            try:
+                self._db_bytes = os.path.getsize(self.path)
+            except OSError:
+                self._db_bytes = 0
+        return self._journal_size >= self.journal_compact_every and \
+            self._journal_bytes >= self._db_bytes
 
-    def save(self, max_backup: int = 10):
+    @contextlib.contextmanager
+    def bulk(self):
+        """
+        Defer the compaction of the journal to the end of a bulk update,
+        instead of every `journal_compact_every` entries (see
+        :meth:`_should_compact`).
+        """
         with self.lock:
-            output_content = json.dumps(self.data)
-
-            if os.path.exists(self.path):
-                parent_dir, file_name = os.path.split(self.path)
-
-                # move the previous db to a new backup
-                new_suffix = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                new_backup_name = f'{file_name}-{new_suffix}'
-                shutil.move(self.path, os.path.join(parent_dir, new_backup_name))
-
-                # cleanup old backups
-                backup_list = []
-                e_prefix = f'{file_name}-'
-                for e in os.listdir(parent_dir):
-                    if e.startswith(e_prefix) and e != file_name:
-                        backup_list.append(e)
-                backup_list.sort()
-                for old_backup in backup_list[:len(backup_list) - max_backup]:
-                    os.remove(os.path.join(parent_dir, old_backup))
+            self._bulk += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self._bulk -= 1
+                if not self._bulk and self._should_compact():
+                    self.checkpoint()
 
-            parent_dir = os.path.split(self.path)[0]
-            if not os.path.isdir(parent_dir):
-                os.makedirs(parent_dir, exist_ok=True)
+    def _clear_journal(self):
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_size = 0
+        self._journal_bytes = 0
+        self._db_bytes = None
+
+    def _next_generation(self):
+        # counts the saves, to detect the saves without a delta backup
+        self.data['db_generation'] = self.data.get('db_generation', 0) + 1
+
+    @property
+    def modified(self) -> bool:
+        """Whether the DB has been changed since it was opened or saved."""
+        return bool(self.dirty) or self._checkpointed
+
+    def save(self, max_backup: Optional[int] = None):
+        self._check_writable()
+        if max_backup is None:
+            max_backup = self.backup_keep
+        with self.lock, METRICS.timer('db_save_seconds'):
+            self._next_generation()
+            self.storage.save(self.data, self.dirty, max_backup=max_backup,
+                              backup=self.backup == 'full')
+            if self.backups is not None:
+                with METRICS.timer('db_backup_seconds'):
+                    self.backups.save(self.data, self._backup_dirty | self.dirty,
+                                      last_generation=self._backup_generation)
+                self._backup_dirty.clear()
+                self._backup_generation = self.data['db_generation']
+            self.dirty.clear()
+            self._checkpointed = False
+            self._clear_journal()
+            if self.search_index is not None:
+                self.search_index.commit(self)
 
-            with codecs.open(self.path, 'wb', 'utf-8') as f:
-                f.write(output_content)
+    def checkpoint(self):
+        """Compact the journal into the DB, without making a backup."""
+        self._check_writable()
+        with self.lock, METRICS.timer('db_checkpoint_seconds'):
+            self._next_generation()
+            self.storage.save(self.data, self.dirty, backup=False)
+            if self.backups is not None:
+                self._backup_dirty |= self.dirty
+            self.dirty.clear()
+            # still saved on exit, to make the backup of this session
+            self._checkpointed = True
+            self._clear_journal()
+            if self.search_index is not None:
+                self.search_index.commit(self)
+
+    def close(self):
+        with self.lock:
+            self._closed = True
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+            self.storage.close()
+            if self.search_index is not None:
+                self.search_index.close()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.save()
+        try:
+            # an unchanged DB is not written again, nor backed up
+            if not self.read_only and self.modified:
+                self.save()
+        finally:
+            self.close()
 
     # ---- common get/set items ----
     def __getitem__(self, key: str):
@@ -88,8 +1077,10 @@ class SyncDB(object):
             return self.data[key]
 
     def __setitem__(self, key: str, val):
+        self._check_writable()
         with self.lock:
             self.data[key] = val
+            self.dirty.add(('meta', key))
 
     def get(self, key: str, default=None):
         with self.lock:
@@ -103,7 +1094,30 @@ class SyncDB(object):
 
     def get_illust_ids(self):
         with self.lock:
-            return list(self.get('illusts', {}))
+            return list(self.data['illusts'])
+
+    def get_illust_items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        with self.lock:
+            return list(self.data['illusts'].items())
+
+    def iter_illust_items(self, batch_size: int = 1000
+                          ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Iterate over the illusts without copying the whole collection, nor
+        loading all the items of a SQLite DB into memory.
+        """
+        illusts = self.data['illusts']
+        if isinstance(illusts, SQLiteCollection):
+            after = 0
+            while after >= 0:
+                with self.lock:
+                    batch, after = illusts.items_batch(after, batch_size)
+                yield from batch
+        else:
+            for illust_id in self.get_illust_ids():
+                illust = self.get_illust(illust_id)
+                if illust is not None:
+                    yield illust_id, illust
 
     # ---- read/write nested collections ----
     def _get_dict(self, coll: str, id: str, default=None):
@@ -115,59 +1129,476 @@ class SyncDB(object):
             if id in self.data[coll]:
                 self.data[coll][id].update(val)
             else:
-                self.data[coll][id] = dict(val)
+                record_type = SYNC_DB_RECORD_TYPES.get(coll, dict)
+                self.data[coll][id] = record_type(val)
+            self.dirty.add((coll, id))
 
     def get_illust(self, illust_id: str, default=None):
         return self._get_dict('illusts', illust_id, default)
 
     def update_illust(self, illust_id: str, val: Dict[str, Any]):
-        self._update_dict('illusts', illust_id, val)
+        """
+        Insert an illust, or update its fields.  The change is journaled,
+        such that the illusts listed by an interrupted run are kept along
+        with their fetched images.
+        """
+        self._check_writable()
+        with self.lock:
+            self._update_dict('illusts', illust_id, val)
+            if self.search_index is not None:
+                self.search_index.mark(illust_id)
+            self._write_journal(['illust', illust_id, val])
+
+    def _update_image(self, illust_id: str, image_id: int,
+                      val: Dict[str, Any]) -> bool:
+        illust = self.data['illusts'].get(illust_id)
+        if illust is None or image_id >= len(illust.get('images', [])):
+            return False
+        image = illust['images'][image_id]
+        for k, v in val.items():
+            if v is None:
+                image.pop(k, None)
+            else:
+                image[k] = v
+        self.dirty.add(('illusts', illust_id))
+        return True
 
     def set_illust_fetched(self, illust_id: str, image_id: int, fetched: bool = True):
+        self._check_writable()
+        with self.lock:
+            self.data['illusts'][illust_id]['images'][image_id]['fetched'] = fetched
+            self.dirty.add(('illusts', illust_id))
+            self._write_journal(['fetched', illust_id, image_id, fetched])
+
+    def update_image(self, illust_id: str, image_id: int, val: Dict[str, Any]):
+        """Update the fields of an image, removing the fields set to None."""
+        self._check_writable()
+        with self.lock:
+            if not self._update_image(illust_id, image_id, val):
+                raise KeyError((illust_id, image_id))
+            self._write_journal(['image', illust_id, image_id, val])
+
+    def _set_hash(self, digest: str, val: Optional[Dict[str, Any]]):
+        if val is None:
+            self.data['hashes'].pop(digest, None)
+        else:
+            self.data['hashes'][digest] = val
+        self.dirty.add(('hashes', digest))
+
+    def get_hash(self, digest: str, default=None):
+        return self._get_dict('hashes', digest, default)
+
+    def set_hash(self, digest: str, val: Optional[Dict[str, Any]]):
+        """Set the entry of a content digest, or remove it if `val` is None."""
+        self._check_writable()
         with self.lock:
-            self['illusts'][illust_id]['images'][image_id]['fetched'] = fetched
+            self._set_hash(digest, val)
+            self._write_journal(['hash', digest, val])
 
     def get_user(self, user_id: str, default=None):
         return self._get_dict('users', user_id, default)
 
     def update_user(self, user_id: str, val: Dict[str, Any]):
-        self._update_dict('users', user_id, val)
+        self._check_writable()
+        with self.lock:
+            self._update_dict('users', user_id, val)
+            self._write_journal(['user', user_id, val])
 
 
-def is_set_intersect(a, b):
-    if not isinstance(b, set):
-        b = set(b)
-    return any(i in b for i in a)
+def get_search_index_path(config: Dict[str, Any]) -> str:
+    return config.get('search.index') or f'{config["sync.db"]}.search.sqlite'
 
 
-def is_illust_excluded(config, illust):
-    # gather illust values
-    info = {
-        'authors': [illust[k] for k in ('author_id', 'author_name')
-                    if k in illust],
-        'tags': []
-    }
-    for tag in illust.get('tags', []):
-        for k in ('name', 'translation'):
-            if k in tag:
-                info['tags'].append(tag[k])
+def open_sync_db(config: Dict[str, Any], read_only: bool = False) -> SyncDB:
+    """
+    Open the sync DB of `config`, along with its search index if it has
+    been built by `search`.  See :class:`SyncDB` for `read_only`.
+    """
+    sync_db = SyncDB(
+        config['sync.db'],
+        engine=config.get('sync.db.engine'),
+        journal_compact_every=config.get('sync.db.journal.compact_every', 1000),
+        journal_fsync=config.get('sync.db.journal.fsync', False),
+        # YAML loads `off` as False
+        backup=config.get('sync.db.backup', 'full') or 'off',
+        backup_keep=config.get('sync.db.backup.keep', 10),
+        read_only=read_only,
+    )
+    search_index_path = get_search_index_path(config)
+    if os.path.exists(search_index_path):
+        sync_db.search_index = SearchIndex(
+            search_index_path, generation=sync_db.get('db_generation'))
+        # the illusts replayed from the journal are not indexed yet
+        for coll, illust_id in sync_db.dirty:
+            if coll == 'illusts':
+                sync_db.search_index.mark(illust_id)
+    return sync_db
+
+
+def migrate_sync_db(source: SyncDB, target: SyncDB):
+    """Copy all the values and collection items from `source` to `target`."""
+    with source.lock, target.lock:
+        for key, val in source.data.items():
+            if key in SYNC_DB_COLLECTIONS:
+                for item_id, item in val.items():
+                    # not converted if the source is opened read-only
+                    target.data[key][item_id] = to_record(key, item)
+                    target.dirty.add((key, item_id))
+            else:
+                target.data[key] = val
+                target.dirty.add(('meta', key))
+        # rebuilt by the next `search`, instead of re-indexing each item
+        if target.search_index is not None:
+            target.search_index.invalidate()
+
+
+def list_full_backups(db_path: str) -> List[str]:
+    """Get the file names of the full backups of a JSON sync DB."""
+    parent_dir, file_name = os.path.split(os.path.abspath(db_path))
+    if not os.path.isdir(parent_dir):
+        return []
+    return sorted(e for e in os.listdir(parent_dir)
+                  if e.startswith(f'{file_name}-'))
+
+
+def restore_sync_db(sync_db: SyncDB, data: Dict[str, Any]):
+    """Replace all the values and collection items of `sync_db` by `data`."""
+    with sync_db.lock:
+        for key in list(sync_db.data):
+            if key not in data and key not in SYNC_DB_COLLECTIONS:
+                del sync_db.data[key]
+                sync_db.dirty.add(('meta', key))
+        for key, val in data.items():
+            if key in SYNC_DB_COLLECTIONS:
+                coll = sync_db.data[key]
+                for item_id in [i for i in coll.keys() if i not in val]:
+                    del coll[item_id]
+                    sync_db.dirty.add((key, item_id))
+                for item_id, item in val.items():
+                    coll[item_id] = to_record(key, item)
+                    sync_db.dirty.add((key, item_id))
+            elif key != 'db_generation':
+                sync_db.data[key] = val
+                sync_db.dirty.add(('meta', key))
+        if sync_db.search_index is not None:
+            sync_db.search_index.invalidate()
+
+
+def _normalize_search_text(text: str) -> str:
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def _iter_title_terms(text: str, query: bool = False) -> Iterator[str]:
+    """
+    Split a title into words, and the words not in ASCII (e.g., Japanese,
+    not separated by spaces) further into the characters and the pairs of
+    adjacent characters.  A query word of multiple characters is matched
+    by its pairs only.
+    """
+    for word in re.findall(r'\w+', _normalize_search_text(text)):
+        if word.isascii() or len(word) == 1:
+            yield word
+        else:
+            if not query:
+                yield from word
+            for i in range(len(word) - 1):
+                yield word[i: i + 2]
+
+
+class SearchIndex(object):
+    """
+    Inverted index of the illusts by tag (name and translation), author (id
+    and name) and title, in a SQLite DB beside the sync DB.
+
+    The illusts changed by :meth:`SyncDB.update_illust` are re-indexed when
+    the sync DB is saved, and the DB generation is recorded along with them.
+    If the generation does not match the sync DB (e.g., the process was
+    killed between both saves), the index is `stale` and must be rebuilt.
+    See :meth:`search` for the query syntax.
+    """
+
+    FIELDS = ('tag', 'author', 'title')
+
+    def __init__(self, path: str, generation: Optional[int] = None):
+        self.path = path
+        os.makedirs(os.path.split(os.path.abspath(path))[0], exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                              '(key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS documents '
+                              '(illust_id INTEGER PRIMARY KEY)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS postings '
+                              '(term TEXT NOT NULL, illust_id INTEGER NOT NULL, '
+                              'PRIMARY KEY (term, illust_id)) WITHOUT ROWID')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS postings_illust '
+                              'ON postings (illust_id)')
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        self.stale = row is None or json.loads(row[0]) != generation
+        self._pending: Set[str] = set()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def get_terms(illust: Mapping[str, Any]) -> Set[str]:
+        terms = set()
+        for tag in illust.get('tags', []):
+            for k in ('name', 'translation'):
+                if tag.get(k):
+                    terms.add('tag:' + _normalize_search_text(tag[k]))
+        for k in ('author_id', 'author_name'):
+            if illust.get(k):
+                terms.add('author:' + _normalize_search_text(illust[k]))
+        terms.update('title:' + t
+                     for t in _iter_title_terms(illust.get('title') or ''))
+        return terms
+
+    def _index(self, illust_id: str, illust: Optional[Mapping[str, Any]],
+               new: bool = False):
+        doc_id = int(illust_id)
+        if not new:
+            self.conn.execute('DELETE FROM postings WHERE illust_id = ?',
+                              (doc_id,))
+        if illust is None or illust.get('_deleted', False):
+            self.conn.execute('DELETE FROM documents WHERE illust_id = ?',
+                              (doc_id,))
+        else:
+            self.conn.execute('INSERT OR IGNORE INTO documents VALUES (?)',
+                              (doc_id,))
+            self.conn.executemany(
+                'INSERT INTO postings VALUES (?, ?)',
+                ((t, doc_id) for t in self.get_terms(illust)))
+
+    def _set_generation(self, generation: Optional[int]):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                          ('generation', json.dumps(generation)))
+
+    def mark(self, illust_id: str):
+        """Re-index the illust on the next :meth:`commit`."""
+        self._pending.add(illust_id)
+
+    def invalidate(self):
+        with self.conn:
+            self._set_generation(None)
+        self.stale = True
+
+    def commit(self, sync_db: 'SyncDB'):
+        """Re-index the changed illusts, after `sync_db` has been saved."""
+        pending, self._pending = self._pending, set()
+        if self.stale:
+            return
+        with self.conn:
+            for illust_id in pending:
+                self._index(illust_id, sync_db.get_illust(illust_id))
+            self._set_generation(sync_db.get('db_generation'))
+
+    def build(self, sync_db: 'SyncDB'):
+        """Index all the illusts of `sync_db` from scratch."""
+        with self.conn:
+            self.conn.execute('DELETE FROM postings')
+            self.conn.execute('DELETE FROM documents')
+            # the primary key is faster to build in order
+            self.conn.execute('DROP INDEX IF EXISTS postings_illust')
+            for illust_id, illust in sync_db.iter_illust_items():
+                self._index(illust_id, illust, new=True)
+            self.conn.execute('CREATE INDEX postings_illust '
+                              'ON postings (illust_id)')
+            self._set_generation(sync_db.get('db_generation'))
+        self._pending.clear()
+        self.stale = False
+
+    def _term_query(self, field: Optional[str], value: str
+                    ) -> Tuple[str, List[str]]:
+        if field is None:
+            parts = [self._term_query(f, value) for f in self.FIELDS]
+            return (' UNION '.join(f'SELECT illust_id FROM ({q})'
+                                   for q, _ in parts),
+                    [p for _, params in parts for p in params])
+        if field not in self.FIELDS:
+            raise ValueError(f'Unknown search field: {field}')
+        value = _normalize_search_text(value)
+        prefix = value.endswith('*')
+        value = value.rstrip('*')
+        if field == 'title':
+            terms = list(_iter_title_terms(value, query=True)) or ['']
+        else:
+            terms = [value]
+        queries, params = [], []
+        for term in terms:
+            term = f'{field}:{term}'
+            if prefix:
+                queries.append('SELECT illust_id FROM postings '
+                               'WHERE term >= ? AND term < ?')
+                params.extend([term, term + '\U0010ffff'])
+            else:
+                queries.append('SELECT illust_id FROM postings WHERE term = ?')
+                params.append(term)
+        return (' INTERSECT '.join(f'SELECT illust_id FROM ({q})'
+                                   for q in queries), params)
 
-    # test against rules
-    includes = config.get('includes', {})
-    includes = {k: includes[k] for k in info if k in includes}
-    excludes = config.get('excludes', {})
-    excludes = {k: excludes[k] for k in info if k in excludes}
+    def _to_sql(self, node) -> Tuple[str, List[str]]:
+        op = node[0]
+        if op == 'term':
+            return self._term_query(node[1], node[2])
+        if op == 'not':
+            q, params = self._to_sql(node[1])
+            return (f'SELECT illust_id FROM documents EXCEPT '
+                    f'SELECT illust_id FROM ({q})', params)
+        children = node[1]
+        if op == 'or':
+            parts = [self._to_sql(c) for c in children]
+            return (' UNION '.join(f'SELECT illust_id FROM ({q})'
+                                   for q, _ in parts),
+                    [p for _, params in parts for p in params])
+        # "and": intersect the positive terms, then except the negative ones
+        positives = [self._to_sql(c) for c in children if c[0] != 'not']
+        negatives = [self._to_sql(c[1]) for c in children if c[0] == 'not']
+        if not positives:
+            positives = [('SELECT illust_id FROM documents', [])]
+        sql = ' INTERSECT '.join(f'SELECT illust_id FROM ({q})'
+                                 for q, _ in positives)
+        sql += ''.join(f' EXCEPT SELECT illust_id FROM ({q})'
+                       for q, _ in negatives)
+        return sql, [p for _, params in positives + negatives for p in params]
 
-    if includes:
-        if not any(is_set_intersect(info[k], includes[k]) for k in includes):
-            return True
+    def search(self, query: str, limit: Optional[int] = None
+               ) -> Tuple[List[str], int]:
+        """
+        Search the illusts, returning the ids of the newest `limit` matches,
+        along with the total number of matches.
 
-    if excludes:
-        if any(is_set_intersect(info[k], excludes[k]) for k in excludes):
-            return True
+        The query is made of terms, i.e., `tag:<tag>`, `author:<id or name>`,
+        `title:<words>`, or a bare word matching any of them, quoted if
+        containing spaces, and a trailing `*` to match by prefix.  The terms
+        are combined by `AND` (implicit), `OR`, `NOT` (or `-`) and
+        parentheses.  The matches are case-insensitive.
+        """
+        sql, params = self._to_sql(_parse_search_query(query))
+        total = self.conn.execute(
+            f'SELECT COUNT(*) FROM ({sql})', params).fetchone()[0]
+        sql = f'SELECT illust_id FROM ({sql}) ORDER BY illust_id DESC'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return [str(r[0]) for r in self.conn.execute(sql, params)], total
 
-    # default action
-    return False
+
+_SEARCH_TOKEN_PATTERN = re.compile(
+    r'\s*(?:(?P<paren>[()])|(?P<neg>-)?(?:(?P<field>\w+):)?'
+    r'(?:"(?P<quoted>[^"]*)"|(?P<word>[^\s()"]+)))')
+
+
+def _parse_search_query(query: str):
+    """Parse a search query into a tree of `(op, ...)` tuples."""
+    tokens = []
+    pos, query = 0, query.strip()
+    while pos < len(query):
+        m = _SEARCH_TOKEN_PATTERN.match(query, pos)
+        if not m or m.end() == pos:
+            raise ValueError(f'Invalid search query at {pos}: {query!r}')
+        pos = m.end()
+        if m.group('paren'):
+            tokens.append(m.group('paren'))
+        elif m.group('quoted') is None and not m.group('field') and \
+                not m.group('neg') and m.group('word') in ('AND', 'OR', 'NOT'):
+            tokens.append(m.group('word'))
+        else:
+            value = m.group('quoted')
+            if value is None:
+                value = m.group('word')
+            term = ('term', m.group('field'), value)
+            tokens.append(('not', term) if m.group('neg') else term)
+
+    def peek():
+        return tokens[0] if tokens else None
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() == 'OR':
+            tokens.pop(0)
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ('or', children)
+
+    def parse_and():
+        children = [parse_unary()]
+        while peek() is not None and peek() not in ('OR', ')'):
+            if peek() == 'AND':
+                tokens.pop(0)
+            children.append(parse_unary())
+        return children[0] if len(children) == 1 else ('and', children)
+
+    def parse_unary():
+        token = tokens.pop(0) if tokens else None
+        if token == 'NOT':
+            return ('not', parse_unary())
+        if token == '(':
+            node = parse_or()
+            if not tokens or tokens.pop(0) != ')':
+                raise ValueError(f'Unbalanced parentheses: {query!r}')
+            return node
+        if not isinstance(token, tuple):
+            raise ValueError(f'Invalid search query: {query!r}')
+        return token
+
+    node = parse_or()
+    if tokens:
+        raise ValueError(f'Invalid search query: {query!r}')
+    return node
+
+
+class IllustFilter(object):
+    """The include/exclude rules of the config, compiled into frozen sets."""
+
+    RULE_KEYS = ('authors', 'tags')
+
+    includes: Dict[str, FrozenSet[str]]
+    excludes: Dict[str, FrozenSet[str]]
+    fingerprint: str
+
+    def __init__(self, config: Dict[str, Any]):
+        def compile_rules(rules):
+            rules = rules or {}
+            return {k: frozenset(rules[k] or ()) for k in self.RULE_KEYS
+                    if k in rules}
+
+        self.includes = compile_rules(config.get('includes'))
+        self.excludes = compile_rules(config.get('excludes'))
+        self.fingerprint = hashlib.sha1(json.dumps(
+            {
+                'includes': {k: sorted(map(str, v))
+                             for k, v in self.includes.items()},
+                'excludes': {k: sorted(map(str, v))
+                             for k, v in self.excludes.items()},
+            },
+            sort_keys=True
+        ).encode('utf-8')).hexdigest()
+
+    def is_excluded(self, illust: Dict[str, Any]) -> bool:
+        # gather illust values
+        info = {
+            'authors': [illust[k] for k in ('author_id', 'author_name')
+                        if k in illust],
+            'tags': []
+        }
+        for tag in illust.get('tags', []):
+            for k in ('name', 'translation'):
+                if k in tag:
+                    info['tags'].append(tag[k])
+
+        # test against rules
+        if self.includes:
+            if all(self.includes[k].isdisjoint(info[k]) for k in self.includes):
+                return True
+
+        if self.excludes:
+            if any(not self.excludes[k].isdisjoint(info[k]) for k in self.excludes):
+                return True
+
+        # default action
+        return False
 
 
 def load_config_file(config_file: str) -> Dict[str, Any]:
@@ -187,23 +1618,159 @@ def pixiv_sync():
     """Pixiv illustrations sync tool."""
 
 
-def make_api_client(sync_db: SyncDB) -> AppPixivAPI:
-    api = AppPixivAPI()
-    auth = sync_db.get_token()
-    keys = ('access_token', 'device_token', 'refresh_token', 'user')
-    if auth and all(k in auth for k in keys):
-        api.access_token = auth['access_token']
-        api.refresh_token = auth['refresh_token']
-        api.user_id = auth['user']['id']
-    return api
+class RateLimiter(object):
+    """
+    Token bucket rate limiter shared by threads.
 
+    The rate is halved on each rate-limit error (:meth:`backoff`), and
+    recovers additively towards `max_rate` on success (:meth:`recover`).
+    """
 
-AUTHOR_ID_PATTERNS = [
-    re.compile(r'^(\d+)$'),
-    re.compile(r'^https?://www\.pixiv\.net/users/(\d+)(?:/.*)?')
-]
-ILLUST_ID_PATTERNS = [
-    re.compile(r'/artworks/(\d+)(?:/.*)?$'),
+    def __init__(self, max_rate: float, burst: Optional[float] = None,
+                 min_rate: Optional[float] = None,
+                 backoff_delay: float = 5.0):
+        if burst is None:
+            burst = max(max_rate, 1.)
+        if min_rate is None:
+            min_rate = max_rate / 16.
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.backoff_delay = backoff_delay
+        self._tokens = burst
+        self._last_time = time.monotonic()
+        self._paused_until = 0.
+        self._n_backoff = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float = 1.):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(
+                        self.burst,
+                        self._tokens + (now - self._last_time) * self.rate
+                    )
+                    self._last_time = now
+                    if self._tokens >= n:
+                        self._tokens -= n
+                        return
+                    delay = (n - self._tokens) / self.rate
+                else:
+                    delay = self._paused_until - now
+            time.sleep(delay)
+
+    def backoff(self) -> float:
+        """Slow down after a rate-limit error, returning the pause delay."""
+        with self._lock:
+            self._n_backoff += 1
+            self.rate = max(self.min_rate, self.rate * .5)
+            self._tokens = 0.
+            delay = self.backoff_delay * min(2 ** (self._n_backoff - 1), 16)
+            self._last_time = self._paused_until = time.monotonic() + delay
+            return delay
+
+    def recover(self):
+        with self._lock:
+            self._n_backoff = 0
+            self.rate = min(self.max_rate,
+                            self.rate + self.max_rate / 16.)
+
+    def reserve(self, n: float) -> float:
+        """
+        Take `n` tokens even if not yet available (e.g., more than `burst`),
+        returning the delay to wait for them, without blocking.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst,
+                self._tokens + max(0., now - self._last_time) * self.rate
+            )
+            self._last_time = now
+            self._tokens -= n
+            return max(0., -self._tokens / self.rate)
+
+
+def make_rate_limiter(config: Dict[str, Any]) -> Optional[RateLimiter]:
+    # unlimited unless configured, as before the limiter was shared
+    max_rate = config.get('api.rate')
+    if not max_rate:
+        return None
+    return RateLimiter(max_rate, burst=config.get('api.burst'))
+
+
+def _is_rate_limited(response) -> bool:
+    if response.status_code not in (403, 429):
+        return False
+    return response.status_code == 429 or 'Rate Limit' in response.text
+
+
+def install_rate_limiter(api: 'AppPixivAPI', rate_limiter: RateLimiter,
+                         max_retries: int = 5):
+    """Let all the API calls of `api` go through `rate_limiter`."""
+    requests_call = api.no_auth_requests_call
+
+    def rate_limited_requests_call(*args, **kwargs):
+        attempt = 0
+        while True:
+            with METRICS.timer('api_rate_limit_wait_seconds'):
+                rate_limiter.acquire()
+            response = requests_call(*args, **kwargs)
+            if not _is_rate_limited(response):
+                rate_limiter.recover()
+                return response
+            if attempt >= max_retries:
+                return response
+            METRICS.inc('api_rate_limited_total')
+            delay = rate_limiter.backoff()
+            print(f'! Rate limited by Pixiv, retry after {delay:.1f} seconds.')
+            attempt += 1
+
+    api.no_auth_requests_call = rate_limited_requests_call
+
+
+def new_app_api() -> 'AppPixivAPI':
+    # imported on demand, since pixivpy3 and its HTTP stack take a while to
+    # import, and the commands only inspecting the DB never use them
+    from pixivpy3 import AppPixivAPI
+    return AppPixivAPI()
+
+
+def make_api_client(sync_db: SyncDB,
+                    rate_limiter: Optional[RateLimiter] = None) -> 'AppPixivAPI':
+    api = new_app_api()
+    auth = sync_db.get_token()
+    keys = ('access_token', 'device_token', 'refresh_token', 'user')
+    if auth and all(k in auth for k in keys):
+        api.access_token = auth['access_token']
+        api.refresh_token = auth['refresh_token']
+        api.user_id = auth['user']['id']
+    if rate_limiter is not None:
+        install_rate_limiter(api, rate_limiter)
+    return api
+
+
+def refresh_api_token(api: 'AppPixivAPI', sync_db: SyncDB) -> bool:
+    """
+    Obtain a new access token by the refresh token of `api`, and store it
+    into `sync_db`.  Returns False if not logged in.
+    """
+    if not api.refresh_token:
+        return False
+    token = api.auth(refresh_token=api.refresh_token)['response']
+    sync_db.set_token(token)
+    return True
+
+
+AUTHOR_ID_PATTERNS = [
+    re.compile(r'^(\d+)$'),
+    re.compile(r'^https?://www\.pixiv\.net/users/(\d+)(?:/.*)?')
+]
+ILLUST_ID_PATTERNS = [
+    re.compile(r'/artworks/(\d+)(?:/.*)?$'),
 ]
 
 
@@ -254,223 +1821,2230 @@ def extract_illust_data(illust) -> Dict[str, Any]:
     return r
 
 
-def update_list(sync_db: SyncDB, config: Dict[str, Any],
-                max_bookmark_id: Optional[str] = None):
-    """Pull the new illustrations that should be downloaded."""
-    def store_illust(illust, counter):
-        illust_id = str(illust['id'])
-        if not sync_db.get_illust(illust_id):
-            item = extract_illust_data(illust)
-            item['_deleted'] = is_illust_excluded(config, item)
-            if item:
-                sync_db.update_illust(illust_id, item)
-                counter += 1
-        return counter
+def parse_author_id(author_id_or_url: str) -> str:
+    for pattern in AUTHOR_ID_PATTERNS:
+        m = pattern.match(author_id_or_url)
+        if m:
+            return m.group(1)
+    raise ValueError(f'No author ID can be recognized from: '
+                     f'{author_id_or_url}')
+
+
+def update_list(sync_db: SyncDB, config: Dict[str, Any],
+                max_bookmark_id: Optional[str] = None,
+                full: bool = False,
+                on_new_illust: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+                api: Optional['AppPixivAPI'] = None):
+    """
+    Pull the new illustrations that should be downloaded.
+
+    Unless `full` is True, the illustrations of each author are pulled
+    until the first page containing the newest illustration seen by the
+    last successful pull of this author, and the bookmarks until the first
+    page without a new illustration.  `on_new_illust` is called with
+    the id and the data of each newly stored illustration.  If `api` is
+    not specified, a rate limited client is made from `sync_db`.
+    """
+    def store_illust(illust, counter, bookmarked=False):
+        illust_id = str(illust['id'])
+        item = None
+        # authors are pulled concurrently, so check and insert atomically
+        with sync_db.lock:
+            old_item = sync_db.get_illust(illust_id)
+            if not old_item:
+                item = extract_illust_data(illust)
+                item['_deleted'] = illust_filter.is_excluded(item)
+                if bookmarked:
+                    item['bookmarked'] = True
+                if item:
+                    sync_db.update_illust(illust_id, item)
+                    counter += 1
+                    METRICS.inc('illusts_discovered_total')
+            elif bookmarked and not old_item.get('bookmarked', False):
+                # pulled from an author first, then bookmarked
+                sync_db.update_illust(illust_id, {'bookmarked': True})
+        # called outside the lock, since it may block on a full queue
+        if item and on_new_illust is not None:
+            on_new_illust(illust_id, item)
+        return counter
+
+    illust_filter = IllustFilter(config)
+    if api is None:
+        api = make_api_client(sync_db, rate_limiter=make_rate_limiter(config))
+
+    # get new illustrations list from interested authors
+    def pull_author(author_id_or_url):
+        author_id = parse_author_id(author_id_or_url)
+        latest_illust_id = None
+        if not full:
+            latest_illust_id = sync_db.get_user(author_id, {}).get(
+                'latest_illust_id')
+        print(f'> Pull from: {author_id_or_url}')
+        offset = 0
+        new_counter = 0
+        newest_illust_id = latest_illust_id
+        try:
+            while True:
+                with METRICS.timer('api_request_seconds'):
+                    r = api.user_illusts(author_id, offset=offset)
+                METRICS.inc('api_pages_total')
+                if 'error' in r:
+                    raise Exception(r['error']['message'] or r['error']['user_message'])
+                illusts = r['illusts']
+                if not illusts:
+                    break
+                for illust in illusts:
+                    new_counter = store_illust(illust, new_counter)
+                offset += len(illusts)
+
+                page_ids = [int(illust['id']) for illust in illusts]
+                if newest_illust_id is None or \
+                        max(page_ids) > int(newest_illust_id):
+                    newest_illust_id = str(max(page_ids))
+
+                # the illusts are listed from the newest, so the rest pages
+                # have been pulled by the last sync
+                if latest_illust_id is not None and \
+                        min(page_ids) <= int(latest_illust_id):
+                    break
+
+        except Exception:
+            METRICS.inc('api_errors_total')
+            print(''.join(traceback.format_exception(*sys.exc_info())) +
+                  f'Failed to call `api.user_illusts`: user_id={author_id}, '
+                  f'offset={offset}.')
+
+        else:
+            # only record the high-water mark after a complete pull, otherwise
+            # the older illusts would be skipped by the next sync
+            sync_db.update_user(author_id, {
+                'latest_illust_id': newest_illust_id,
+                'synced_at': datetime.now().isoformat(),
+            })
+
+        if new_counter > 0:
+            print(f'Discovered {new_counter} new illusts from: '
+                  f'{author_id_or_url}')
+
+    authors = config.get('authors', [])
+    for author_id_or_url in authors:
+        parse_author_id(author_id_or_url)  # validate before pulling
+    if authors:
+        with METRICS.phase('list_authors'), sync_db.bulk():
+            pool = ThreadPool(processes=config.get('list.workers', 4))
+            pool.map(pull_author, authors)
+            pool.close()
+            pool.join()
+
+    # get new illustrations from user's bookmarks
+    with METRICS.phase('list_bookmarks'), sync_db.bulk():
+        the_max_bookmark_id = max_bookmark_id
+        if api.user_id:
+            for fav in config.get('favourites', []):
+                if fav not in ('public', 'private'):
+                    raise ValueError(f'Unknown favourite type: {fav}')
+
+                max_bookmark_id = the_max_bookmark_id
+                new_counter = 0
+
+                while True:
+                    print(f'> Pull from bookmark: {fav} (max_bookmark_id={max_bookmark_id})')
+                    with METRICS.timer('api_request_seconds'):
+                        r = api.user_bookmarks_illust(
+                            api.user_id, restrict=fav, max_bookmark_id=max_bookmark_id)
+                    METRICS.inc('api_pages_total')
+                    if 'error' in r:
+                        raise Exception(r['error']['message'] or r['error']['user_message'])
+
+                    # parse the illustrations
+                    illusts = r['illusts']
+                    if not illusts:
+                        break
+
+                    old_new_counter = new_counter
+                    for illust in illusts:
+                        new_counter = store_illust(illust, new_counter,
+                                                   bookmarked=True)
+
+                    # if no new illusts on this page, stop pulling, unless
+                    # the illusts already stored are to be flagged as
+                    # bookmarked
+                    if old_new_counter == new_counter:
+                        if not full:
+                            break
+                    else:
+                        print(f'Discovered {new_counter - old_new_counter} new illusts.')
+
+                    # parse the next bookmark
+                    next_url = r['next_url']
+                    if not next_url:
+                        break
+                    m = re.match(r'.*[?&]max_bookmark_id=(\d+)(?:&|$)', next_url)
+                    if m:
+                        max_bookmark_id = m.group(1)
+                    else:
+                        break
+        else:
+            print('! User not logged in, bookmarks disabled.')
+
+    # update "_deleted" if the rules have changed since the last sync,
+    # otherwise only the new illusts need to be evaluated (by `store_illust`)
+    if sync_db.get('rules_fingerprint') != illust_filter.fingerprint:
+        print('> Rules changed, re-evaluate all illusts.')
+        with METRICS.phase('evaluate_rules'), sync_db.bulk():
+            for illust_id, illust in sync_db.iter_illust_items():
+                deleted = illust_filter.is_excluded(illust)
+                if illust.get('_deleted') != deleted:
+                    sync_db.update_illust(illust_id, {'_deleted': deleted})
+        sync_db['rules_fingerprint'] = illust_filter.fingerprint
+
+
+# the fields of an illust updated by `refresh`, besides the images
+REFRESH_FIELDS = ('title', 'author_id', 'author_name', 'tags', 'width',
+                  'height')
+
+# the error messages of `api.illust_detail` for the works deleted on Pixiv
+UNAVAILABLE_ILLUST_PATTERN = re.compile(
+    r'見つかりません|削除|存在しない|not found|deleted|does not exist', re.I)
+
+
+def get_illust_fingerprint(item: Mapping[str, Any]) -> str:
+    """Digest of the metadata of an illust, to detect the edited works."""
+    cnt = {k: item.get(k) for k in REFRESH_FIELDS}
+    cnt['images'] = [image['url'] for image in item.get('images', [])]
+    return hashlib.sha1(json.dumps(
+        cnt, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def select_stale_illusts(sync_db: SyncDB, max_age: Optional[float] = None,
+                         limit: Optional[int] = None) -> List[str]:
+    """
+    Get the ids of the illusts not refreshed within `max_age` seconds, the
+    stalest first (i.e., the never refreshed ones, then by `refreshed_at`).
+    """
+    cutoff = None
+    if max_age is not None:
+        cutoff = (datetime.now() - timedelta(seconds=max_age)).isoformat()
+    candidates = (
+        (illust.get('refreshed_at') or '', int(illust_id), illust_id)
+        for illust_id, illust in sync_db.iter_illust_items()
+        if not illust.get('unavailable') and
+        (cutoff is None or (illust.get('refreshed_at') or '') < cutoff)
+    )
+    if limit:
+        candidates = heapq.nsmallest(limit, candidates)
+    else:
+        candidates = sorted(candidates)
+    return [illust_id for _, _, illust_id in candidates]
+
+
+def _merge_refreshed_images(sync_db: SyncDB, download_dir: str,
+                            illust_id: str, illust: Mapping[str, Any],
+                            new_images: List[Dict[str, Any]],
+                            dir_index: 'DirectoryIndex',
+                            layout: str = 'author_name'
+                            ) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Merge the refreshed pages of an illust into its images, returning the
+    new images, and the number of pages to fetch.
+
+    The pages with the same url are kept.  The pages whose url has changed
+    (e.g., re-uploaded) are to be fetched again, and released from the hash
+    index.  The paths of the fetched images are pinned, since the default
+    paths may change along with the pages or the author.
+    """
+    images = [dict(image) for image in illust.get('images', [])]
+    for i, image in enumerate(images):
+        if image.get('fetched', False) and not image.get('path'):
+            image['path'] = os.path.relpath(get_image_path(
+                download_dir, illust_id, illust, i), download_dir)
+
+    changed = [i for i, image in enumerate(new_images)
+               if i >= len(images) or images[i]['url'] != image['url']]
+    released = [images[i] if i in changed else {}
+                for i in range(len(images))]
+    _release_image_refs(sync_db, download_dir, illust_id,
+                        {**illust, 'images': released}, dir_index, layout)
+    merged = [images[i] if i not in changed else {'url': image['url']}
+              for i, image in enumerate(new_images)]
+    # the pages removed from Pixiv are kept, along with their files
+    merged.extend(images[len(new_images):])
+    return merged, len(changed)
+
+
+def refresh_illusts(sync_db: SyncDB, config: Dict[str, Any],
+                    download_dir: str, illust_ids: List[str],
+                    dir_index: 'DirectoryIndex',
+                    api: Optional['AppPixivAPI'] = None,
+                    checkpoint_interval: float = 60.) -> Dict[str, int]:
+    """
+    Fetch the metadata of the illusts again, in batches of
+    `refresh.batch_size` illusts pulled by `list.workers` concurrent
+    workers, and store the changed fields.
+
+    The illusts whose fingerprint is unchanged only get a new
+    `refreshed_at`.  The illusts deleted on Pixiv are marked `unavailable`,
+    with their images kept.  The DB is checkpointed every
+    `checkpoint_interval` seconds, such that an interrupted refresh resumes
+    from the stalest illusts left.
+    """
+    illust_filter = IllustFilter(config)
+    layout = get_download_layout(config)
+    if api is None:
+        api = make_api_client(sync_db, rate_limiter=make_rate_limiter(config))
+    batch_size = config.get('refresh.batch_size', 100)
+    counts = dict.fromkeys(
+        ['unchanged', 'changed', 'unavailable', 'failed', 'new_pages'], 0)
+
+    def fetch_detail(illust_id):
+        try:
+            with METRICS.timer('api_request_seconds'):
+                r = api.illust_detail(illust_id)
+            METRICS.inc('api_pages_total')
+            return illust_id, r
+        except Exception:
+            METRICS.inc('api_errors_total')
+            print(''.join(traceback.format_exception(*sys.exc_info())) +
+                  f'Failed to call `api.illust_detail`: illust_id={illust_id}.')
+            return illust_id, None
+
+    def apply_detail(illust_id, r):
+        illust = sync_db.get_illust(illust_id)
+        now = datetime.now().isoformat()
+        if r is None:
+            counts['failed'] += 1
+            return
+        if 'error' in r or not r['illust'].get('visible', True):
+            error = r.get('error') or {}
+            message = error.get('user_message') or error.get('message') or ''
+            if 'error' in r and not UNAVAILABLE_ILLUST_PATTERN.search(message):
+                counts['failed'] += 1
+                print(f'! Failed to refresh illust {illust_id}: {message}')
+                return
+            counts['unavailable'] += 1
+            print(f'Unavailable: {illust_id}')
+            sync_db.update_illust(illust_id, {'unavailable': True,
+                                              'refreshed_at': now})
+            return
+
+        item = extract_illust_data(r['illust'])
+        fingerprint = get_illust_fingerprint(item)
+        changes: Dict[str, Any] = {'refreshed_at': now}
+        changed_fields = []
+        if illust.get('unavailable'):
+            changes['unavailable'] = False
+        # the illusts stored before the fingerprints are compared by fields
+        if illust.get('fingerprint') != fingerprint:
+            changes['fingerprint'] = fingerprint
+            changed_fields = [k for k in REFRESH_FIELDS
+                              if illust.get(k) != item[k]]
+            changes.update({k: item[k] for k in changed_fields})
+            if [im['url'] for im in illust.get('images', [])] != \
+                    [im['url'] for im in item['images']]:
+                changed_fields.append('images')
+            if {'images', 'author_id', 'author_name'} & set(changed_fields):
+                changes['images'], n_new = _merge_refreshed_images(
+                    sync_db, download_dir, illust_id, illust, item['images'],
+                    dir_index, layout)
+                counts['new_pages'] += n_new
+            deleted = illust_filter.is_excluded({**illust, **changes})
+            if illust.get('_deleted') != deleted:
+                changes['_deleted'] = deleted
+
+        if changed_fields:
+            counts['changed'] += 1
+            print(f'Changed: {illust_id} ({", ".join(changed_fields)})')
+        else:
+            counts['unchanged'] += 1
+        sync_db.update_illust(illust_id, changes)
+
+    print(f'> Refresh {len(illust_ids)} illusts ...')
+    pool = ThreadPool(processes=config.get('list.workers', 4))
+    checkpoint_time = time.monotonic()
+    try:
+        with METRICS.phase('refresh'):
+            for start in range(0, len(illust_ids), batch_size):
+                batch = illust_ids[start: start + batch_size]
+                for illust_id, r in pool.imap(fetch_detail, batch):
+                    with sync_db.lock:
+                        apply_detail(illust_id, r)
+                print(f'[{min(start + batch_size, len(illust_ids))}/'
+                      f'{len(illust_ids)}] refreshed.')
+                if time.monotonic() - checkpoint_time >= checkpoint_interval:
+                    sync_db.checkpoint()
+                    checkpoint_time = time.monotonic()
+    finally:
+        pool.close()
+        pool.join()
+    return counts
+
+
+@dataclass
+class FetchImageJob(object):
+    __slots__ = ('file_path', 'image_url', 'illust_id', 'image_id',
+                 'author_id')
+
+    file_path: str
+    image_url: str
+    illust_id: str
+    image_id: int
+    author_id: str
+
+
+@dataclass
+class FetchImageResult(object):
+    size: int
+    digest: str  # SHA-256 of the content
+
+
+DOWNLOAD_HEADERS = {
+    'Referer': 'https://app-api.pixiv.net/',
+    # compressed responses would break resuming by byte ranges
+    'Accept-Encoding': 'identity',
+}
+
+
+def _shard(key: str) -> str:
+    return hashlib.md5(key.encode('utf-8')).hexdigest()[:2]
+
+
+# the directories of an illust, relative to the download directory
+DOWNLOAD_LAYOUTS: Dict[str, Callable[[str, Dict[str, Any]], List[str]]] = {
+    # <author_name>/<file>
+    'author_name': lambda illust_id, illust: [illust['author_name']],
+    # <author_id>/<file>, not changed by renaming the author
+    'author_id': lambda illust_id, illust: [illust['author_id']],
+    # <hash prefix of author_id>/<author_id>/<hash prefix of illust_id>/<file>,
+    # at most 256 entries per directory above the authors and the illusts
+    'sharded': lambda illust_id, illust: [
+        _shard(illust['author_id']), illust['author_id'], _shard(illust_id)],
+}
+
+
+def get_illust_dir(download_dir: str, illust_id: str,
+                   illust: Dict[str, Any],
+                   layout: str = 'author_name') -> str:
+    """
+    Get the directory of an illust in the download `layout`, with one
+    more directory for the illusts of multiple pages.
+    """
+    parent_dir = os.path.join(
+        download_dir, *DOWNLOAD_LAYOUTS[layout](illust_id, illust))
+    if len(illust.get('images', [])) > 1:
+        parent_dir = os.path.join(parent_dir, illust_id)
+    return parent_dir
+
+
+def get_default_image_path(download_dir: str, illust_id: str,
+                           illust: Dict[str, Any], image_id: int,
+                           layout: str = 'author_name') -> str:
+    image_url = illust['images'][image_id]['url']
+    file_name = image_url.rsplit('/', 1)[-1]
+    return os.path.join(
+        get_illust_dir(download_dir, illust_id, illust, layout), file_name)
+
+
+def get_image_path(download_dir: str, illust_id: str,
+                   illust: Dict[str, Any], image_id: int,
+                   layout: str = 'author_name') -> str:
+    """
+    Get the path of an image, which is the `path` stored in the image
+    (relative to `download_dir`) when fetched, or the default path in the
+    download `layout`.  The images fetched before the paths were stored
+    are in the original "author_name" layout.
+    """
+    image = illust['images'][image_id]
+    path = image.get('path')
+    if path:
+        return os.path.join(download_dir, path)
+    if image.get('fetched', False):
+        layout = 'author_name'
+    return get_default_image_path(
+        download_dir, illust_id, illust, image_id, layout)
+
+
+def get_image_paths(download_dir: str, illust_id: str,
+                    illust: Dict[str, Any],
+                    layout: str = 'author_name') -> List[str]:
+    """
+    Get the paths of all the images of an illust, as :func:`get_image_path`,
+    with the directory of the illust resolved once.
+    """
+    ret = []
+    illust_dirs = {}
+    for image in illust.get('images', []):
+        path = image.get('path')
+        if path:
+            ret.append(os.path.join(download_dir, path))
+            continue
+        image_layout = 'author_name' if image.get('fetched', False) else layout
+        illust_dir = illust_dirs.get(image_layout)
+        if illust_dir is None:
+            illust_dir = illust_dirs[image_layout] = get_illust_dir(
+                download_dir, illust_id, illust, image_layout)
+        ret.append(os.path.join(illust_dir, image['url'].rsplit('/', 1)[-1]))
+    return ret
+
+
+def get_illust_fetch_jobs(download_dir: str, illust_id: str,
+                          illust: Dict[str, Any],
+                          layout: str = 'author_name') -> List[FetchImageJob]:
+    image_jobs: List[FetchImageJob] = []
+    if illust.get('_deleted', False) or illust.get('unavailable', False):
+        return image_jobs
+    for i, image in enumerate(illust.get('images', [])):
+        if image.get('fetched', False):
+            continue
+        image_jobs.append(FetchImageJob(
+            file_path=get_image_path(download_dir, illust_id, illust, i, layout),
+            image_url=image['url'],
+            illust_id=illust_id,
+            image_id=i,
+            author_id=illust.get('author_id', ''),
+        ))
+    return image_jobs
+
+
+# the keys of the illusts to fetch first, see :func:`get_fetch_priority`
+FETCH_PRIORITIES = {
+    'newest': lambda illust_id, illust: -int(illust_id),
+    'oldest': lambda illust_id, illust: int(illust_id),
+    'bookmarks': lambda illust_id, illust: not illust.get('bookmarked', False),
+    'small': lambda illust_id, illust: (
+        (illust.get('width') or 0) * (illust.get('height') or 0),
+        len(illust.get('images', []))),
+}
+
+
+def get_fetch_priority(illust_id: str, illust: Dict[str, Any],
+                       priority: List[str]) -> tuple:
+    """
+    Get the sort key of an illust by the `priority` names, in the order of
+    significance, e.g., `['bookmarks', 'newest']` fetches the bookmarks
+    first, and the newest illusts first among them.
+    """
+    return tuple(FETCH_PRIORITIES[p](illust_id, illust) for p in priority)
+
+
+def iter_fetch_jobs(sync_db: SyncDB, download_dir: str,
+                    layout: str = 'author_name',
+                    priority: Optional[List[str]] = None) -> Iterator[FetchImageJob]:
+    """
+    Generate the jobs of the pending images, in the order of the illusts
+    in `sync_db`, or sorted by `priority` (see :func:`get_fetch_priority`).
+    """
+    if not priority:
+        for illust_id, illust in sync_db.iter_illust_items():
+            yield from get_illust_fetch_jobs(download_dir, illust_id, illust,
+                                             layout)
+        return
+
+    # only the keys of the pending illusts are sorted, and the jobs are
+    # made while being consumed; since the keys are derived from the
+    # stored illusts, an interrupted run is resumed in the same order
+    keys = []
+    for illust_id, illust in sync_db.iter_illust_items():
+        if illust.get('_deleted', False) or illust.get('unavailable', False):
+            continue
+        if all(image.get('fetched', False)
+               for image in illust.get('images', [])):
+            continue
+        keys.append((get_fetch_priority(illust_id, illust, priority),
+                     illust_id))
+    keys.sort()
+    for _, illust_id in keys:
+        illust = sync_db.get_illust(illust_id)
+        if illust is not None:
+            yield from get_illust_fetch_jobs(download_dir, illust_id, illust,
+                                             layout)
+
+
+def _put_fetch_jobs(job_queue: 'FetchQueue', jobs: Iterable[FetchImageJob]):
+    try:
+        for job in jobs:
+            job_queue.put(job)
+    finally:
+        job_queue.close()
+
+
+class FetchQueue(object):
+    """
+    Queue of the fetch jobs, between the producers and the download workers.
+
+    If `maxsize` is positive, :meth:`put` blocks while the queue is full.
+    :meth:`get` blocks until a job is available, and returns None after
+    the queue has been closed and drained.
+
+    If `max_per_illust` or `max_per_author` is positive, :meth:`get` skips
+    the jobs of the illusts or the authors with this many jobs in flight,
+    until they are released by :meth:`task_done`.  While the workers are
+    starved by the skipped jobs, :meth:`put` does not block on a full queue.
+
+    :meth:`cancel` drops the jobs left, e.g., when the sync is interrupted,
+    such that the workers stop after their downloads in flight.
+    """
+
+    def __init__(self, maxsize: int = 0, max_per_illust: int = 0,
+                 max_per_author: int = 0):
+        self.maxsize = maxsize
+        self.max_per_illust = max_per_illust
+        self.max_per_author = max_per_author
+        self._jobs: Deque[FetchImageJob] = collections.deque()
+        self._closed = False
+        self._cancelled = False
+        self._cond = threading.Condition()
+        self._illusts_in_flight: Dict[str, int] = collections.Counter()
+        self._authors_in_flight: Dict[str, int] = collections.Counter()
+        self._starved = 0  # number of `get` waiting on skipped jobs
+
+    def __len__(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def __iter__(self):
+        while True:
+            job = self.get()
+            if job is None:
+                break
+            yield job
+
+    def put(self, job: FetchImageJob):
+        with self._cond:
+            while self.maxsize > 0 and len(self._jobs) >= self.maxsize and \
+                    not self._closed and not self._starved:
+                self._cond.wait()
+            if self._cancelled:
+                return
+            if self._closed:
+                raise RuntimeError('The fetch queue has been closed.')
+            self._jobs.append(job)
+            self._cond.notify_all()
+
+    def get(self, block: bool = True) -> Optional[FetchImageJob]:
+        """
+        Get the next job.
+
+        Raises:
+            queue.Empty: If `block` is False and no job is available yet.
+        """
+        with self._cond:
+            while True:
+                if not self.max_per_illust and not self.max_per_author:
+                    if self._jobs:
+                        job = self._jobs.popleft()
+                        self._cond.notify_all()
+                        return job
+                else:
+                    job = self._pop_allowed()
+                    if job is not None:
+                        self._cond.notify_all()
+                        return job
+                if self._closed and not self._jobs:
+                    return None
+                if not block:
+                    raise queue.Empty()
+                starved = bool(self._jobs)
+                if starved:
+                    self._starved += 1
+                    self._cond.notify_all()
+                try:
+                    self._cond.wait()
+                finally:
+                    if starved:
+                        self._starved -= 1
+
+    def _pop_allowed(self) -> Optional[FetchImageJob]:
+        # the first job under the limits, the others keep their order
+        for i, job in enumerate(self._jobs):
+            if self.max_per_illust and \
+                    self._illusts_in_flight[job.illust_id] >= self.max_per_illust:
+                continue
+            if self.max_per_author and \
+                    self._authors_in_flight[job.author_id] >= self.max_per_author:
+                continue
+            del self._jobs[i]
+            self._illusts_in_flight[job.illust_id] += 1
+            self._authors_in_flight[job.author_id] += 1
+            return job
+        return None
+
+    def task_done(self, job: FetchImageJob):
+        """Release a job got from the queue, after it is done or failed."""
+        if not self.max_per_illust and not self.max_per_author:
+            return
+        with self._cond:
+            for in_flight, key in ((self._illusts_in_flight, job.illust_id),
+                                   (self._authors_in_flight, job.author_id)):
+                in_flight[key] -= 1
+                if in_flight[key] <= 0:
+                    del in_flight[key]
+            self._cond.notify_all()
+
+    def close(self):
+        """No more jobs will be put into the queue."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def cancel(self):
+        """Close the queue and drop the jobs left, and those put later."""
+        with self._cond:
+            self._closed = True
+            self._cancelled = True
+            self._jobs.clear()
+            self._cond.notify_all()
+
+    @property
+    def cancelled(self) -> bool:
+        with self._cond:
+            return self._cancelled
+
+    @property
+    def drained(self) -> bool:
+        """Whether the queue has been closed, and all the jobs taken."""
+        with self._cond:
+            return self._closed and not self._jobs
+
+
+class DownloadError(Exception):
+    """Raised when an image cannot be downloaded."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _is_retryable_status(status: int) -> bool:
+    return status in (408, 429) or status >= 500
+
+
+def _get_part_path(file_path: str) -> str:
+    return f'{file_path}.part'
+
+
+def _begin_part_file(part_path: str) -> Tuple[int, Dict[str, str]]:
+    """Get the offset to resume the download, and the request headers."""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+    return offset, headers
+
+
+def _hash_file(path: str, hasher=None, chunk_size: int = 1048576):
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher
+
+
+def _open_part_file(part_path: str, offset: int, status: int,
+                    headers: Mapping[str, str]
+                    ) -> Tuple[IO[bytes], Optional[int], Any]:
+    """
+    Open the part file according to the response, and get the expected
+    total size of the image (if known), and the SHA-256 hasher of the
+    content already in the part file.
+    """
+    if status == 206 and offset > 0:
+        m = re.match(r'^bytes (\d+)-\d+/(\d+|\*)$',
+                     headers.get('Content-Range', ''))
+        if not m or int(m.group(1)) != offset:
+            raise DownloadError(f'Unexpected Content-Range: '
+                                f'{headers.get("Content-Range")!r}')
+        total = int(m.group(2)) if m.group(2) != '*' else None
+        return open(part_path, 'ab'), total, _hash_file(part_path)
+    elif status == 200:
+        # the server ignored the Range header, start over
+        length = headers.get('Content-Length')
+        total = int(length) if length else None
+        return open(part_path, 'wb'), total, hashlib.sha256()
+    elif status == 416 and offset > 0:
+        # the part file is not a prefix of the image, start over
+        os.remove(part_path)
+        raise DownloadError(f'Range not satisfiable, offset={offset}')
+    else:
+        raise DownloadError(f'HTTP error {status}',
+                            retryable=_is_retryable_status(status))
+
+
+def _commit_part_file(part_path: str, file_path: str, total: Optional[int],
+                      hasher) -> FetchImageResult:
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        raise DownloadError(f'Incomplete download: {size} of {total} bytes')
+    os.replace(part_path, file_path)
+    return FetchImageResult(size=size, digest=hasher.hexdigest())
+
+
+def _download_with_requests(api: 'AppPixivAPI',
+                            job: FetchImageJob,
+                            headers: Dict[str, str],
+                            bandwidth: Optional[RateLimiter] = None,
+                            chunk_size: int = 65536) -> FetchImageResult:
+    part_path = _get_part_path(job.file_path)
+    offset, range_headers = _begin_part_file(part_path)
+    with api.requests_call('GET', job.image_url, stream=True,
+                           headers={**headers, **range_headers}) as response:
+        f, total, hasher = _open_part_file(
+            part_path, offset, response.status_code, response.headers)
+        with f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                hasher.update(chunk)
+                METRICS.inc('download_bytes_total', len(chunk))
+                if bandwidth is not None:
+                    delay = bandwidth.reserve(len(chunk))
+                    if delay > 0:
+                        time.sleep(delay)
+    return _commit_part_file(part_path, job.file_path, total, hasher)
+
+
+def _get_retry_delay(retry_backoff: float, attempt: int) -> float:
+    return retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def _call_on_done(on_done: Callable[[FetchImageJob, FetchImageResult], None],
+                  job: FetchImageJob, result: FetchImageResult):
+    # not retried if the bookkeeping fails, since the download is done, and
+    # the job has been released by `on_done`
+    try:
+        on_done(job, result)
+    except Exception:
+        print(''.join(traceback.format_exception(*sys.exc_info())) +
+              f'Failed to store: {job.image_url}')
+
+
+def _start_thread(target: Callable, *args, daemon: bool = False
+                  ) -> threading.Event:
+    """
+    Start a thread running `target`, and return an event set when it exits.
+
+    The event is waited for instead of joining the thread, since a join
+    interrupted by Ctrl+C or SIGTERM may return before the thread exits if
+    joined again.
+    """
+    exited = threading.Event()
+
+    def run():
+        try:
+            target(*args)
+        finally:
+            exited.set()
+
+    threading.Thread(target=run, daemon=daemon).start()
+    return exited
+
+
+class ConcurrencyTuner(object):
+    """
+    AIMD tuner of the number of in-flight downloads, between `min_limit`
+    and `max_limit` (the number of download workers).
+
+    The latency, the throughput and the error rate of the downloads are
+    measured over windows of :attr:`WINDOW_SECONDS`.  The limit is doubled
+    after each window until the first congestion (slow start), then
+    increased by one, and halved on congestion, i.e., too many retryable
+    errors, or the latency inflated without any gain of throughput.  The
+    limit is not increased while the throughput is capped by `bandwidth`.
+    Each worker has a `slot`, and only takes jobs while `slot < limit`.
+    """
+
+    WINDOW_SECONDS = 2.
+    MIN_SAMPLES = 4
+    MAX_ERROR_RATE = .05
+    LATENCY_FACTOR = 2.
+
+    def __init__(self, max_limit: int, min_limit: int = 1,
+                 bandwidth: Optional[float] = None):
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.limit = self.min_limit
+        self.bandwidth = bandwidth
+        self._slow_start = True
+        self._min_latency: Optional[float] = None
+        self._last_throughput = 0.
+        self._cond = threading.Condition()
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, now: float):
+        self._window_start = now
+        self._n_samples = self._n_errors = 0
+        self._bytes = 0
+        self._seconds = 0.
+
+    def allows(self, slot: int) -> bool:
+        return slot < self.limit
+
+    def wait(self, timeout: float):
+        """Wait for the limit to change, or `timeout`."""
+        with self._cond:
+            self._cond.wait(timeout)
+
+    def record(self, seconds: float, size: int, ok: bool = True):
+        """Record a download attempt of `seconds`, which got `size` bytes."""
+        with self._cond:
+            self._n_samples += 1
+            self._n_errors += not ok
+            self._bytes += size
+            self._seconds += seconds
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed < self.WINDOW_SECONDS or \
+                    self._n_samples < min(self.MIN_SAMPLES, self.limit):
+                return
+
+            throughput = self._bytes / elapsed
+            latency = self._seconds / self._n_samples
+            congested = (
+                self._n_errors / self._n_samples > self.MAX_ERROR_RATE or
+                (self._min_latency is not None and
+                 latency > self.LATENCY_FACTOR * self._min_latency and
+                 throughput <= self._last_throughput)
+            )
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            self._last_throughput = throughput
+            self._reset_window(now)
+
+            old_limit = self.limit
+            if congested:
+                self._slow_start = False
+                self.limit = max(self.min_limit, self.limit // 2)
+            elif self.bandwidth and throughput >= .9 * self.bandwidth:
+                pass  # more downloads would only share the same bandwidth
+            elif self._slow_start:
+                self.limit = min(self.max_limit, self.limit * 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1)
+            if self.limit != old_limit:
+                METRICS.inc('download_concurrency_changes_total')
+                print(f'> Download concurrency: {old_limit} -> {self.limit} '
+                      f'({throughput / 1048576:.2f} MiB/s, '
+                      f'{latency:.2f}s per image)')
+                self._cond.notify_all()
+
+
+def _fetch_with_threads(api: 'AppPixivAPI',
+                        job_queue: FetchQueue,
+                        n_workers: int,
+                        headers: Dict[str, str],
+                        retries: int,
+                        retry_backoff: float,
+                        on_done: Callable[[FetchImageJob, FetchImageResult], None],
+                        on_failed: Callable[[FetchImageJob], None],
+                        tuner: Optional[ConcurrencyTuner] = None,
+                        bandwidth: Optional[RateLimiter] = None):
+    def f_download(job: FetchImageJob):
+        parent_dir = os.path.split(job.file_path)[0]
+        attempt = 0
+        while True:
+            start_time = time.monotonic()
+            try:
+                os.makedirs(parent_dir, exist_ok=True)
+                with METRICS.timer('download_seconds'):
+                    result = _download_with_requests(api, job, headers, bandwidth)
+                if tuner is not None:
+                    tuner.record(time.monotonic() - start_time, result.size)
+                break
+            except Exception as ex:
+                retryable = getattr(ex, 'retryable', True)
+                if tuner is not None:
+                    tuner.record(time.monotonic() - start_time, 0,
+                                 ok=not retryable)
+                if attempt >= retries or not retryable or \
+                        job_queue.cancelled:
+                    on_failed(job)
+                    return
+                METRICS.inc('download_retries_total')
+                time.sleep(_get_retry_delay(retry_backoff, attempt))
+                attempt += 1
+        _call_on_done(on_done, job, result)
+
+    def worker(slot: int):
+        while True:
+            # the workers above the limit of the tuner are parked
+            if tuner is not None and not tuner.allows(slot):
+                if job_queue.drained:
+                    break
+                tuner.wait(1.)
+                continue
+            job = job_queue.get()
+            if job is None:
+                break
+            f_download(job)
+
+    workers = [_start_thread(worker, i, daemon=True) for i in range(n_workers)]
+    try:
+        for exited in workers:
+            exited.wait()
+    except BaseException:
+        # e.g., interrupted by Ctrl+C or SIGTERM: the downloads in flight
+        # are finished and stored before the DB is closed
+        job_queue.cancel()
+        for exited in workers:
+            exited.wait()
+        raise
+
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise RuntimeError('`download.engine: asyncio` requires aiohttp, '
+                           'please install it by `pip install aiohttp`.')
+    return aiohttp
+
+
+def _fetch_with_asyncio(job_queue: FetchQueue,
+                        n_workers: int,
+                        n_connections: int,
+                        headers: Dict[str, str],
+                        retries: int,
+                        retry_backoff: float,
+                        on_done: Callable[[FetchImageJob, FetchImageResult], None],
+                        on_failed: Callable[[FetchImageJob], None],
+                        tuner: Optional[ConcurrencyTuner] = None,
+                        bandwidth: Optional[RateLimiter] = None,
+                        chunk_size: int = 65536):
+    import asyncio
+    aiohttp = _import_aiohttp()
+    # hashing a resumed part file, and the DB bookkeeping of `on_done`
+    # (which may write the journal, or compact it into the DB), are kept
+    # off the event loop
+    bookkeeping_pool = ThreadPoolExecutor(
+        max_workers=4, thread_name_prefix='fetch-bookkeeping')
+
+    async def run_blocking(fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            bookkeeping_pool, fn, *args)
+
+    async def download(session: aiohttp.ClientSession, job: FetchImageJob):
+        part_path = _get_part_path(job.file_path)
+        offset, range_headers = _begin_part_file(part_path)
+        async with session.get(job.image_url, headers=range_headers) as response:
+            if offset > 0:
+                # hashes the part file to resume
+                f, total, hasher = await run_blocking(
+                    _open_part_file, part_path, offset, response.status,
+                    response.headers)
+            else:
+                f, total, hasher = _open_part_file(
+                    part_path, offset, response.status, response.headers)
+            with f:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    METRICS.inc('download_bytes_total', len(chunk))
+                    if bandwidth is not None:
+                        delay = bandwidth.reserve(len(chunk))
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+        return _commit_part_file(part_path, job.file_path, total, hasher)
+
+    async def f_download(session: aiohttp.ClientSession, job: FetchImageJob):
+        parent_dir = os.path.split(job.file_path)[0]
+        attempt = 0
+        while True:
+            start_time = time.monotonic()
+            try:
+                os.makedirs(parent_dir, exist_ok=True)
+                with METRICS.timer('download_seconds'):
+                    result = await download(session, job)
+                if tuner is not None:
+                    tuner.record(time.monotonic() - start_time, result.size)
+                break
+            except Exception as ex:
+                retryable = getattr(ex, 'retryable', True)
+                if tuner is not None:
+                    tuner.record(time.monotonic() - start_time, 0,
+                                 ok=not retryable)
+                if attempt >= retries or not retryable or \
+                        job_queue.cancelled:
+                    # on the loop, which has the traceback of the failure
+                    on_failed(job)
+                    return
+                METRICS.inc('download_retries_total')
+                await asyncio.sleep(_get_retry_delay(retry_backoff, attempt))
+                attempt += 1
+        await run_blocking(_call_on_done, on_done, job, result)
+
+    async def main():
+        # the keep-alive connections are pooled by the connector, and
+        # shared among all the in-flight downloads
+        connector = aiohttp.TCPConnector(limit=n_connections)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30,
+                                        sock_read=60)
+        async with aiohttp.ClientSession(
+                connector=connector, headers=headers,
+                timeout=timeout) as session:
+            # each worker pulls the jobs from the shared queue, such that
+            # the number of coroutines does not grow with the number of
+            # jobs; while the shared queue is empty, the jobs are fed into
+            # an asyncio queue by a thread blocking on the shared queue,
+            # one job at a time
+            loop = asyncio.get_running_loop()
+            jobs = asyncio.Queue()
+            feeding = threading.Semaphore(1)
+            fed = threading.Event()
+
+            def put_job(job: Optional[FetchImageJob]):
+                # fails if the loop has been closed, e.g., interrupted
+                with contextlib.suppress(RuntimeError):
+                    loop.call_soon_threadsafe(jobs.put_nowait, job)
+
+            def feed():
+                try:
+                    for job in job_queue:
+                        while not feeding.acquire(timeout=1.) and \
+                                not job_queue.cancelled:
+                            pass
+                        if job_queue.cancelled:
+                            break
+                        put_job(job)
+                finally:
+                    fed.set()
+                    put_job(None)
+
+            async def worker(slot: int):
+                while True:
+                    if tuner is not None and not tuner.allows(slot):
+                        # the jobs left are taken by the workers allowed
+                        if fed.is_set():
+                            break
+                        await asyncio.sleep(.5)
+                        continue
+                    try:
+                        job = job_queue.get(block=False)
+                    except queue.Empty:
+                        job = None
+                    if job is None:
+                        # the last jobs may still be held by the feeder
+                        job = await jobs.get()
+                        if job is not None:
+                            feeding.release()
+                    if job is None:
+                        # passed on to the other workers
+                        jobs.put_nowait(None)
+                        break
+                    await f_download(session, job)
+
+            # not joined, since it may be blocked by a failed loop
+            threading.Thread(target=feed, daemon=True).start()
+            await asyncio.gather(*(worker(i) for i in range(n_workers)))
+
+    try:
+        asyncio.run(main())
+    finally:
+        # if interrupted, the bookkeeping in flight is finished before the
+        # DB is closed
+        bookkeeping_pool.shutdown()
+
+
+FETCH_ENGINES = ('thread', 'asyncio')
+
+
+def make_thumbnail(file_path: str, rel_path: str, thumbnail_dir: str,
+                   size: int = 512, quality: int = 85):
+    """
+    Post-processing hook saving a JPEG thumbnail of an image at the same
+    relative path under `thumbnail_dir`.  Requires Pillow.
+    """
+    from PIL import Image  # optional dependency, only needed by this hook
+
+    thumb_path = os.path.join(
+        thumbnail_dir, os.path.splitext(rel_path)[0] + '.jpg')
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    with Image.open(file_path) as im:
+        im.thumbnail((size, size))
+        if im.mode not in ('RGB', 'L'):
+            im = im.convert('RGB')
+        im.save(thumb_path + '.part', format='JPEG', quality=quality)
+    os.replace(thumb_path + '.part', thumb_path)
+
+
+def _run_postprocess_hooks(hooks: List[Dict[str, Any]], file_path: str,
+                           rel_path: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    Run the post-processing `hooks` on an image, in a worker process.
+    Returns the name of each hook along with its error message, or None
+    if succeeded.
+    """
+    ret = []
+    for hook in hooks:
+        try:
+            if hook.get('function'):
+                module_name, _, func_name = hook['function'].partition(':')
+                func = getattr(importlib.import_module(module_name), func_name)
+                func(file_path, rel_path, **(hook.get('options') or {}))
+            else:
+                dir_name, name = os.path.split(file_path)
+                stem, ext = os.path.splitext(name)
+                fields = dict(file=file_path, rel_path=rel_path, dir=dir_name,
+                              name=name, stem=stem, ext=ext)
+                args = [str(a).format(**fields) for a in hook['command']]
+                proc = subprocess.run(args, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.PIPE)
+                if proc.returncode != 0:
+                    raise RuntimeError(
+                        f'exit code {proc.returncode}: '
+                        f'{proc.stderr.decode("utf-8", "replace").strip()}')
+        except Exception as ex:
+            ret.append((hook['name'], f'{ex.__class__.__name__}: {ex}'))
+        else:
+            ret.append((hook['name'], None))
+    return ret
+
+
+class PostProcessor(object):
+    """
+    Post-processing of the downloaded images, e.g., thumbnailing or
+    transcoding, by the `hooks` run on a pool of `n_workers` processes.
+
+    Each hook is a dict with a `name`, and either a `function` given as
+    "module:function" (called with the file path, the path relative to the
+    download directory, and the `options` of the hook), or a `command` as
+    a list of arguments, formatted with `{file}`, `{rel_path}`, `{dir}`,
+    `{name}`, `{stem}` and `{ext}`.
+
+    The names of the hooks done on an image are stored in its `processed`
+    field, such that later runs only run the remaining hooks.  At most
+    `queue_size` images are in the pool; the images submitted by the
+    download workers while the pool is full are left for
+    :meth:`process_pending`, instead of blocking the downloads.
+    """
+
+    def __init__(self, hooks: Optional[List[Dict[str, Any]]] = None,
+                 n_workers: Optional[int] = None,
+                 queue_size: int = 64):
+        self.hooks = list(hooks or [])
+        for hook in self.hooks:
+            if not hook.get('name') or \
+                    bool(hook.get('function')) == bool(hook.get('command')):
+                raise ValueError(f'Invalid post-processing hook: {hook!r}; '
+                                 f'a name and either a function or a command '
+                                 f'is required.')
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._queued: Set[Tuple[str, int]] = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'PostProcessor':
+        return cls(
+            hooks=config.get('postprocess.hooks'),
+            n_workers=config.get('postprocess.workers'),
+            queue_size=config.get('postprocess.queue_size', 64),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def pending_hooks(self, image: Dict[str, Any]) -> List[Dict[str, Any]]:
+        processed = image.get('processed') or ()
+        return [h for h in self.hooks if h['name'] not in processed]
+
+    def submit(self, sync_db: SyncDB, download_dir: str, illust_id: str,
+               image_id: int, block: bool = False) -> bool:
+        """
+        Submit the pending hooks of a fetched image.  Returns whether it is
+        submitted, i.e., False if the image has nothing to do, or if the
+        pool is full and not `block`.
+        """
+        illust = sync_db.get_illust(illust_id)
+        image = illust['images'][image_id]
+        hooks = self.pending_hooks(image)
+        if not hooks or not image.get('fetched', False):
+            return False
+        file_path = get_image_path(download_dir, illust_id, illust, image_id)
+        if not os.path.isfile(file_path):
+            return False
+        rel_path = os.path.relpath(file_path, download_dir)
+        key = (illust_id, image_id)
+        with self._lock:
+            if key in self._queued:
+                return False
+        if not self._slots.acquire(blocking=block):
+            METRICS.inc('postprocess_deferred_total')
+            return False
+
+        with self._lock:
+            self._queued.add(key)
+            if self._pool is None:
+                # not forked, since the download workers are running threads
+                self._pool = ProcessPoolExecutor(
+                    self.n_workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            future = self._pool.submit(
+                _run_postprocess_hooks, hooks, file_path, rel_path)
+        except Exception:
+            self._release(key)
+            raise
+        future.add_done_callback(
+            lambda f: self._on_done(sync_db, key, file_path, f))
+        return True
+
+    def _release(self, key: Tuple[str, int]):
+        with self._lock:
+            self._queued.discard(key)
+            self._slots.release()
+            self._idle.notify_all()
+
+    def _on_done(self, sync_db: SyncDB, key: Tuple[str, int], file_path: str,
+                 future):
+        try:
+            results = future.result()
+        except Exception:
+            METRICS.inc('postprocess_failed_total')
+            print(''.join(traceback.format_exception(*sys.exc_info())) +
+                  f'Failed to post-process: {file_path}')
+        else:
+            done = [name for name, error in results if error is None]
+            for name, error in results:
+                if error is not None:
+                    METRICS.inc('postprocess_failed_total')
+                    print(f'! Post-processing hook {name} failed on '
+                          f'{file_path}: {error}')
+            if done:
+                METRICS.inc('postprocess_done_total', len(done))
+                with sync_db.lock:
+                    image = sync_db.get_illust(key[0])['images'][key[1]]
+                    # not if unfetched meanwhile, e.g., by `verify`
+                    if image.get('fetched', False):
+                        processed = list(image.get('processed') or ())
+                        processed.extend(n for n in done if n not in processed)
+                        sync_db.update_image(key[0], key[1],
+                                             {'processed': processed})
+        finally:
+            self._release(key)
+
+    def process_pending(self, sync_db: SyncDB, download_dir: str):
+        """Post-process the fetched images with pending hooks, and wait."""
+        if not self.hooks:
+            return
+        print('> Post-processing images ...')
+        count = 0
+        with METRICS.phase('postprocess'):
+            for illust_id, illust in sync_db.iter_illust_items():
+                if illust.get('_deleted', False):
+                    continue
+                for i in range(len(illust.get('images', []))):
+                    if self.submit(sync_db, download_dir, illust_id, i,
+                                   block=True):
+                        count += 1
+            self.wait()
+        print(f'> Post-processed {count} images.')
+
+    def wait(self):
+        with self._lock:
+            while self._queued:
+                self._idle.wait()
+
+    def close(self):
+        self.wait()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def fetch_images(sync_db: SyncDB, download_dir: str, n_workers: int,
+                 engine: str = 'thread',
+                 n_connections: Optional[int] = None,
+                 http_headers: Optional[Dict[str, str]] = None,
+                 retries: int = 3,
+                 retry_backoff: float = 1.0,
+                 job_queue: Optional[FetchQueue] = None,
+                 api: Optional['AppPixivAPI'] = None,
+                 dedup: str = 'off',
+                 queue_size: int = 1000,
+                 layout: str = 'author_name',
+                 postprocessor: Optional[PostProcessor] = None,
+                 autotune: bool = False,
+                 min_workers: int = 1,
+                 bandwidth: Optional[float] = None,
+                 priority: Optional[List[str]] = None,
+                 max_per_illust: int = 0,
+                 max_per_author: int = 0):
+    """
+    Fetch the images not yet fetched.
+
+    If `job_queue` is specified, fetch the jobs from this queue until it
+    is closed, instead of the pending images in `sync_db`, which are
+    streamed in the order of `priority` (see :func:`iter_fetch_jobs`)
+    through a queue of `queue_size` jobs, with at most `max_per_illust`
+    and `max_per_author` downloads in flight (see :class:`FetchQueue`),
+    and stored in the download `layout`.  If `api` is not specified, a
+    client is made from `sync_db`.  See :func:`store_fetched_image` for
+    `dedup`.
+
+    If `postprocessor` is specified, the fetched images are post-processed
+    while the downloads go on, and the images left behind are processed
+    after all the downloads.
+
+    If `autotune`, the number of in-flight downloads is tuned between
+    `min_workers` and `n_workers` by :class:`ConcurrencyTuner`.  If
+    `bandwidth` is specified, the downloads are throttled to this many
+    bytes per second in total.
+    """
+    if engine not in FETCH_ENGINES:
+        raise ValueError(f'Unknown download engine: {engine}')
+    if dedup not in DEDUP_MODES:
+        raise ValueError(f'Unknown dedup mode: {dedup}')
+    if api is None:
+        api = make_api_client(sync_db)
+
+    # the pending images are generated while being fetched, such that
+    # the jobs in memory are bounded by the queue size
+    producer = None
+    if job_queue is None:
+        job_queue = FetchQueue(maxsize=queue_size,
+                               max_per_illust=max_per_illust,
+                               max_per_author=max_per_author)
+        producer = _start_thread(
+            _put_fetch_jobs, job_queue,
+            iter_fetch_jobs(sync_db, download_dir, layout, priority=priority),
+            daemon=True,
+        )
+    print('> Fetching images ...')
+
+    f_lock = threading.RLock()
+    counter = [0]
+
+    def on_done(job: FetchImageJob, result: FetchImageResult):
+        METRICS.inc('downloads_done_total')
+        try:
+            with f_lock:
+                counter[0] += 1
+                store_fetched_image(sync_db, download_dir, job, result,
+                                    dedup=dedup)
+                print(f'[{counter[0]}] done: {job.image_url}')
+        finally:
+            job_queue.task_done(job)
+        if postprocessor is not None:
+            postprocessor.submit(
+                sync_db, download_dir, job.illust_id, job.image_id)
+
+    def on_failed(job: FetchImageJob):
+        # the partial download is kept, and will be resumed by the next run
+        METRICS.inc('downloads_failed_total')
+        print(''.join(traceback.format_exception(*sys.exc_info())) +
+              f'Failed to download: {job.image_url}')
+        job_queue.task_done(job)
+
+    try:
+        _run_fetch_engine(
+            api, job_queue, on_done, on_failed,
+            n_workers=n_workers, engine=engine, n_connections=n_connections,
+            http_headers=http_headers, retries=retries,
+            retry_backoff=retry_backoff, autotune=autotune,
+            min_workers=min_workers, bandwidth=bandwidth,
+        )
+    except BaseException:
+        # e.g., interrupted: the producer reading the DB stops at its next
+        # job, before the DB is closed
+        job_queue.cancel()
+        raise
+    finally:
+        if producer is not None:
+            producer.wait()
+    if postprocessor is not None:
+        postprocessor.process_pending(sync_db, download_dir)
+
+
+def _run_fetch_engine(api: 'AppPixivAPI',
+                      job_queue: Union[FetchQueue, 'SharedFetchScheduler'],
+                      on_done: Callable[[FetchImageJob, FetchImageResult], None],
+                      on_failed: Callable[[FetchImageJob], None],
+                      n_workers: int,
+                      engine: str = 'thread',
+                      n_connections: Optional[int] = None,
+                      http_headers: Optional[Dict[str, str]] = None,
+                      retries: int = 3,
+                      retry_backoff: float = 1.0,
+                      autotune: bool = False,
+                      min_workers: int = 1,
+                      bandwidth: Optional[float] = None):
+    """Download the jobs of `job_queue` by the download `engine`."""
+    if engine not in FETCH_ENGINES:
+        raise ValueError(f'Unknown download engine: {engine}')
+    headers = dict(DOWNLOAD_HEADERS)
+    headers.update(http_headers or {})
+    bandwidth_limiter = None
+    if bandwidth:
+        # up to one second of burst
+        bandwidth_limiter = RateLimiter(bandwidth, burst=bandwidth)
+    tuner = None
+    if autotune:
+        tuner = ConcurrencyTuner(n_workers, min_limit=min_workers,
+                                 bandwidth=bandwidth)
+
+    with METRICS.phase('fetch_images'):
+        if engine == 'asyncio':
+            _fetch_with_asyncio(
+                job_queue,
+                n_workers=n_workers,
+                n_connections=n_connections or n_workers,
+                headers=headers,
+                retries=retries,
+                retry_backoff=retry_backoff,
+                on_done=on_done,
+                on_failed=on_failed,
+                tuner=tuner,
+                bandwidth=bandwidth_limiter,
+            )
+        else:
+            _fetch_with_threads(
+                api,
+                job_queue,
+                n_workers=n_workers,
+                headers=headers,
+                retries=retries,
+                retry_backoff=retry_backoff,
+                on_done=on_done,
+                on_failed=on_failed,
+                tuner=tuner,
+                bandwidth=bandwidth_limiter,
+            )
+
+
+def sync_pipelined(sync_db: SyncDB, config: Dict[str, Any],
+                   download_dir: str, fetch_kwargs: Dict[str, Any],
+                   max_bookmark_id: Optional[str] = None,
+                   full: bool = False,
+                   api: Optional['AppPixivAPI'] = None):
+    """
+    Pull the new illustrations and fetch the images at the same time.
+
+    The images of newly discovered illustrations are put into a bounded
+    queue consumed by the download workers, while the listing goes on.
+    If the download workers fail, the listing is stopped, and their error
+    is raised.
+    """
+    # fail before listing, instead of leaving the queue without consumers
+    check_fetch_kwargs(fetch_kwargs)
+    job_queue = FetchQueue(maxsize=fetch_kwargs['queue_size'],
+                           max_per_illust=fetch_kwargs['max_per_illust'],
+                           max_per_author=fetch_kwargs['max_per_author'])
+    queued = set()
+
+    def on_new_illust(illust_id, illust):
+        for job in get_illust_fetch_jobs(download_dir, illust_id, illust,
+                                         fetch_kwargs['layout']):
+            queued.add((job.illust_id, job.image_id))
+            job_queue.put(job)
+
+    fetch_errors = []
+
+    def fetch():
+        try:
+            fetch_images(sync_db, download_dir, job_queue=job_queue, api=api,
+                         **fetch_kwargs)
+        except BaseException as ex:
+            fetch_errors.append(ex)
+            # makes the blocked `put` of the listing raise
+            job_queue.close()
+
+    fetcher = _start_thread(fetch)
+    try:
+        with METRICS.phase('update_list'):
+            update_list(sync_db, config, max_bookmark_id=max_bookmark_id,
+                        full=full, on_new_illust=on_new_illust, api=api)
+
+        # then the images pending from previous runs, or re-included by
+        # changed rules
+        for job in iter_fetch_jobs(sync_db, download_dir, fetch_kwargs['layout'],
+                                   priority=fetch_kwargs['priority']):
+            if (job.illust_id, job.image_id) not in queued:
+                job_queue.put(job)
+    except BaseException:
+        # e.g., interrupted: only the downloads in flight are waited for
+        job_queue.cancel()
+        raise
+    finally:
+        job_queue.close()
+        try:
+            fetcher.wait()
+        except BaseException:
+            # interrupted while waiting for the downloads left
+            job_queue.cancel()
+            fetcher.wait()
+            raise
+        if fetch_errors:
+            raise fetch_errors[0]
+
+
+@dataclass
+class SyncProfile(object):
+    """A config synchronized along with others by one `sync` process."""
+
+    name: str
+    config: Dict[str, Any]
+    sync_db: SyncDB
+    download_dir: str
+    fetch_kwargs: Dict[str, Any]
+
+
+class _FetchQueueLane(object):
+    """The queue of a profile in :class:`SharedFetchScheduler`."""
+
+    def __init__(self, scheduler: 'SharedFetchScheduler', index: int):
+        self.scheduler = scheduler
+        self.index = index
+
+    def put(self, job: FetchImageJob):
+        self.scheduler.put(self.index, job)
+
+    def close(self):
+        self.scheduler.close(self.index)
+
+
+class SharedFetchScheduler(object):
+    """
+    Download scheduler shared by the `profiles` synchronized by one process.
+
+    Each profile has its own queue of at most `maxsize` fetch jobs, and the
+    download workers take the jobs from the queues in turn, such that no
+    profile is starved by the backfill of another.  An image with the same
+    url in several profiles is downloaded once: if already fetched by
+    another profile, it is linked (or copied) from its file; if being
+    downloaded for another profile, it waits for this download.
+
+    The scheduler is consumed by the download engines like a
+    :class:`FetchQueue`, with :meth:`on_done` and :meth:`on_failed` as the
+    callbacks, which store the images into the DB of their profiles.  The
+    `max_per_illust` and `max_per_author` limits are applied as by
+    :class:`FetchQueue`, the authors being shared by the profiles.
+    """
+
+    def __init__(self, profiles: List[SyncProfile], maxsize: int = 0,
+                 max_per_illust: int = 0, max_per_author: int = 0):
+        self.profiles = profiles
+        self.maxsize = maxsize
+        self.max_per_illust = max_per_illust
+        self.max_per_author = max_per_author
+        self._jobs = [collections.deque() for _ in profiles]
+        self._closed = [False] * len(profiles)
+        self._cancelled = False
+        self._next = 0
+        self._cond = threading.Condition()
+        self._owners: Dict[int, int] = {}  # id of a job => profile index
+        self._in_flight: Dict[str, int] = {}  # url => profile index
+        self._waiting: Dict[str, List[Tuple[int, FetchImageJob]]] = {}
+        self._counters = [0] * len(profiles)
+        self._lock = threading.RLock()
+        self._illusts_in_flight: Dict[Tuple[int, str], int] = \
+            collections.Counter()
+        self._authors_in_flight: Dict[str, int] = collections.Counter()
+        self._starved = 0  # number of `get` waiting on skipped jobs
+
+    def lane(self, index: int) -> _FetchQueueLane:
+        return _FetchQueueLane(self, index)
+
+    # ---- the queue interface ----
+    def put(self, index: int, job: FetchImageJob, force: bool = False):
+        with self._cond:
+            while not force and self.maxsize > 0 and \
+                    len(self._jobs[index]) >= self.maxsize and \
+                    not self._closed[index] and not self._starved:
+                self._cond.wait()
+            if self._cancelled:
+                return
+            if self._closed[index] and not force:
+                raise RuntimeError('The fetch queue has been closed.')
+            self._jobs[index].append(job)
+            self._cond.notify_all()
+
+    def close(self, index: Optional[int] = None):
+        with self._cond:
+            for i in (range(len(self._jobs)) if index is None else [index]):
+                self._closed[i] = True
+            self._cond.notify_all()
+
+    def cancel(self):
+        """As :meth:`FetchQueue.cancel`, for all the profiles."""
+        with self._cond:
+            self._cancelled = True
+            for i, jobs in enumerate(self._jobs):
+                self._closed[i] = True
+                jobs.clear()
+            self._waiting.clear()
+            self._cond.notify_all()
+
+    @property
+    def cancelled(self) -> bool:
+        with self._cond:
+            return self._cancelled
+
+    @property
+    def drained(self) -> bool:
+        with self._cond:
+            return all(self._closed) and not any(self._jobs) and \
+                not self._in_flight
+
+    def __iter__(self):
+        while True:
+            job = self.get()
+            if job is None:
+                break
+            yield job
+
+    def _pop_allowed(self, index: int) -> Optional[FetchImageJob]:
+        jobs = self._jobs[index]
+        if not self.max_per_illust and not self.max_per_author:
+            return jobs.popleft() if jobs else None
+        # the first job under the limits, the others keep their order
+        for i, job in enumerate(jobs):
+            if self.max_per_illust and self._illusts_in_flight[
+                    index, job.illust_id] >= self.max_per_illust:
+                continue
+            if self.max_per_author and \
+                    self._authors_in_flight[job.author_id] >= self.max_per_author:
+                continue
+            del jobs[i]
+            self._illusts_in_flight[index, job.illust_id] += 1
+            self._authors_in_flight[job.author_id] += 1
+            return job
+        return None
+
+    def _unlimit(self, index: int, job: FetchImageJob):
+        if not self.max_per_illust and not self.max_per_author:
+            return
+        with self._cond:
+            for in_flight, key in (
+                    (self._illusts_in_flight, (index, job.illust_id)),
+                    (self._authors_in_flight, job.author_id)):
+                in_flight[key] -= 1
+                if in_flight[key] <= 0:
+                    del in_flight[key]
+            self._cond.notify_all()
+
+    def _pop(self, block: bool) -> Optional[Tuple[int, FetchImageJob]]:
+        with self._cond:
+            while True:
+                n = len(self._jobs)
+                for step in range(n):
+                    index = (self._next + step) % n
+                    job = self._pop_allowed(index)
+                    if job is not None:
+                        self._next = (index + 1) % n
+                        self._cond.notify_all()
+                        return index, job
+                # the waiting jobs may be queued again if a download fails
+                if all(self._closed) and not any(self._jobs) and \
+                        not self._in_flight:
+                    return None
+                if not block:
+                    raise queue.Empty()
+                starved = any(self._jobs)
+                if starved:
+                    self._starved += 1
+                    self._cond.notify_all()
+                try:
+                    self._cond.wait()
+                finally:
+                    if starved:
+                        self._starved -= 1
+
+    def get(self, block: bool = True) -> Optional[FetchImageJob]:
+        """
+        Get the next job to download.
+
+        Raises:
+            queue.Empty: If `block` is False and no job is available yet.
+        """
+        while True:
+            item = self._pop(block)
+            if item is None:
+                return None
+            index, job = item
+            if self._claim(index, job):
+                return job
+            # linked, or waiting for the download of another profile
+            self._unlimit(index, job)
+
+    # ---- the urls shared by the profiles ----
+    def _find_fetched(self, index: int, job: FetchImageJob
+                      ) -> Optional[Tuple[str, FetchImageResult]]:
+        for i, profile in enumerate(self.profiles):
+            if i == index:
+                continue
+            illust = profile.sync_db.get_illust(job.illust_id)
+            images = illust.get('images', []) if illust else []
+            if job.image_id >= len(images):
+                continue
+            image = images[job.image_id]
+            if image['url'] != job.image_url or \
+                    not image.get('fetched', False) or 'digest' not in image:
+                continue
+            file_path = get_image_path(
+                profile.download_dir, job.illust_id, illust, job.image_id,
+                profile.fetch_kwargs['layout'])
+            if os.path.isfile(file_path) and \
+                    os.path.getsize(file_path) == image.get('size'):
+                return file_path, FetchImageResult(
+                    size=image['size'], digest=image['digest'])
+
+    def _link(self, index: int, job: FetchImageJob, source_path: str,
+              result: FetchImageResult) -> bool:
+        try:
+            os.makedirs(os.path.split(job.file_path)[0], exist_ok=True)
+            tmp_path = f'{job.file_path}.link'
+            try:
+                os.link(source_path, tmp_path)
+            except OSError:
+                # e.g., on different file systems
+                shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, job.file_path)
+        except OSError as ex:
+            print(f'! Failed to link {source_path} to {job.file_path}: {ex}')
+            return False
+        METRICS.inc('shared_downloads_total')
+        self._store(index, job, result, f'linked from {source_path}')
+        return True
+
+    def _claim(self, index: int, job: FetchImageJob) -> bool:
+        """Whether to download the job, or it is handled otherwise."""
+        with self._cond:
+            owner = self._in_flight.get(job.image_url)
+            if owner is not None and owner != index:
+                self._waiting.setdefault(job.image_url, []).append((index, job))
+                return False
+        fetched = self._find_fetched(index, job)
+        if fetched is not None and self._link(index, job, *fetched):
+            return False
+        with self._cond:
+            owner = self._in_flight.get(job.image_url)
+            if owner is not None and owner != index:
+                self._waiting.setdefault(job.image_url, []).append((index, job))
+                return False
+            self._in_flight[job.image_url] = index
+            self._owners[id(job)] = index
+        return True
+
+    def _release(self, job: FetchImageJob
+                 ) -> Tuple[int, List[Tuple[int, FetchImageJob]]]:
+        with self._cond:
+            index = self._owners.pop(id(job))
+            self._in_flight.pop(job.image_url, None)
+            waiting = self._waiting.pop(job.image_url, [])
+            self._unlimit(index, job)
+            self._cond.notify_all()
+        return index, waiting
+
+    def _store(self, index: int, job: FetchImageJob, result: FetchImageResult,
+               message: str = 'done'):
+        profile = self.profiles[index]
+        with self._lock:
+            self._counters[index] += 1
+            store_fetched_image(profile.sync_db, profile.download_dir, job,
+                                result, dedup=profile.fetch_kwargs['dedup'])
+            print(f'[{profile.name}] [{self._counters[index]}] {message}: '
+                  f'{job.image_url}')
+        postprocessor = profile.fetch_kwargs.get('postprocessor')
+        if postprocessor is not None:
+            postprocessor.submit(profile.sync_db, profile.download_dir,
+                                 job.illust_id, job.image_id)
+
+    # ---- the callbacks of the download engines ----
+    def on_done(self, job: FetchImageJob, result: FetchImageResult):
+        METRICS.inc('downloads_done_total')
+        with self._cond:
+            index = self._owners[id(job)]
+        # the url is released once stored, such that the jobs of the other
+        # profiles claiming it meanwhile wait, instead of downloading it again
+        try:
+            self._store(index, job, result)
+        except BaseException:
+            # the waiting jobs get their own attempts
+            _, waiting = self._release(job)
+            for i, waiting_job in waiting:
+                self.put(i, waiting_job, force=True)
+            raise
+        _, waiting = self._release(job)
+        profile = self.profiles[index]
+        # the stored copy may be elsewhere with `download.dedup: skip`
+        source_path = get_image_path(
+            profile.download_dir, job.illust_id,
+            profile.sync_db.get_illust(job.illust_id), job.image_id,
+            profile.fetch_kwargs['layout'])
+        for i, waiting_job in waiting:
+            if not self._link(i, waiting_job, source_path, result):
+                self.put(i, waiting_job, force=True)
+
+    def on_failed(self, job: FetchImageJob):
+        METRICS.inc('downloads_failed_total')
+        print(''.join(traceback.format_exception(*sys.exc_info())) +
+              f'Failed to download: {job.image_url}')
+        # the waiting jobs get their own attempts
+        _, waiting = self._release(job)
+        for i, waiting_job in waiting:
+            self.put(i, waiting_job, force=True)
+
+
+def fetch_profile_images(profiles: List[SyncProfile],
+                         api: Optional['AppPixivAPI'] = None):
+    """
+    Fetch the pending images of several profiles through one
+    :class:`SharedFetchScheduler`, with the download settings (e.g., the
+    number of workers) of the first profile.
+    """
+    fetch_kwargs = profiles[0].fetch_kwargs
+    if api is None:
+        api = make_api_client(profiles[0].sync_db)
+    scheduler = SharedFetchScheduler(
+        profiles, maxsize=fetch_kwargs['queue_size'],
+        max_per_illust=fetch_kwargs['max_per_illust'],
+        max_per_author=fetch_kwargs['max_per_author'])
+    lanes = []
+    for i, profile in enumerate(profiles):
+        if profile.fetch_kwargs['dedup'] not in DEDUP_MODES:
+            raise ValueError(f'Unknown dedup mode: '
+                             f'{profile.fetch_kwargs["dedup"]}')
+        jobs = iter_fetch_jobs(profile.sync_db, profile.download_dir,
+                               profile.fetch_kwargs['layout'],
+                               priority=profile.fetch_kwargs['priority'])
+        lanes.append((scheduler.lane(i), jobs))
+    # the dedup modes of all the profiles are checked before starting
+    producers = [_start_thread(_put_fetch_jobs, lane, jobs, daemon=True)
+                 for lane, jobs in lanes]
+    print(f'> Fetching images of {len(profiles)} profiles ...')
+
+    try:
+        _run_fetch_engine(
+            api, scheduler, scheduler.on_done, scheduler.on_failed,
+            **{k: fetch_kwargs[k] for k in (
+                'n_workers', 'engine', 'n_connections', 'http_headers',
+                'retries', 'retry_backoff', 'autotune', 'min_workers',
+                'bandwidth')}
+        )
+    except BaseException:
+        scheduler.cancel()
+        raise
+    finally:
+        for producer in producers:
+            producer.wait()
+    for profile in profiles:
+        postprocessor = profile.fetch_kwargs.get('postprocessor')
+        if postprocessor is not None:
+            postprocessor.process_pending(profile.sync_db, profile.download_dir)
+
 
-    api = make_api_client(sync_db)
+class WatchSchedule(object):
+    """
+    Schedule of the sources pulled by `watch`, i.e., the authors and the
+    favourites, each due every `watch.interval` seconds.
 
-    # get new illustrations list from interested authors
-    for author_id_or_url in config.get('authors', []):
-        author_id = None
-        for pattern in AUTHOR_ID_PATTERNS:
-            m = pattern.match(author_id_or_url)
-            if m:
-                author_id = m.group(1)
-                break
-        if author_id is None:
-            raise ValueError(f'No author ID can be recognized from: '
-                             f'{author_id_or_url}')
+    The interval may be overridden in `watch.intervals`, by the author id
+    (or url) or the favourite type, or by "authors" or "favourites" for
+    all the sources of this kind.
+    """
 
-        print(f'> Pull from: {author_id_or_url}')
-        offset = 0
-        new_counter = 0
+    def __init__(self, config: Dict[str, Any]):
+        default = config.get('watch.interval', 3600)
+        intervals = config.get('watch.intervals') or {}
+        self.intervals: Dict[Tuple[str, str], float] = {}
+        for kind in ('authors', 'favourites'):
+            for source in config.get(kind, []):
+                self.intervals[(kind, source)] = intervals.get(
+                    str(source), intervals.get(kind, default))
+        self.interval = default
+        self._next_due = {k: float('-inf') for k in self.intervals}
+        self._last_start_time = float('-inf')
+
+    def due(self, now: float) -> List[Tuple[str, str]]:
+        return [k for k, t in self._next_due.items() if t <= now]
+
+    def done(self, sources: Iterable[Tuple[str, str]], start_time: float):
+        for k in sources:
+            self._next_due[k] = start_time + self.intervals[k]
+        self._last_start_time = start_time
+
+    def next_due(self) -> float:
+        # without any source, only fetch the pending images every interval
+        return min(self._next_due.values(),
+                   default=self._last_start_time + self.interval)
+
+
+class DirectoryIndex(object):
+    """
+    Index of the file names in the download directories.
+
+    Each directory is listed by one :func:`os.scandir` instead of one
+    :func:`os.path.exists` per file, and kept for the rest of the run.
+    """
+
+    def __init__(self, n_workers: int = 8):
+        self.n_workers = n_workers
+        self._dirs: Dict[str, FrozenSet[str]] = {}
+        self._lock = threading.Lock()
+
+    def _list_dir(self, dir_path: str) -> FrozenSet[str]:
         try:
-            while True:
-                r = api.user_illusts(author_id, offset=offset)
-                if 'error' in r:
-                    raise Exception(r['error']['message'] or r['error']['user_message'])
-                illusts = r['illusts']
-                if not illusts:
-                    break
-                for illust in illusts:
-                    new_counter = store_illust(illust, new_counter)
-                offset += len(illusts)
+            with os.scandir(dir_path) as it:
+                names = frozenset(e.name for e in it)
+        except (FileNotFoundError, NotADirectoryError):
+            names = frozenset()
+        with self._lock:
+            self._dirs[dir_path] = names
+        return names
 
-        except Exception:
-            print(''.join(traceback.format_exception(*sys.exc_info())) +
-                  f'Failed to call `api.user_illusts`: user_id={author_id}, '
-                  f'offset={offset}.')
+    def prefetch(self, dir_paths: Iterable[str]):
+        """List the directories in parallel, if not yet listed by this run."""
+        dir_paths = [d for d in set(dir_paths) if d not in self._dirs]
+        if len(dir_paths) > 1 and self.n_workers > 1:
+            pool = ThreadPool(processes=self.n_workers)
+            try:
+                pool.map(self._list_dir, dir_paths, chunksize=16)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for d in dir_paths:
+                self._list_dir(d)
 
-        if new_counter > 0:
-            print(f'Discovered {new_counter} new illusts.')
+    def list_dir(self, dir_path: str) -> FrozenSet[str]:
+        names = self._dirs.get(dir_path)
+        if names is None:
+            names = self._list_dir(dir_path)
+        return names
 
-    # get new illustrations from user's bookmarks
-    the_max_bookmark_id = max_bookmark_id
-    if api.user_id:
-        for fav in config.get('favourites', []):
-            if fav not in ('public', 'private'):
-                raise ValueError(f'Unknown favourite type: {fav}')
+    def exists(self, path: str) -> bool:
+        dir_path, name = os.path.split(path)
+        return name in self.list_dir(dir_path)
 
-            max_bookmark_id = the_max_bookmark_id
-            new_counter = 0
+    def add(self, path: str):
+        """Remember a file created (or moved here) by this run."""
+        dir_path, name = os.path.split(path)
+        with self._lock:
+            if dir_path in self._dirs:
+                self._dirs[dir_path] = self._dirs[dir_path] | {name}
 
-            while True:
-                print(f'> Pull from bookmark: {fav} (max_bookmark_id={max_bookmark_id})')
-                r = api.user_bookmarks_illust(
-                    api.user_id, restrict=fav, max_bookmark_id=max_bookmark_id)
-                if 'error' in r:
-                    raise Exception(r['error']['message'] or r['error']['user_message'])
+    def discard(self, path: str):
+        """Forget a file (or a directory) removed by this run."""
+        dir_path, name = os.path.split(path)
+        with self._lock:
+            if dir_path in self._dirs:
+                self._dirs[dir_path] = self._dirs[dir_path] - {name}
+            self._dirs.pop(path, None)
 
-                # parse the illustrations
-                illusts = r['illusts']
-                if not illusts:
-                    break
 
-                old_new_counter = new_counter
-                for illust in illusts:
-                    new_counter = store_illust(illust, new_counter)
+def make_dir_index(config: Dict[str, Any]) -> DirectoryIndex:
+    return DirectoryIndex(n_workers=config.get('scan.workers', 8))
 
-                # if no new illusts on this page, stop pulling
-                if old_new_counter == new_counter:
-                    break
-                else:
-                    print(f'Discovered {new_counter - old_new_counter} new illusts.')
 
-                # parse the next bookmark
-                next_url = r['next_url']
-                if next_url:
-                    m = re.match(r'.*[?&]max_bookmark_id=(\d+)(?:&|$)', next_url)
-                    if m:
-                        max_bookmark_id = m.group(1)
-                    else:
-                        break
-    else:
-        print('! User not logged in, bookmarks disabled.')
-
-    # update "_deleted"
-    for illust_id in sync_db.get_illust_ids():
-        illust = sync_db.get_illust(illust_id, {})
-        sync_db.update_illust(
-            illust_id,
-            {'_deleted': is_illust_excluded(config, illust)}
-        )
+DEDUP_MODES = ('off', 'hardlink', 'skip')
 
 
-@dataclass
-class FetchImageJob(object):
-    file_path: str
-    image_url: str
-    illust_id: str
-    image_id: int
+def store_fetched_image(sync_db: SyncDB, download_dir: str,
+                        job: FetchImageJob, result: FetchImageResult,
+                        dedup: str = 'off'):
+    """
+    Mark a downloaded image as fetched, and record its content digest in
+    the hash index of `sync_db`.
 
+    The path of the file (relative to `download_dir`) is stored in the
+    image.  If `dedup` is "hardlink", an image with the same content as an
+    image already stored is replaced by a hard link to the stored one.  If
+    `dedup` is "skip", the downloaded file is removed, and the image is
+    marked as `shared`, with the `path` of the stored one.
+    """
+    rel_path = os.path.relpath(job.file_path, download_dir)
+    ref = f'{job.illust_id}/{job.image_id}'
+    # the new content is to be post-processed again
+    image_val = {'size': result.size, 'digest': result.digest,
+                 'path': rel_path, 'shared': None, 'processed': None}
 
-def fetch_images(sync_db: SyncDB, download_dir: str, n_workers: int):
-    api = make_api_client(sync_db)
+    with sync_db.lock:
+        entry = sync_db.get_hash(result.digest)
+        if entry is None:
+            entry = {'path': rel_path, 'size': result.size, 'refs': []}
+        else:
+            entry = {**entry, 'refs': list(entry['refs'])}
+        stored_path = os.path.join(download_dir, entry['path'])
 
-    # get the jobs of fetch images
-    image_jobs: List[FetchImageJob] = []
-    for illust_id in sync_db.get_illust_ids():
-        illust = sync_db.get_illust(illust_id, {})
-        if illust.get('_deleted', False):
+        if not os.path.isfile(stored_path):
+            # the stored copy is gone, this one becomes the stored copy
+            entry['path'] = rel_path
+        elif entry['path'] != rel_path and dedup != 'off' and \
+                os.path.getsize(stored_path) == result.size:
+            try:
+                if dedup == 'hardlink':
+                    if not os.path.samefile(stored_path, job.file_path):
+                        tmp_path = f'{job.file_path}.link'
+                        os.link(stored_path, tmp_path)
+                        os.replace(tmp_path, job.file_path)
+                else:
+                    os.remove(job.file_path)
+                    image_val['path'] = entry['path']
+                    image_val['shared'] = True
+            except OSError as ex:
+                # e.g., the file system does not support hard links
+                print(f'! Failed to de-duplicate {job.file_path}: {ex}')
+            else:
+                METRICS.inc('dedup_images_total')
+                METRICS.inc('dedup_bytes_total', result.size)
+
+        if ref not in entry['refs']:
+            entry['refs'].append(ref)
+        sync_db.update_image(job.illust_id, job.image_id, image_val)
+        sync_db.set_hash(result.digest, entry)
+        sync_db.set_illust_fetched(job.illust_id, job.image_id)
+
+
+def _release_image_refs(sync_db: SyncDB, download_dir: str, illust_id: str,
+                        illust: Dict[str, Any],
+                        dir_index: DirectoryIndex,
+                        layout: str = 'author_name'):
+    """
+    Remove the images of an illust from the hash index, before removing
+    their files.  If the stored copy of an image is shared with the images
+    of other illusts, it is moved to one of them.
+    """
+    prefix = f'{illust_id}/'
+    for i, image in enumerate(illust.get('images', [])):
+        digest = image.get('digest')
+        entry = sync_db.get_hash(digest) if digest else None
+        if entry is None:
+            continue
+        refs = [r for r in entry['refs'] if not r.startswith(prefix)]
+        if not refs:
+            sync_db.set_hash(digest, None)
             continue
 
-        author_name = illust['author_name']
-        parent_dir = os.path.join(download_dir, author_name)
+        entry = {**entry, 'refs': refs}
+        file_path = get_image_path(download_dir, illust_id, illust, i, layout)
+        if not image.get('shared') and \
+                entry['path'] == os.path.relpath(file_path, download_dir):
+            sharing = []
+            for ref in refs:
+                ref_illust_id, ref_image_id = ref.rsplit('/', 1)
+                ref_illust = sync_db.get_illust(ref_illust_id, {})
+                ref_images = ref_illust.get('images', [])
+                if int(ref_image_id) < len(ref_images):
+                    ref_image = ref_images[int(ref_image_id)]
+                    if ref_image.get('shared') and \
+                            ref_image.get('path') == entry['path']:
+                        sharing.append(
+                            (ref_illust_id, ref_illust, int(ref_image_id)))
 
-        images = illust.get('images', [])
-        if len(images) > 1:
-            parent_dir = os.path.join(parent_dir, illust_id)
-        for i, image in enumerate(
-                sync_db.get_illust(illust_id, {}).get('images')):
-            if image.get('fetched', False):
-                continue
-            image_url = image['url']
-            file_name = image_url.rsplit('/', 1)[-1]
-            file_path = os.path.join(parent_dir, file_name)
-            image_jobs.append(FetchImageJob(
-                file_path=file_path,
-                image_url=image_url,
-                illust_id=illust_id,
-                image_id=i,
-            ))
-    image_jobs.sort(key=lambda o: o.file_path)
-    f_lock = threading.RLock()
-    counter = [len(image_jobs)]
+            if sharing and dir_index.exists(file_path):
+                # move the stored copy to the first image sharing it
+                new_path = get_default_image_path(
+                    download_dir, *sharing[0], layout=layout)
+                os.makedirs(os.path.split(new_path)[0], exist_ok=True)
+                os.replace(file_path, new_path)
+                dir_index.discard(file_path)
+                dir_index.add(new_path)
+                print(f'Moved: {file_path} -> {new_path}')
+                entry['path'] = os.path.relpath(new_path, download_dir)
+                for j, (ref_illust_id, _, ref_image_id) in enumerate(sharing):
+                    sync_db.update_image(ref_illust_id, ref_image_id, {
+                        'path': entry['path'],
+                        'shared': True if j else None,
+                    })
+            else:
+                # the other images have their own copies (or hard links)
+                for ref in refs:
+                    ref_illust_id, ref_image_id = ref.rsplit('/', 1)
+                    ref_illust = sync_db.get_illust(ref_illust_id, {})
+                    ref_images = ref_illust.get('images', [])
+                    if int(ref_image_id) < len(ref_images) and \
+                            not ref_images[int(ref_image_id)].get('shared'):
+                        ref_path = get_image_path(
+                            download_dir, ref_illust_id, ref_illust,
+                            int(ref_image_id), layout)
+                        if dir_index.exists(ref_path):
+                            entry['path'] = os.path.relpath(ref_path, download_dir)
+                            break
 
-    def f_download(job: FetchImageJob):
-        parent_dir, name = os.path.split(job.file_path)
-        try:
-            os.makedirs(parent_dir, exist_ok=True)
-            api.download(
-                url=job.image_url,
-                path=parent_dir,
-                name=name,
-                replace=True,
-            )
-            with f_lock:
-                counter[0] -= 1
-                sync_db.set_illust_fetched(job.illust_id, job.image_id)
-                print(f'[{counter[0]}/{len(image_jobs)}] done: {job.image_url}')
-        except:
-            try:
-                os.remove(job.file_path)
-            except Exception:
-                pass
-            print(''.join(traceback.format_exception(*sys.exc_info())) +
-                  f'Failed to download: {job.image_url}')
+        sync_db.set_hash(digest, entry)
 
-    if image_jobs:
-        print(f'> Fetching {len(image_jobs)} images ...')
-        pool = ThreadPool(processes=n_workers)
-        pool.map(f_download, image_jobs)
-        pool.close()
-        pool.join()
 
+def _prefetch_illust_dirs(dir_index: DirectoryIndex, download_dir: str,
+                          illust_items: Iterable[Tuple[str, Dict[str, Any]]],
+                          layout: str = 'author_name'):
+    dir_paths = set()
+    for illust_id, illust in illust_items:
+        for file_path in get_image_paths(download_dir, illust_id, illust,
+                                         layout):
+            image_dir = os.path.dirname(file_path)
+            dir_paths.add(image_dir)
+            dir_paths.add(os.path.dirname(image_dir))
+    dir_index.prefetch(dir_paths)
+
+
+def _remove_illust(download_dir, sync_db, illust_ids,
+                   dir_index: Optional[DirectoryIndex] = None,
+                   layout: str = 'author_name'):
+    if dir_index is None:
+        dir_index = DirectoryIndex()
+    illust_items = [(i, sync_db.get_illust(i)) for i in illust_ids]
+    _prefetch_illust_dirs(
+        dir_index, download_dir, [(i, v) for i, v in illust_items if v],
+        layout)
 
-def _remove_illust(download_dir, sync_db, illust_ids):
     for illust_id in illust_ids:
         illust = sync_db.get_illust(illust_id)
         if illust:
-            author_name = illust['author_name']
-            parent_dir = os.path.join(download_dir, author_name)
-            remove_parent_dir = False
-
+            parent_dirs = {get_illust_dir(download_dir, illust_id, illust, layout)}
             images = illust.get('images', [])
-            if len(images) > 1:
-                parent_dir = os.path.join(parent_dir, illust_id)
-                remove_parent_dir = True
+            remove_parent_dir = len(images) > 1
+            _release_image_refs(sync_db, download_dir, illust_id, illust,
+                                dir_index, layout)
 
             for i, image in enumerate(images):
                 if not image.get('fetched', False):
                     continue
-                image_url = image['url']
-                file_name = image_url.rsplit('/', 1)[-1]
-                file_path = os.path.join(parent_dir, file_name)
-                is_removed = not os.path.exists(file_path)
+                if image.get('shared'):
+                    # the stored copy belongs to another image, keep it
+                    sync_db.update_image(illust_id, i, {'path': None, 'shared': None})
+                    sync_db.set_illust_fetched(illust_id, i, False)
+                    continue
+                file_path = get_image_path(download_dir, illust_id, illust, i, layout)
+                parent_dirs.add(os.path.split(file_path)[0])
+                is_removed = not dir_index.exists(file_path)
 
                 if not is_removed:
                     try:
                         os.remove(file_path)
                         is_removed = True
+                        dir_index.discard(file_path)
                         print(f'Removed: {file_path}')
                     except Exception:
                         print(f'Failed to remove: {file_path}')
                         print(''.join(traceback.format_exception(*sys.exc_info())))
 
                 if is_removed:
+                    sync_db.update_image(illust_id, i, {'path': None})
                     sync_db.set_illust_fetched(illust_id, i, False)
 
-            if remove_parent_dir and os.path.exists(parent_dir):
-                try:
-                    shutil.rmtree(parent_dir)
-                except Exception:
-                    print(f'Failed to rmtree: {parent_dir}')
-                    print(''.join(traceback.format_exception(*sys.exc_info())))
+            for parent_dir in parent_dirs:
+                # only the directories of this illust, in any layout
+                if remove_parent_dir and \
+                        os.path.basename(parent_dir) == illust_id and \
+                        dir_index.exists(parent_dir):
+                    try:
+                        shutil.rmtree(parent_dir)
+                        dir_index.discard(parent_dir)
+                    except Exception:
+                        print(f'Failed to rmtree: {parent_dir}')
+                        print(''.join(traceback.format_exception(*sys.exc_info())))
 
             sync_db.update_illust(illust_id, {'_deleted': True})
 
 
-def _count_db(sync_db, download_dir):
+def _count_db(sync_db, download_dir,
+              dir_index: Optional[DirectoryIndex] = None,
+              layout: str = 'author_name'):
     counts = {
         'illust': [],
         'deleted_illust': [],
@@ -479,23 +4053,23 @@ def _count_db(sync_db, download_dir):
         'not_exist_images': [],
         'not_deleted_images': [],
     }
-    for illust_id in sync_db.get_illust_ids():
-        illust = sync_db.get_illust(illust_id, {})
+    if dir_index is None:
+        dir_index = DirectoryIndex()
+    # the illusts are streamed once, and only the paths of their images
+    # (which are returned anyway) are kept until the directories are listed
+    illust_paths = []
+    dir_paths = set()
+    for illust_id, illust in sync_db.iter_illust_items():
         deleted = illust.get('_deleted')
         counts['deleted_illust' if deleted else 'illust'].append(illust_id)
+        paths = get_image_paths(download_dir, illust_id, illust, layout)
+        dir_paths.update(os.path.dirname(p) for p in paths)
+        illust_paths.append((deleted, paths))
+    dir_index.prefetch(dir_paths)
 
-        author_name = illust['author_name']
-        parent_dir = os.path.join(download_dir, author_name)
-        images = illust.get('images', [])
-        if len(images) > 1:
-            parent_dir = os.path.join(parent_dir, illust_id)
-
-        for i, image in enumerate(images):
-            image_url = image['url']
-            file_name = image_url.rsplit('/', 1)[-1]
-            file_path = os.path.join(parent_dir, file_name)
-
-            if os.path.exists(file_path):
+    for deleted, paths in illust_paths:
+        for file_path in paths:
+            if dir_index.exists(file_path):
                 counts['not_deleted_images' if deleted else 'images'].append(file_path)
             else:
                 counts['deleted_images' if deleted else 'not_exist_images'].append(file_path)
@@ -503,6 +4077,239 @@ def _count_db(sync_db, download_dir):
     return counts
 
 
+def _move_stored_path(sync_db: SyncDB, digest: Optional[str],
+                      old_path: str, new_path: str):
+    """Update the hash index, and the images sharing a moved stored copy."""
+    entry = sync_db.get_hash(digest) if digest else None
+    if entry is None or entry['path'] != old_path:
+        return
+    for ref in entry['refs']:
+        ref_illust_id, ref_image_id = ref.rsplit('/', 1)
+        ref_illust = sync_db.get_illust(ref_illust_id, {})
+        ref_images = ref_illust.get('images', [])
+        if int(ref_image_id) < len(ref_images):
+            ref_image = ref_images[int(ref_image_id)]
+            if ref_image.get('shared') and ref_image.get('path') == old_path:
+                sync_db.update_image(ref_illust_id, int(ref_image_id),
+                                     {'path': new_path})
+    sync_db.set_hash(digest, {**entry, 'path': new_path})
+
+
+def relocate_images(sync_db: SyncDB, download_dir: str, layout: str,
+                    simulate: bool = False) -> Dict[str, int]:
+    """
+    Move the fetched images, and the partial downloads, into the download
+    `layout` by renames, and store the paths of the fetched images.
+
+    A file missing from its path but found in the layout (e.g., moved by
+    an interrupted run) is recorded as moved.
+    """
+    counts = {'moved': 0, 'kept': 0, 'missing': 0}
+    old_dirs = set()
+
+    for illust_id, illust in sync_db.iter_illust_items():
+        for i, image in enumerate(illust.get('images', [])):
+            if image.get('shared'):
+                continue  # follows its stored copy
+            fetched = image.get('fetched', False)
+            file_path = get_image_path(download_dir, illust_id, illust, i, layout)
+            new_path = get_default_image_path(
+                download_dir, illust_id, illust, i, layout)
+            if not fetched:
+                file_path = _get_part_path(file_path)
+                new_path = _get_part_path(new_path)
+
+            if file_path == new_path:
+                counts['kept'] += 1
+            elif not os.path.exists(file_path):
+                if not fetched or not os.path.exists(new_path):
+                    counts['missing'] += int(fetched)
+                    continue
+                counts['moved'] += 1
+            else:
+                print(f'Move: {file_path} -> {new_path}')
+                counts['moved'] += 1
+                if simulate:
+                    continue
+                os.makedirs(os.path.split(new_path)[0], exist_ok=True)
+                os.replace(file_path, new_path)
+                old_dirs.add(os.path.split(file_path)[0])
+
+            if simulate:
+                continue
+            if fetched:
+                old_rel_path = os.path.relpath(file_path, download_dir)
+                new_rel_path = os.path.relpath(new_path, download_dir)
+                if image.get('path') != new_rel_path:
+                    sync_db.update_image(illust_id, i, {'path': new_rel_path})
+                if old_rel_path != new_rel_path:
+                    _move_stored_path(sync_db, image.get('digest'),
+                                      old_rel_path, new_rel_path)
+            elif image.get('path'):
+                sync_db.update_image(illust_id, i, {'path': None})
+
+    # remove the directories left empty
+    for old_dir in sorted(old_dirs, key=len, reverse=True):
+        try:
+            os.removedirs(old_dir)
+        except OSError:
+            pass
+    return counts
+
+
+VERIFY_STATUSES = ('ok', 'unchecked', 'missing', 'truncated', 'corrupt')
+
+
+def _verify_image_file(args: Tuple[str, Optional[int], Optional[str]]) -> str:
+    """
+    Check an image file against its recorded size and digest, in a worker
+    process.  The file is memory-mapped, such that it is hashed without
+    being copied into the process.
+    """
+    file_path, size, digest = args
+    try:
+        file_size = os.path.getsize(file_path)
+    except FileNotFoundError:
+        return 'missing'
+    if size is not None and file_size < size:
+        return 'truncated'
+    if size is not None and file_size != size:
+        return 'corrupt'
+    if digest is None:
+        return 'unchecked'
+
+    if file_size == 0:
+        hasher = hashlib.sha256()
+    else:
+        with open(file_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            hasher = hashlib.sha256(m)
+    return 'ok' if hasher.hexdigest() == digest else 'corrupt'
+
+
+def _verify_db(sync_db: SyncDB, download_dir: str, n_workers: Optional[int] = None
+               ) -> Dict[str, List[Tuple[str, List[Tuple[str, int]]]]]:
+    """
+    Verify the files of the fetched images with a pool of `n_workers`
+    processes.  Returns the file paths by status, each with the images
+    stored in this file (more than one with ``download.dedup: skip``).
+    """
+    files: Dict[str, Tuple[Optional[int], Optional[str]]] = {}
+    file_images: Dict[str, List[Tuple[str, int]]] = collections.defaultdict(list)
+    for illust_id, illust in sync_db.iter_illust_items():
+        for i, image in enumerate(illust.get('images', [])):
+            if image.get('fetched', False):
+                file_path = get_image_path(download_dir, illust_id, illust, i)
+                files[file_path] = (image.get('size'), image.get('digest'))
+                file_images[file_path].append((illust_id, i))
+
+    ret = {k: [] for k in VERIFY_STATUSES}
+    # sorted to read the files in the order of the directories
+    args = sorted((k, *v) for k, v in files.items())
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        statuses = pool.map(_verify_image_file, args, chunksize=32)
+        for (file_path, _, _), status in zip(args, statuses):
+            ret[status].append((file_path, file_images[file_path]))
+    return ret
+
+
+def _unfetch_corrupt_images(sync_db: SyncDB, status: str, file_path: str,
+                            images: List[Tuple[str, int]]):
+    """
+    Mark the images of a missing or corrupt file as not fetched, such that
+    the next sync fetches them again.  A truncated file is kept as a partial
+    download, to be resumed.  The images sharing the file are fetched again
+    into their own files.
+    """
+    if status == 'truncated':
+        os.replace(file_path, _get_part_path(file_path))
+    elif status == 'corrupt':
+        os.remove(file_path)
+    for illust_id, image_id in images:
+        image = sync_db.get_illust(illust_id)['images'][image_id]
+        if image.get('shared'):
+            sync_db.update_image(illust_id, image_id,
+                                 {'path': None, 'shared': None})
+        sync_db.set_illust_fetched(illust_id, image_id, False)
+
+
+FETCH_PLAN_FORMATS = ('jsonl', 'aria2')
+
+
+def write_fetch_plan(jobs: Iterable[FetchImageJob], f: IO[str], fmt: str,
+                     headers: Dict[str, str]) -> int:
+    """
+    Write the fetch jobs for an external downloader, as JSON lines, or as
+    an input file of ``aria2c -i``.  Returns the number of jobs.
+    """
+    if fmt not in FETCH_PLAN_FORMATS:
+        raise ValueError(f'Unknown fetch plan format: {fmt}')
+    count = 0
+    for job in jobs:
+        if fmt == 'aria2':
+            dir_name, file_name = os.path.split(job.file_path)
+            f.write(f'{job.image_url}\n  dir={dir_name}\n  out={file_name}\n')
+            for k, v in headers.items():
+                f.write(f'  header={k}: {v}\n')
+        else:
+            f.write(json.dumps({
+                'url': job.image_url,
+                'path': job.file_path,
+                'illust_id': job.illust_id,
+                'image_id': job.image_id,
+                'headers': headers,
+            }, ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+
+def _hash_image_file(file_path: str) -> Optional[FetchImageResult]:
+    """
+    Hash a file downloaded by an external downloader, in a worker process.
+    Returns None if missing, or still being downloaded by aria2.
+    """
+    if os.path.exists(f'{file_path}.aria2') or not os.path.isfile(file_path):
+        return None
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return None
+    with open(file_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return FetchImageResult(size=size, digest=hashlib.sha256(m).hexdigest())
+
+
+def ingest_fetched_images(sync_db: SyncDB, download_dir: str,
+                          n_workers: Optional[int] = None,
+                          dedup: str = 'off',
+                          layout: str = 'author_name',
+                          simulate: bool = False,
+                          batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Mark the pending images as fetched if their files have been completed
+    by an external downloader, hashing the files with a pool of `n_workers`
+    processes.  See :func:`store_fetched_image` for `dedup`.
+    """
+    counts = {'ingested': 0, 'pending': 0}
+    jobs = iter_fetch_jobs(sync_db, download_dir, layout)
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        while True:
+            batch = list(itertools.islice(jobs, batch_size))
+            if not batch:
+                break
+            results = pool.map(_hash_image_file,
+                               [job.file_path for job in batch], chunksize=32)
+            for job, result in zip(batch, results):
+                if result is None:
+                    counts['pending'] += 1
+                    continue
+                counts['ingested'] += 1
+                print(f'Ingested: {job.file_path}')
+                if not simulate:
+                    store_fetched_image(sync_db, download_dir, job, result,
+                                        dedup=dedup)
+    return counts
+
+
 @pixiv_sync.command()
 @click.option('-C', '--config-file', help='The YAML config file.',
               default='config.yml', required=True)
@@ -511,31 +4318,296 @@ def _count_db(sync_db, download_dir):
 def login(config_file, username, password):
     """Login with username and password and obtain authentication token."""
     config = load_config_file(config_file)
-    with SyncDB(config['sync.db']) as sync_db:
-        api = AppPixivAPI()
+    with open_sync_db(config) as sync_db:
+        api = new_app_api()
         token = api.login(username, password)['response']
         pprint(token)
         sync_db.set_token(token)
 
 
+def get_download_layout(config: Dict[str, Any]) -> str:
+    layout = config.get('download.layout', 'author_name')
+    if layout not in DOWNLOAD_LAYOUTS:
+        raise ValueError(f'Unknown download layout: {layout}')
+    return layout
+
+
+def get_fetch_priority_config(config: Dict[str, Any]) -> List[str]:
+    priority = config.get('download.priority') or []
+    if isinstance(priority, str):
+        priority = [priority]
+    for p in priority:
+        if p not in FETCH_PRIORITIES:
+            raise ValueError(f'Unknown download priority: {p}')
+    return priority
+
+
+def check_fetch_kwargs(fetch_kwargs: Dict[str, Any]):
+    """Validate the arguments of :func:`fetch_images`, before any download."""
+    engine = fetch_kwargs.get('engine', 'thread')
+    if engine not in FETCH_ENGINES:
+        raise ValueError(f'Unknown download engine: {engine}')
+    if engine == 'asyncio':
+        _import_aiohttp()
+    dedup = fetch_kwargs.get('dedup', 'off')
+    if dedup not in DEDUP_MODES:
+        raise ValueError(f'Unknown dedup mode: {dedup}')
+    layout = fetch_kwargs.get('layout', 'author_name')
+    if layout not in DOWNLOAD_LAYOUTS:
+        raise ValueError(f'Unknown download layout: {layout}')
+
+
+def get_fetch_kwargs(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Get the arguments of :func:`fetch_images` from `config`."""
+    return dict(
+        n_workers=config.get('download.workers', 8),
+        engine=config.get('download.engine', 'thread'),
+        n_connections=config.get('download.connections'),
+        http_headers=config.get('http.headers') or {},
+        retries=config.get('download.retries', 3),
+        retry_backoff=config.get('download.retry_backoff', 1.0),
+        dedup=config.get('download.dedup') or 'off',  # YAML loads `off` as False
+        queue_size=config.get('download.queue_size', 1000),
+        layout=get_download_layout(config),
+        autotune=config.get('download.autotune', False),
+        min_workers=config.get('download.min_workers', 1),
+        bandwidth=config.get('download.bandwidth'),
+        priority=get_fetch_priority_config(config),
+        max_per_illust=config.get('download.max_per_illust', 0),
+        max_per_author=config.get('download.max_per_author', 0),
+    )
+
+
 @pixiv_sync.command()
-@click.option('-C', '--config-file', help='The YAML config file.',
-              default='config.yml', required=True)
+@click.option('-C', '--config-file', 'config_files', multiple=True,
+              default=['config.yml'], required=True,
+              help='The YAML config file; repeat it to sync several profiles '
+                   'with shared downloads.')
 @click.option('--list-only', is_flag=True, default=False)
 @click.option('--fetch-only', is_flag=True, default=False)
 @click.option('--max-bookmark-id', required=False, default=None)
-def sync(config_file, list_only, fetch_only, max_bookmark_id):
+@click.option('--full', is_flag=True, default=False,
+              help='Pull all the illusts of the authors and the bookmarks, '
+                   'not only the new ones.')
+@click.option('--pipeline', is_flag=True, default=None,
+              help='Start fetching images while still pulling the list.')
+@click.option('--metrics-file', required=False, default=None,
+              help='Save the metrics of the run to this JSON file.')
+@click.option('--prometheus-file', required=False, default=None,
+              help='Save the metrics of the run to this file, in the '
+                   'Prometheus text format.')
+@click.option('--profile', 'profile_file', required=False, default=None,
+              help='Save the cProfile stats of the run to this file.')
+def sync(config_files, list_only, fetch_only, max_bookmark_id, full, pipeline,
+         metrics_file, prometheus_file, profile_file):
     """Synchronize the illustrations."""
-    config = load_config_file(config_file)
+    if len(config_files) > 1:
+        if pipeline:
+            print('! `--pipeline` is not supported with several profiles.')
+        sync_profiles(config_files, list_only=list_only, fetch_only=fetch_only,
+                      max_bookmark_id=max_bookmark_id, full=full,
+                      metrics_file=metrics_file,
+                      prometheus_file=prometheus_file,
+                      profile_file=profile_file)
+        return
+
+    config = load_config_file(config_files[0])
     download_dir = os.path.abspath(config['download.dir'])
-    n_workers = config.get('download.workers', 8)
+    fetch_kwargs = get_fetch_kwargs(config)
+    if pipeline is None:
+        pipeline = config.get('sync.pipeline', False)
+
+    metrics_file = metrics_file or config.get('metrics.file')
+    prometheus_file = prometheus_file or config.get('metrics.prometheus_file')
+
+    with contextlib.ExitStack() as stack:
+        if profile_file:
+            stack.enter_context(profile_run(profile_file))
+        stack.enter_context(METRICS.phase('sync'))
+        sync_db = stack.enter_context(open_sync_db(config))
+        fetch_kwargs['postprocessor'] = stack.enter_context(
+            PostProcessor.from_config(config))
+
+        if pipeline and not fetch_only and not list_only:
+            sync_pipelined(sync_db, config, download_dir, fetch_kwargs,
+                           max_bookmark_id=max_bookmark_id, full=full)
+        else:
+            if not fetch_only:
+                with METRICS.phase('update_list'):
+                    update_list(sync_db, config,
+                                max_bookmark_id=max_bookmark_id, full=full)
+            if not list_only:
+                print('')
+                fetch_images(sync_db, download_dir, **fetch_kwargs)
+
+    save_metrics(METRICS, json_file=metrics_file,
+                 prometheus_file=prometheus_file)
+
+
+def sync_profiles(config_files: Sequence[str], list_only: bool = False,
+                  fetch_only: bool = False,
+                  max_bookmark_id: Optional[str] = None,
+                  full: bool = False,
+                  metrics_file: Optional[str] = None,
+                  prometheus_file: Optional[str] = None,
+                  profile_file: Optional[str] = None):
+    """
+    Synchronize several configs in one process: pull the list of each
+    config in turn, then fetch the images of all the configs by
+    :func:`fetch_profile_images`.
+    """
+    configs = [load_config_file(f) for f in config_files]
+    db_paths = [os.path.abspath(c['sync.db']) for c in configs]
+    if len(set(db_paths)) != len(db_paths):
+        raise ValueError('The profiles must not share the same `sync.db`.')
+    metrics_file = metrics_file or configs[0].get('metrics.file')
+    prometheus_file = prometheus_file or \
+        configs[0].get('metrics.prometheus_file')
+
+    with contextlib.ExitStack() as stack:
+        if profile_file:
+            stack.enter_context(profile_run(profile_file))
+        stack.enter_context(METRICS.phase('sync'))
+        profiles = []
+        for config_file, config in zip(config_files, configs):
+            fetch_kwargs = get_fetch_kwargs(config)
+            sync_db = stack.enter_context(open_sync_db(config))
+            fetch_kwargs['postprocessor'] = stack.enter_context(
+                PostProcessor.from_config(config))
+            profiles.append(SyncProfile(
+                name=config_file,
+                config=config,
+                sync_db=sync_db,
+                download_dir=os.path.abspath(config['download.dir']),
+                fetch_kwargs=fetch_kwargs,
+            ))
 
-    with SyncDB(config['sync.db']) as sync_db:
         if not fetch_only:
-            update_list(sync_db, config, max_bookmark_id=max_bookmark_id)
+            for profile in profiles:
+                print(f'> Profile: {profile.name}')
+                with METRICS.phase('update_list'):
+                    update_list(profile.sync_db, profile.config,
+                                max_bookmark_id=max_bookmark_id, full=full)
         if not list_only:
             print('')
-            fetch_images(sync_db, download_dir, n_workers)
+            fetch_profile_images(profiles)
+
+    save_metrics(METRICS, json_file=metrics_file,
+                 prometheus_file=prometheus_file)
+
+
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.option('--pipeline', is_flag=True, default=None,
+              help='Start fetching images while still pulling the list.')
+@click.option('--cycles', type=int, required=False, default=None,
+              help='Exit after this many cycles (default: run until '
+                   'interrupted).')
+def watch(config_file, pipeline, cycles):
+    """Keep synchronizing the illustrations on schedule."""
+    config = load_config_file(config_file)
+    download_dir = os.path.abspath(config['download.dir'])
+    fetch_kwargs = get_fetch_kwargs(config)
+    if pipeline is None:
+        pipeline = config.get('sync.pipeline', False)
+    token_refresh = config.get('watch.token_refresh', 2700)
+    metrics_file = config.get('metrics.file')
+    prometheus_file = config.get('metrics.prometheus_file')
+    schedule = WatchSchedule(config)
+
+    # stop by SIGTERM as by Ctrl+C, such that the DB is saved on exit
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # the DB, the API client and the post-processing pool are kept across
+    # the cycles
+    with open_sync_db(config) as sync_db, \
+            PostProcessor.from_config(config) as postprocessor:
+        fetch_kwargs['postprocessor'] = postprocessor
+        api = make_api_client(sync_db, rate_limiter=make_rate_limiter(config))
+        token_time = None
+        n_cycles = 0
+        try:
+            while cycles is None or n_cycles < cycles:
+                now = time.monotonic()
+                if schedule.next_due() > now:
+                    time.sleep(schedule.next_due() - now)
+                    continue
+
+                start_time = time.monotonic()
+                sources = schedule.due(start_time)
+                if token_time is None or start_time - token_time >= token_refresh:
+                    try:
+                        if refresh_api_token(api, sync_db):
+                            print('> Access token refreshed.')
+                        token_time = start_time
+                    except Exception:
+                        print(''.join(traceback.format_exception(*sys.exc_info())) +
+                              'Failed to refresh the access token.')
+
+                cycle_config = dict(config)
+                for kind in ('authors', 'favourites'):
+                    cycle_config[kind] = [s for k, s in sources if k == kind]
+                print(f'> Sync cycle {n_cycles + 1}: {len(sources)} sources due.')
+                try:
+                    with METRICS.phase('sync'):
+                        if pipeline:
+                            sync_pipelined(sync_db, cycle_config, download_dir,
+                                           fetch_kwargs, api=api)
+                        else:
+                            with METRICS.phase('update_list'):
+                                update_list(sync_db, cycle_config, api=api)
+                            print('')
+                            fetch_images(sync_db, download_dir, api=api,
+                                         **fetch_kwargs)
+                except Exception:
+                    print(''.join(traceback.format_exception(*sys.exc_info())) +
+                          'Sync cycle failed.')
+
+                schedule.done(sources, start_time)
+                n_cycles += 1
+                METRICS.inc('watch_cycles_total')
+                if sync_db.dirty:
+                    sync_db.checkpoint()
+                save_metrics(METRICS, json_file=metrics_file,
+                             prometheus_file=prometheus_file)
+        except KeyboardInterrupt:
+            print('Stopped.')
+
+
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.option('-n', '--limit', type=int, required=False, default=None,
+              help='Max number of illusts to refresh, the stalest first.')
+@click.option('--max-age', type=float, required=False, default=None,
+              help='Only refresh the illusts not refreshed within this many '
+                   'days (default: `refresh.max_age`, or 30).')
+@click.option('--fetch', is_flag=True, default=False,
+              help='Fetch the new pages right after refreshing.')
+@click.argument('illust_ids', nargs=-1)
+def refresh(config_file, limit, max_age, fetch, illust_ids):
+    """Update the metadata of the stored illusts."""
+    config = load_config_file(config_file)
+    download_dir = os.path.abspath(config['download.dir'])
+    if max_age is None:
+        max_age = config.get('refresh.max_age', 30)
+
+    with open_sync_db(config) as sync_db:
+        if illust_ids:
+            illust_ids = [i for i in illust_ids if sync_db.get_illust(i)]
+        else:
+            illust_ids = select_stale_illusts(
+                sync_db, max_age=max_age * 86400, limit=limit)
+        api = make_api_client(sync_db, rate_limiter=make_rate_limiter(config))
+        dir_index = make_dir_index(config)
+        counts = refresh_illusts(sync_db, config, download_dir, illust_ids,
+                                 dir_index, api=api)
+        pprint(counts)
+        if fetch and counts['new_pages']:
+            print('')
+            fetch_images(sync_db, download_dir, api=api,
+                         **get_fetch_kwargs(config))
 
 
 @pixiv_sync.command()
@@ -545,11 +4617,13 @@ def sync(config_file, list_only, fetch_only, max_bookmark_id):
 def remove(config_file, illust_ids):
     """Delete illusts."""
     config = load_config_file(config_file)
-    sync_db = SyncDB(config['sync.db'])
+    sync_db = open_sync_db(config)
     download_dir = os.path.abspath(config['download.dir'])
 
     with sync_db:
-        _remove_illust(download_dir, sync_db, illust_ids)
+        dir_index = make_dir_index(config)
+        _remove_illust(download_dir, sync_db, illust_ids, dir_index,
+                       layout=get_download_layout(config))
 
 
 @pixiv_sync.command()
@@ -560,14 +4634,21 @@ def remove(config_file, illust_ids):
 def remove_excluded(config_file, simulate, show_info):
     """Delete excluded illusts."""
     config = load_config_file(config_file)
-    sync_db = SyncDB(config['sync.db'])
+    sync_db = open_sync_db(config, read_only=simulate)
     download_dir = os.path.abspath(config['download.dir'])
     delete_ids = []
 
+    illust_filter = IllustFilter(config)
+
     with sync_db:
-        for illust_id in sync_db.get_illust_ids():
-            illust = sync_db.get_illust(illust_id, {})
-            if not illust.get('_deleted', False) and is_illust_excluded(config, illust):
+        # if the rules have not changed since the last sync, all the excluded
+        # illusts have already been marked as "_deleted"
+        illust_items = iter(())
+        if sync_db.get('rules_fingerprint') != illust_filter.fingerprint:
+            illust_items = sync_db.iter_illust_items()
+
+        for illust_id, illust in illust_items:
+            if not illust.get('_deleted', False) and illust_filter.is_excluded(illust):
                 delete_ids.append(illust_id)
                 if show_info:
                     title = f'Info for {illust_id}'
@@ -577,7 +4658,9 @@ def remove_excluded(config_file, simulate, show_info):
 
         print(f'Found {len(delete_ids)} illusts to remove.')
         if not simulate:
-            _remove_illust(download_dir, sync_db, delete_ids)
+            dir_index = make_dir_index(config)
+            _remove_illust(download_dir, sync_db, delete_ids, dir_index,
+                           layout=get_download_layout(config))
 
 
 @pixiv_sync.command()
@@ -587,10 +4670,243 @@ def count(config_file):
     """Count downloaded illusts."""
     config = load_config_file(config_file)
     download_dir = os.path.abspath(config['download.dir'])
-    with SyncDB(config['sync.db']) as sync_db:
-        counts = _count_db(sync_db, download_dir)
+    with open_sync_db(config, read_only=True) as sync_db:
+        dir_index = make_dir_index(config)
+        counts = _count_db(sync_db, download_dir, dir_index,
+                           layout=get_download_layout(config))
         pprint({k: len(counts[k]) for k in counts})
 
 
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.option('-n', '--limit', type=int, required=False, default=50,
+              help='Max number of illusts to show, the newest first '
+                   '(0 for all).')
+@click.option('-p', '--paths', is_flag=True, default=False,
+              help='Print the paths of the fetched images instead.')
+@click.option('--rebuild', is_flag=True, default=False,
+              help='Rebuild the search index from scratch.')
+@click.argument('query', nargs=-1, required=True)
+def search(config_file, limit, paths, rebuild, query):
+    """
+    Search the illusts by tags, authors and titles.
+
+    For example: tag:オリジナル (author:12345 OR title:"summer*") -tag:R-18
+    """
+    config = load_config_file(config_file)
+    download_dir = os.path.abspath(config['download.dir'])
+    layout = get_download_layout(config)
+
+    # only the search index is written
+    with open_sync_db(config, read_only=True) as sync_db:
+        if sync_db.search_index is None:
+            sync_db.search_index = SearchIndex(get_search_index_path(config))
+        search_index = sync_db.search_index
+        if rebuild or search_index.stale:
+            print('> Building the search index ...', file=sys.stderr)
+            search_index.build(sync_db)
+
+        illust_ids, total = search_index.search(' '.join(query), limit=limit)
+        for illust_id in illust_ids:
+            illust = sync_db.get_illust(illust_id)
+            if paths:
+                for i, image in enumerate(illust.get('images', [])):
+                    if image.get('fetched', False):
+                        print(get_image_path(
+                            download_dir, illust_id, illust, i, layout))
+            else:
+                print(f'{illust_id}\t{illust.get("author_name")}\t'
+                      f'{illust.get("title")}')
+        if not paths:
+            print(f'> {total} illusts found.', file=sys.stderr)
+
+
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.option('--layout', type=click.Choice(list(DOWNLOAD_LAYOUTS)),
+              required=False, default=None,
+              help='The target layout (default: download.layout).')
+@click.option('-S', '--simulate', is_flag=True, default=False)
+def relocate(config_file, layout, simulate):
+    """Move the downloaded images into the download layout."""
+    config = load_config_file(config_file)
+    download_dir = os.path.abspath(config['download.dir'])
+    if layout is None:
+        layout = get_download_layout(config)
+    elif layout != config.get('download.layout', 'author_name'):
+        print(f'! Set `download.layout: {layout}` to download new images '
+              f'into this layout.')
+
+    with open_sync_db(config, read_only=simulate) as sync_db, sync_db.bulk():
+        counts = relocate_images(sync_db, download_dir, layout,
+                                 simulate=simulate)
+        pprint(counts)
+
+
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.option('-j', '--workers', type=int, required=False, default=None,
+              help='Number of worker processes (default: verify.workers, '
+                   'or the number of CPUs).')
+@click.option('-S', '--simulate', is_flag=True, default=False)
+def verify(config_file, workers, simulate):
+    """Check the downloaded images against their sizes and digests."""
+    config = load_config_file(config_file)
+    download_dir = os.path.abspath(config['download.dir'])
+    if workers is None:
+        workers = config.get('verify.workers')
+
+    with open_sync_db(config, read_only=simulate) as sync_db:
+        results = _verify_db(sync_db, download_dir, workers)
+        for status in ('missing', 'truncated', 'corrupt'):
+            for file_path, images in results[status]:
+                print(f'{status.capitalize()}: {file_path}')
+                if not simulate:
+                    try:
+                        _unfetch_corrupt_images(
+                            sync_db, status, file_path, images)
+                    except Exception:
+                        print(f'Failed to reset: {file_path}')
+                        print(''.join(traceback.format_exception(*sys.exc_info())))
+        pprint({k: len(results[k]) for k in results})
+
+
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.option('-f', '--format', 'fmt', type=click.Choice(FETCH_PLAN_FORMATS),
+              default='jsonl', help='JSON lines, or an aria2c input file.')
+@click.option('-o', '--output', type=click.File('w', encoding='utf-8'),
+              default='-', help='The output file (default: stdout).')
+def plan(config_file, fmt, output):
+    """Write the pending images for an external downloader."""
+    config = load_config_file(config_file)
+    download_dir = os.path.abspath(config['download.dir'])
+    headers = dict(DOWNLOAD_HEADERS)
+    headers.update(config.get('http.headers') or {})
+
+    with open_sync_db(config, read_only=True) as sync_db:
+        jobs = iter_fetch_jobs(sync_db, download_dir,
+                               get_download_layout(config),
+                               priority=get_fetch_priority_config(config))
+        count = write_fetch_plan(jobs, output, fmt, headers)
+    print(f'> {count} images planned.', file=sys.stderr)
+
+
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.option('-j', '--workers', type=int, required=False, default=None,
+              help='Number of worker processes (default: `verify.workers`, '
+                   'or the number of CPUs).')
+@click.option('-S', '--simulate', is_flag=True, default=False)
+def ingest(config_file, workers, simulate):
+    """Mark the images completed by an external downloader as fetched."""
+    config = load_config_file(config_file)
+    download_dir = os.path.abspath(config['download.dir'])
+    if workers is None:
+        workers = config.get('verify.workers')
+    fetch_kwargs = get_fetch_kwargs(config)
+
+    with open_sync_db(config, read_only=simulate) as sync_db, sync_db.bulk():
+        counts = ingest_fetched_images(
+            sync_db, download_dir, n_workers=workers,
+            dedup=fetch_kwargs['dedup'], layout=fetch_kwargs['layout'],
+            simulate=simulate)
+        pprint(counts)
+
+
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.option('-j', '--workers', type=int, required=False, default=None,
+              help='Number of worker processes (default: '
+                   '`postprocess.workers`, or the number of CPUs).')
+@click.option('--redo', multiple=True,
+              help='Run this hook again on all the images.')
+def postprocess(config_file, workers, redo):
+    """Run the post-processing hooks on the fetched images."""
+    config = load_config_file(config_file)
+    download_dir = os.path.abspath(config['download.dir'])
+    postprocessor = PostProcessor.from_config(config)
+    if workers is not None:
+        postprocessor.n_workers = workers
+    if not postprocessor.hooks:
+        print('No post-processing hook in `postprocess.hooks`.')
+        return
+
+    with open_sync_db(config) as sync_db, postprocessor, sync_db.bulk():
+        if redo:
+            for illust_id, illust in sync_db.iter_illust_items():
+                for i, image in enumerate(illust.get('images', [])):
+                    processed = image.get('processed') or ()
+                    if any(n in processed for n in redo):
+                        sync_db.update_image(illust_id, i, {'processed': [
+                            n for n in processed if n not in redo] or None})
+        postprocessor.process_pending(sync_db, download_dir)
+
+
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.option('--engine', required=False, default=None,
+              help='Storage engine of the source DB.')
+@click.argument('source', type=click.Path(exists=True, dir_okay=False),
+                required=True)
+def migrate_db(config_file, engine, source):
+    """Copy an existing sync DB into the configured one."""
+    config = load_config_file(config_file)
+    # neither created if mistyped, nor set up for writing
+    source_db = SyncDB(source, engine=engine, read_only=True)
+    try:
+        with open_sync_db(config) as sync_db:
+            if source_db.path == sync_db.path:
+                raise ValueError(f'Source and target DB are the same: {source}')
+            migrate_sync_db(source_db, sync_db)
+            print(f'Migrated {len(source_db.get_illust_ids())} illusts from '
+                  f'{source_db.path} to {sync_db.path}.')
+    finally:
+        source_db.close()
+
+
+@pixiv_sync.command()
+@click.option('-C', '--config-file', help='The YAML config file.',
+              default='config.yml', required=True)
+@click.argument('point', required=False, default=None)
+def restore(config_file, point):
+    """List the backups of the sync DB, or restore the backup POINT."""
+    config = load_config_file(config_file)
+    db_path = os.path.abspath(config['sync.db'])
+    full_backups = []
+    if (config.get('sync.db.engine') or guess_sync_db_engine(db_path)) == 'json':
+        full_backups = list_full_backups(db_path)
+    delta_backups = DeltaBackups(db_path)
+
+    if point is None:
+        for name in full_backups:
+            print(f'{name}  (full)')
+        for name in delta_backups.list_points():
+            print(f'{name}  (incremental)')
+        return
+
+    delta_points = delta_backups.list_points()
+    if point not in full_backups and point not in delta_points:
+        raise click.BadParameter(
+            f'Unknown restore point: {point}.  Available restore points: '
+            f'{", ".join(full_backups + delta_points) or "none"}.',
+            param_hint='POINT')
+    if point in full_backups:
+        backup_path = os.path.join(os.path.split(db_path)[0], point)
+        data = JsonStorage(backup_path).load()
+    else:
+        data = delta_backups.load(point)
+    with open_sync_db(config) as sync_db:
+        restore_sync_db(sync_db, data)
+        print(f'Restored {point} into {sync_db.path}.')
+
+
 if __name__ == '__main__':
     pixiv_sync()
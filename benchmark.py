@@ -0,0 +1,584 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks of PixivSync.
+
+A stand-in for the `AppPixivAPI` endpoints and a local image server are
+run in-process, such that `update_list`, `fetch_images`, `SyncDB` and
+`_count_db` can be measured without network access, e.g.::
+
+    python benchmark.py list --authors 100 --pages 5 --latency 0.05
+    python benchmark.py fetch --images 2000 --size 500000 --engine asyncio
+    python benchmark.py db --illusts 100000 --db-engine sqlite
+"""
+
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+
+import click
+
+import PixivSync
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+
+# ---- fake Pixiv API ----
+class FakeResponse(object):
+
+    def __init__(self, status_code: int, payload: Dict[str, Any]):
+        self.status_code = status_code
+        self.payload = payload
+        self.text = json.dumps(payload)
+
+
+class FakePixivAPI(object):
+    """
+    In-process stand-in for the `AppPixivAPI` endpoints used by PixivSync.
+
+    Each author has `pages_per_author` pages of `page_size` illusts, listed
+    from the newest.  The bookmarks have `bookmark_pages` pages.  Each API
+    call sleeps for `latency` seconds, and fails with a rate-limit error
+    at the probability of `failure_rate`.  The image urls point to
+    `image_base_url`, and :meth:`requests_call` does real HTTP requests.
+    """
+
+    def __init__(self,
+                 image_base_url: str,
+                 pages_per_author: int = 3,
+                 page_size: int = 30,
+                 bookmark_pages: int = 0,
+                 max_pages_per_illust: int = 3,
+                 latency: float = 0.,
+                 failure_rate: float = 0.,
+                 seed: int = 1234):
+        import requests
+
+        self.image_base_url = image_base_url.rstrip('/')
+        self.pages_per_author = pages_per_author
+        self.page_size = page_size
+        self.bookmark_pages = bookmark_pages
+        self.max_pages_per_illust = max_pages_per_illust
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.access_token = 'fake-access-token'
+        self.refresh_token = 'fake-refresh-token'
+        self.user_id = 1 if bookmark_pages > 0 else None
+        self.session = requests.Session()
+        self.n_calls = 0
+        self.n_failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def make_illust(self, illust_id: int, author_id: int) -> Dict[str, Any]:
+        n_pages = 1 + illust_id % self.max_pages_per_illust
+        urls = [f'{self.image_base_url}/img/{illust_id}_p{p}.jpg'
+                for p in range(n_pages)]
+        return {
+            'id': illust_id,
+            'title': f'illust {illust_id}',
+            'create_date': '2020-01-01T00:00:00+09:00',
+            'user': {'id': author_id, 'name': f'author {author_id}'},
+            'tags': [{'name': f'tag{illust_id % 97}',
+                      'translated_name': f'translated tag{illust_id % 97}'},
+                     {'name': f'tag{illust_id % 13}'}],
+            'width': 1000 + illust_id % 1000,
+            'height': 1000 + illust_id % 777,
+            'meta_single_page': (
+                {'original_image_url': urls[0]} if n_pages == 1 else {}),
+            'meta_pages': (
+                [{'image_urls': {'original': u}} for u in urls]
+                if n_pages > 1 else []),
+        }
+
+    def no_auth_requests_call(self, method, url, headers=None, params=None,
+                              data=None, req_auth=True) -> FakeResponse:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            self.n_calls += 1
+            failed = self._random.random() < self.failure_rate
+            if failed:
+                self.n_failures += 1
+        if failed:
+            return FakeResponse(403, {'error': {
+                'message': 'Rate Limit', 'user_message': ''}})
+
+        params = params or {}
+        if url == '/v1/user/illusts':
+            author_id = int(params['user_id'])
+            offset = int(params.get('offset') or 0)
+            total = self.pages_per_author * self.page_size
+            ids = range(total - offset, max(total - offset - self.page_size, 0), -1)
+            return FakeResponse(200, {
+                'illusts': [self.make_illust(author_id * 1000000 + i, author_id)
+                            for i in ids],
+                'next_url': None,
+            })
+
+        if url == '/v1/user/bookmarks/illust':
+            max_bookmark_id = int(params.get('max_bookmark_id') or
+                                  self.bookmark_pages * self.page_size + 1)
+            page = (self.bookmark_pages * self.page_size + 1 -
+                    max_bookmark_id) // self.page_size
+            if page >= self.bookmark_pages:
+                return FakeResponse(200, {'illusts': [], 'next_url': None})
+            ids = range(max_bookmark_id - 1, max_bookmark_id - 1 - self.page_size, -1)
+            next_id = max_bookmark_id - self.page_size
+            return FakeResponse(200, {
+                'illusts': [self.make_illust(900000000 + i, 900 + i % 50)
+                            for i in ids],
+                'next_url': f'https://app-api.pixiv.net/v1/user/bookmarks/'
+                            f'illust?max_bookmark_id={next_id}',
+            })
+
+        raise ValueError(f'Unknown url: {url}')
+
+    def _parse(self, response: FakeResponse) -> Dict[str, Any]:
+        return json.loads(response.text)
+
+    def user_illusts(self, user_id, type='illust', filter='for_ios',
+                     offset=None, req_auth=True):
+        return self._parse(self.no_auth_requests_call(
+            'GET', '/v1/user/illusts',
+            params={'user_id': user_id, 'offset': offset}))
+
+    def user_bookmarks_illust(self, user_id, restrict='public',
+                              filter='for_ios', max_bookmark_id=None,
+                              tag=None, req_auth=True):
+        return self._parse(self.no_auth_requests_call(
+            'GET', '/v1/user/bookmarks/illust',
+            params={'user_id': user_id, 'restrict': restrict,
+                    'max_bookmark_id': max_bookmark_id}))
+
+    def requests_call(self, method, url, headers=None, params=None,
+                      data=None, stream=False):
+        return self.session.request(method, url, headers=headers,
+                                    params=params, data=data, stream=stream)
+
+    def download(self, url, prefix='', path=os.path.curdir, name=None,
+                 replace=False, fname=None, referer='https://app-api.pixiv.net/'):
+        file_path = os.path.join(path, prefix + (name or os.path.basename(url)))
+        with self.requests_call('GET', url, headers={'Referer': referer},
+                                stream=True) as response:
+            response.raise_for_status()
+            with open(file_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f)
+        return True
+
+
+# ---- fake image server ----
+class ImageServer(object):
+    """
+    Local HTTP server of fake images of `image_size` bytes, supporting
+    `Range` requests.  Each request waits for `latency` seconds, and
+    fails at the probability of `failure_rate`, either with an HTTP 503
+    or by closing the connection in the middle of the body.
+    """
+
+    def __init__(self, image_size: int = 100000, latency: float = 0.,
+                 failure_rate: float = 0., seed: int = 1234):
+        self.image_size = image_size
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.body = bytes(random.Random(seed).getrandbits(8)
+                          for _ in range(min(image_size, 65536)))
+        self.n_requests = 0
+        self.n_failures = 0
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if server.latency > 0:
+                    time.sleep(server.latency)
+                with server._lock:
+                    server.n_requests += 1
+                    failure = None
+                    if server._random.random() < server.failure_rate:
+                        server.n_failures += 1
+                        failure = server._random.choice(['status', 'truncate'])
+
+                if failure == 'status':
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                size = server.image_size
+                start = 0
+                m = re.match(r'^bytes=(\d+)-$', self.headers.get('Range', ''))
+                if m and int(m.group(1)) < size:
+                    start = int(m.group(1))
+                    self.send_response(206)
+                    self.send_header('Content-Range',
+                                     f'bytes {start}-{size - 1}/{size}')
+                elif m:
+                    self.send_response(416)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(size - start))
+                self.end_headers()
+
+                end = size if failure is None else start + (size - start) // 2
+                pos = start
+                body = server.body
+                while pos < end:
+                    chunk = body[pos % len(body):][:end - pos]
+                    self.wfile.write(chunk)
+                    pos += len(chunk)
+                with server._lock:
+                    server.bytes_sent += end - start
+                if failure is not None:
+                    self.close_connection = True
+
+        return Handler
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# ---- synthetic sync DB ----
+def make_synthetic_illust(illust_id: int, n_authors: int,
+                          image_base_url: str,
+                          max_pages_per_illust: int = 3,
+                          fetched: bool = False) -> Dict[str, Any]:
+    author_id = illust_id % n_authors
+    n_pages = 1 + illust_id % max_pages_per_illust
+    return {
+        'id': str(illust_id),
+        'title': f'illust {illust_id}',
+        'create_time': '2020-01-01T00:00:00+09:00',
+        'author_id': str(author_id),
+        'author_name': f'author {author_id}',
+        'tags': [{'name': f'tag{illust_id % 97}',
+                  'translation': f'translated tag{illust_id % 97}'},
+                 {'name': f'tag{illust_id % 13}'}],
+        'width': 1000 + illust_id % 1000,
+        'height': 1000 + illust_id % 777,
+        'images': [{'url': f'{image_base_url}/img/{illust_id}_p{p}.jpg',
+                    'fetched': fetched}
+                   for p in range(n_pages)],
+        '_deleted': False,
+    }
+
+
+def fill_synthetic_db(sync_db: PixivSync.SyncDB, n_illusts: int,
+                      n_authors: int, image_base_url: str,
+                      fetched: bool = False):
+    # measures the inserts, not the compactions of the journal
+    with sync_db.bulk():
+        for i in range(n_illusts):
+            illust_id = 10000000 + i
+            sync_db.update_illust(
+                str(illust_id),
+                make_synthetic_illust(illust_id, n_authors, image_base_url,
+                                      fetched=fetched)
+            )
+
+
+# ---- measurement ----
+@dataclass
+class PhaseResult(object):
+    name: str
+    wall_time: float = 0.
+    items: int = 0
+    item_unit: str = 'items'
+    bytes: int = 0
+    peak_traced_mb: Optional[float] = None
+    max_rss_mb: Optional[float] = None
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.wall_time if self.wall_time > 0 else 0.
+
+    def to_json(self) -> Dict[str, Any]:
+        ret = asdict(self)
+        ret['throughput'] = self.throughput
+        if self.bytes:
+            ret['bytes_per_sec'] = self.bytes / self.wall_time
+        return ret
+
+
+class Benchmark(object):
+
+    def __init__(self, trace_memory: bool = False, verbose: bool = False):
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.results: List[PhaseResult] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str, item_unit: str = 'items'):
+        result = PhaseResult(name=name, item_unit=item_unit)
+        if self.trace_memory:
+            tracemalloc.start()
+        output = contextlib.ExitStack()
+        if not self.verbose:
+            output.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        start_time = time.perf_counter()
+        try:
+            with output:
+                yield result
+        finally:
+            result.wall_time = time.perf_counter() - start_time
+            if self.trace_memory:
+                result.peak_traced_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+            if resource is not None:
+                max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                if sys.platform != 'darwin':
+                    max_rss *= 1024
+                result.max_rss_mb = max_rss / 2 ** 20
+            self.results.append(result)
+            self.print_result(result)
+
+    def print_result(self, r: PhaseResult):
+        line = (f'{r.name:<28s} {r.wall_time:9.3f}s  '
+                f'{r.throughput:12.1f} {r.item_unit}/s')
+        if r.bytes:
+            line += f'  {r.bytes / r.wall_time / 2 ** 20:9.2f} MB/s'
+        if r.peak_traced_mb is not None:
+            line += f'  peak={r.peak_traced_mb:.1f}MB'
+        if r.max_rss_mb is not None:
+            line += f'  max_rss={r.max_rss_mb:.1f}MB'
+        if r.extra:
+            line += '  ' + ' '.join(f'{k}={v}' for k, v in r.extra.items())
+        print(line, file=sys.stderr)
+
+    def save(self, path: str, params: Dict[str, Any]):
+        with open(path, 'w') as f:
+            json.dump({
+                'params': params,
+                'phases': [r.to_json() for r in self.results],
+            }, f, indent=2)
+
+
+def _count_images(sync_db: PixivSync.SyncDB) -> Tuple[int, int]:
+    n_images = n_fetched = 0
+    for _, illust in sync_db.get_illust_items():
+        for image in illust.get('images', []):
+            n_images += 1
+            n_fetched += bool(image.get('fetched'))
+    return n_images, n_fetched
+
+
+@click.group()
+def benchmark():
+    """Offline benchmarks of PixivSync."""
+
+
+def common_options(f):
+    f = click.option('--output', default=None,
+                     help='Save the results as JSON to this file.')(f)
+    f = click.option('--trace-memory', is_flag=True, default=False,
+                     help='Measure the peak memory of each phase by '
+                          'tracemalloc (slows down the phases).')(f)
+    f = click.option('--verbose', is_flag=True, default=False,
+                     help='Show the output of PixivSync.')(f)
+    f = click.option('--db-engine', default='json',
+                     type=click.Choice(sorted(PixivSync.SYNC_DB_ENGINES)))(f)
+    return f
+
+
+@benchmark.command('list')
+@click.option('--authors', default=50, help='Number of followed authors.')
+@click.option('--pages', default=3, help='Number of pages per author.')
+@click.option('--page-size', default=30)
+@click.option('--bookmark-pages', default=0)
+@click.option('--latency', default=0.02, help='Latency of each API call.')
+@click.option('--failure-rate', default=0.,
+              help='Probability of a rate-limit error per API call.')
+@click.option('--workers', default=4, help='Value of `list.workers`.')
+@click.option('--api-rate', default=0., help='Value of `api.rate`.')
+@common_options
+def bench_list(authors, pages, page_size, bookmark_pages, latency,
+               failure_rate, workers, api_rate, output, trace_memory,
+               verbose, db_engine):
+    """Benchmark `update_list`."""
+    params = dict(locals())
+    bench = Benchmark(trace_memory=trace_memory, verbose=verbose)
+    work_dir = tempfile.mkdtemp()
+    try:
+        config = {
+            'authors': [str(i + 1) for i in range(authors)],
+            'favourites': ['public'] if bookmark_pages else [],
+            'list.workers': workers,
+        }
+        api = FakePixivAPI(
+            'http://127.0.0.1:1', pages_per_author=pages, page_size=page_size,
+            bookmark_pages=bookmark_pages, latency=latency,
+            failure_rate=failure_rate,
+        )
+        if api_rate > 0:
+            PixivSync.install_rate_limiter(
+                api, PixivSync.RateLimiter(api_rate, backoff_delay=.1))
+
+        db_path = os.path.join(work_dir, f'db.{db_engine}')
+        with PixivSync.SyncDB(db_path, engine=db_engine) as sync_db:
+            for name, full in [('update_list (first)', True),
+                               ('update_list (incremental)', False)]:
+                n_calls = api.n_calls
+                with bench.phase(name, 'calls') as r:
+                    PixivSync.update_list(sync_db, config, full=full, api=api)
+                    r.items = api.n_calls - n_calls
+                    r.extra['illusts'] = len(sync_db.get_illust_ids())
+                    r.extra['failures'] = api.n_failures
+
+            with bench.phase('SyncDB.save', 'illusts') as r:
+                sync_db.save()
+                r.items = len(sync_db.get_illust_ids())
+    finally:
+        shutil.rmtree(work_dir)
+
+    if output:
+        bench.save(output, params)
+
+
+@benchmark.command('fetch')
+@click.option('--images', default=1000, help='Approximate number of images.')
+@click.option('--size', default=200000, help='Size of each image in bytes.')
+@click.option('--latency', default=0.01, help='Latency of each request.')
+@click.option('--failure-rate', default=0.,
+              help='Probability of a failed image request.')
+@click.option('--engine', default='thread',
+              type=click.Choice(PixivSync.FETCH_ENGINES))
+@click.option('--workers', default=8, help='Value of `download.workers`.')
+@common_options
+def bench_fetch(images, size, latency, failure_rate, engine, workers,
+                output, trace_memory, verbose, db_engine):
+    """Benchmark `fetch_images` against a local image server."""
+    params = dict(locals())
+    bench = Benchmark(trace_memory=trace_memory, verbose=verbose)
+    work_dir = tempfile.mkdtemp()
+    try:
+        with ImageServer(image_size=size, latency=latency,
+                         failure_rate=failure_rate) as server:
+            api = FakePixivAPI(server.base_url)
+            db_path = os.path.join(work_dir, f'db.{db_engine}')
+            download_dir = os.path.join(work_dir, 'images')
+            with PixivSync.SyncDB(db_path, engine=db_engine) as sync_db:
+                # on average 2 images per illust
+                fill_synthetic_db(sync_db, max(images // 2, 1),
+                                  max(images // 200, 1), server.base_url)
+                with bench.phase(f'fetch_images ({engine})', 'images') as r:
+                    PixivSync.fetch_images(
+                        sync_db, download_dir, workers, engine=engine,
+                        retry_backoff=.01, api=api)
+                    n_images, n_fetched = _count_images(sync_db)
+                    r.items = n_fetched
+                    r.bytes = n_fetched * size
+                    r.extra['pending'] = n_images - n_fetched
+                    r.extra['requests'] = server.n_requests
+                    r.extra['failures'] = server.n_failures
+    finally:
+        shutil.rmtree(work_dir)
+
+    if output:
+        bench.save(output, params)
+
+
+@benchmark.command('db')
+@click.option('--illusts', default=100000, help='Number of illusts in the DB.')
+@click.option('--authors', default=1000)
+@click.option('--backup', default='full',
+              type=click.Choice(PixivSync.SYNC_DB_BACKUP_MODES),
+              help='Value of `sync.db.backup`.')
+@common_options
+def bench_db(illusts, authors, backup, output, trace_memory, verbose,
+             db_engine):
+    """Benchmark `SyncDB` and `_count_db` on a synthetic DB."""
+    params = dict(locals())
+    bench = Benchmark(trace_memory=trace_memory, verbose=verbose)
+    work_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(work_dir, f'db.{db_engine}')
+        download_dir = os.path.join(work_dir, 'images')
+        base_url = 'https://i.pximg.net/img-original/img/2020/01/01/00/00/00'
+
+        # the journal is compacted only by the measured save
+        sync_db = PixivSync.SyncDB(db_path, engine=db_engine, backup=backup,
+                                   journal_compact_every=0)
+        with bench.phase('SyncDB fill', 'illusts') as r:
+            fill_synthetic_db(sync_db, illusts, authors, base_url, fetched=True)
+            r.items = illusts
+        with bench.phase('SyncDB.save (all dirty)', 'illusts') as r:
+            sync_db.save()
+            r.items = illusts
+        sync_db.close()
+
+        with bench.phase('SyncDB load', 'illusts') as r:
+            sync_db = PixivSync.SyncDB(db_path, engine=db_engine,
+                                       backup=backup)
+            r.items = len(sync_db.get_illust_ids())
+        with bench.phase('SyncDB.get_illust_items', 'illusts') as r:
+            r.items = len(sync_db.get_illust_items())
+        with bench.phase('SyncDB.save (1 dirty)', 'saves') as r:
+            sync_db.set_illust_fetched(str(10000000), 0, False)
+            sync_db.save()
+            r.items = 1
+
+        # a few images on disk, such that the directories exist
+        for illust_id in range(10000000, 10000000 + min(illusts, 1000)):
+            illust = sync_db.get_illust(str(illust_id))
+            path = PixivSync.get_image_path(download_dir, str(illust_id), illust, 0)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'wb').close()
+
+        with bench.phase('_count_db', 'images') as r:
+            counts = PixivSync._count_db(sync_db, download_dir,
+                                         PixivSync.DirectoryIndex())
+            r.items = sum(len(v) for k, v in counts.items()
+                          if k.endswith('images'))
+        sync_db.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+    if output:
+        bench.save(output, params)
+
+
+if __name__ == '__main__':
+    benchmark()
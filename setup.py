@@ -42,6 +42,9 @@ setup(
     platforms='any',
     setup_requires=['setuptools'],
     install_requires=install_requires,
+    extras_require={
+        'asyncio': ['aiohttp'],
+    },
     dependency_links=dependency_links,
     entry_points='''
     [console_scripts]
@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+import PixivSync
+from benchmark import FakePixivAPI, ImageServer, fill_synthetic_db
+
+
+def fetch_all(tmp_path, n_illusts: int, dedup: str):
+    """
+    Fetch the images of `n_illusts` illusts of one page, all with the same
+    content as served by :class:`ImageServer`.
+    """
+    download_dir = str(tmp_path / 'images')
+    sync_db = PixivSync.SyncDB(str(tmp_path / 'db.json'))
+    with ImageServer(image_size=1000) as server:
+        # the ids of one page are multiples of 3
+        fill_synthetic_db(sync_db, 3 * n_illusts, 2, server.base_url)
+        for illust_id in sync_db.get_illust_ids():
+            if len(sync_db.get_illust(illust_id)['images']) != 1:
+                del sync_db.data['illusts'][illust_id]
+        PixivSync.fetch_images(sync_db, download_dir, 1, dedup=dedup,
+                               api=FakePixivAPI(server.base_url))
+    return sync_db, download_dir
+
+
+def list_files(download_dir: str):
+    return sorted(os.path.relpath(os.path.join(d, f), download_dir)
+                  for d, _, files in os.walk(download_dir) for f in files)
+
+
+def get_entry(sync_db):
+    assert len(sync_db.data['hashes']) == 1
+    return next(iter(sync_db.data['hashes'].values()))
+
+
+@pytest.mark.parametrize('dedup', ['off', 'hardlink'])
+def test_refs_of_own_copies(tmp_path, dedup):
+    sync_db, download_dir = fetch_all(tmp_path, 3, dedup)
+    entry = get_entry(sync_db)
+    illust_ids = sorted(sync_db.get_illust_ids())
+    assert sorted(entry['refs']) == [f'{i}/0' for i in illust_ids]
+    assert len(list_files(download_dir)) == 3
+    paths = [os.path.join(download_dir, p) for p in list_files(download_dir)]
+    n_links = {os.stat(p).st_nlink for p in paths}
+    assert n_links == ({3} if dedup == 'hardlink' else {1})
+
+    # the stored copy is then the copy of an image left
+    owner_id = next(i for i in illust_ids if sync_db.get_illust(i)[
+        'images'][0]['path'] == entry['path'])
+    PixivSync._remove_illust(download_dir, sync_db, [owner_id])
+    new_entry = get_entry(sync_db)
+    assert sorted(new_entry['refs']) == \
+        [f'{i}/0' for i in illust_ids if i != owner_id]
+    assert new_entry['path'] != entry['path']
+    assert entry['path'] not in list_files(download_dir)
+    assert new_entry['path'] in list_files(download_dir)
+    sync_db.close()
+
+
+def test_skip_shares_the_stored_copy(tmp_path):
+    sync_db, download_dir = fetch_all(tmp_path, 3, 'skip')
+    entry = get_entry(sync_db)
+    assert len(entry['refs']) == 3
+    assert list_files(download_dir) == [entry['path']]
+
+    owner_id = entry['refs'][0].split('/')[0]
+    others = [r.split('/')[0] for r in entry['refs'][1:]]
+    for illust_id in others:
+        image = sync_db.get_illust(illust_id)['images'][0]
+        assert image['shared'] and image['path'] == entry['path']
+        assert image['fetched']
+
+    # removing the owner moves the stored copy to the next image sharing it
+    PixivSync._remove_illust(download_dir, sync_db, [owner_id])
+    entry = get_entry(sync_db)
+    assert sorted(entry['refs']) == sorted(f'{i}/0' for i in others)
+    assert list_files(download_dir) == [entry['path']]
+    new_owner = sync_db.get_illust(others[0])['images'][0]
+    assert not new_owner.get('shared') and new_owner['path'] == entry['path']
+    assert sync_db.get_illust(others[1])['images'][0]['path'] == entry['path']
+
+    # removing a sharing image keeps the stored copy
+    PixivSync._remove_illust(download_dir, sync_db, [others[1]])
+    assert get_entry(sync_db)['refs'] == [f'{others[0]}/0']
+    assert list_files(download_dir) == [entry['path']]
+    assert not sync_db.get_illust(others[1])['images'][0]['fetched']
+
+    # removing the last reference drops the hash entry and the file
+    PixivSync._remove_illust(download_dir, sync_db, [others[0]])
+    assert not sync_db.data['hashes']
+    assert list_files(download_dir) == []
+    sync_db.close()
+
+
+def test_store_again_is_not_counted_twice(tmp_path):
+    sync_db, download_dir = fetch_all(tmp_path, 2, 'skip')
+    entry = get_entry(sync_db)
+    illust_id = entry['refs'][0].split('/')[0]
+    illust = sync_db.get_illust(illust_id)
+    job = PixivSync.get_illust_fetch_jobs(
+        download_dir, illust_id, {**illust.to_dict(), 'images': [
+            {**illust['images'][0], 'fetched': False}]})[0]
+    PixivSync.store_fetched_image(
+        sync_db, download_dir, job,
+        PixivSync.FetchImageResult(size=1000, digest=next(
+            iter(sync_db.data['hashes']))),
+        dedup='skip')
+    assert get_entry(sync_db)['refs'] == entry['refs']
+    sync_db.close()
@@ -0,0 +1,257 @@
+import queue
+import threading
+
+import pytest
+
+import PixivSync
+from benchmark import FakePixivAPI, ImageServer, fill_synthetic_db, _count_images
+
+
+def make_job(illust_id: str, image_id: int = 0, author_id: str = 'a'):
+    return PixivSync.FetchImageJob(
+        file_path=f'/nonexistent/{illust_id}_p{image_id}.jpg',
+        image_url=f'http://127.0.0.1:1/img/{illust_id}_p{image_id}.jpg',
+        illust_id=illust_id, image_id=image_id, author_id=author_id)
+
+
+def get_jobs(q, n=None):
+    """Get the available jobs without blocking."""
+    jobs = []
+    while n is None or len(jobs) < n:
+        try:
+            job = q.get(block=False)
+        except queue.Empty:
+            break
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def ids(jobs):
+    return [(j.illust_id, j.image_id) for j in jobs]
+
+
+# ---- FetchQueue ----
+def test_queue_without_limits_keeps_order():
+    q = PixivSync.FetchQueue()
+    for i in range(3):
+        q.put(make_job('1', i))
+    q.close()
+    assert ids(q) == [('1', 0), ('1', 1), ('1', 2)]
+    assert q.get() is None
+    assert q.drained
+
+
+def test_queue_max_per_illust():
+    q = PixivSync.FetchQueue(max_per_illust=2)
+    for job in [make_job('1', 0), make_job('1', 1), make_job('1', 2),
+                make_job('2', 0)]:
+        q.put(job)
+    first = get_jobs(q)
+    # the third image of illust 1 waits, illust 2 goes ahead of it
+    assert ids(first) == [('1', 0), ('1', 1), ('2', 0)]
+    assert len(q) == 1
+
+    q.task_done(first[0])
+    assert ids(get_jobs(q)) == [('1', 2)]
+    assert dict(q._illusts_in_flight) == {'1': 2, '2': 1}
+    for job in first[1:]:
+        q.task_done(job)
+    assert dict(q._illusts_in_flight) == {'1': 1}
+
+
+def test_queue_max_per_author():
+    q = PixivSync.FetchQueue(max_per_author=1)
+    for job in [make_job('1', 0, 'a'), make_job('2', 0, 'a'),
+                make_job('3', 0, 'b')]:
+        q.put(job)
+    first = get_jobs(q)
+    assert ids(first) == [('1', 0), ('3', 0)]
+
+    q.task_done(first[1])
+    assert get_jobs(q) == []
+    q.task_done(first[0])
+    assert ids(get_jobs(q)) == [('2', 0)]
+
+
+def test_queue_counters_are_released():
+    q = PixivSync.FetchQueue(max_per_illust=1, max_per_author=2)
+    for i in range(5):
+        q.put(make_job(str(i), 0, 'a'))
+    q.close()
+    while True:
+        jobs = get_jobs(q)
+        if not jobs:
+            break
+        for job in jobs:
+            q.task_done(job)
+    assert q.drained
+    assert not q._illusts_in_flight and not q._authors_in_flight
+
+
+def test_queue_full_put_does_not_block_starved_workers():
+    # the jobs in the full queue are all held back by the limits
+    q = PixivSync.FetchQueue(maxsize=2, max_per_illust=1)
+    q.put(make_job('1', 0))
+    q.put(make_job('1', 1))
+    first = q.get()
+    got = []
+    worker = threading.Thread(target=lambda: got.append(q.get()))
+    worker.start()
+    # the worker waits for illust 1, such that the producer can put more
+    q.put(make_job('1', 2))
+    q.put(make_job('2', 0))
+    worker.join(5)
+    assert ids(got) == [('2', 0)]
+    q.task_done(first)
+
+
+def test_queue_cancel_drops_jobs():
+    q = PixivSync.FetchQueue(maxsize=2)
+    q.put(make_job('1', 0))
+    q.put(make_job('1', 1))
+    blocked = threading.Thread(target=q.put, args=(make_job('1', 2),))
+    blocked.start()
+    q.cancel()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    assert q.cancelled and len(q) == 0
+    # the jobs put later are dropped too
+    q.put(make_job('2', 0))
+    assert q.get() is None
+
+
+def test_queue_put_after_close():
+    q = PixivSync.FetchQueue()
+    q.close()
+    with pytest.raises(RuntimeError):
+        q.put(make_job('1', 0))
+
+
+# ---- SharedFetchScheduler ----
+@pytest.fixture
+def profiles(tmp_path):
+    profiles = []
+    for name in ('p0', 'p1'):
+        fetch_kwargs = PixivSync.get_fetch_kwargs({})
+        profiles.append(PixivSync.SyncProfile(
+            name=name, config={},
+            sync_db=PixivSync.SyncDB(str(tmp_path / f'{name}.json')),
+            download_dir=str(tmp_path / name),
+            fetch_kwargs=fetch_kwargs,
+        ))
+    yield profiles
+    for profile in profiles:
+        profile.sync_db.close()
+
+
+def test_scheduler_round_robin(profiles):
+    scheduler = PixivSync.SharedFetchScheduler(profiles)
+    for i in range(3):
+        scheduler.put(0, make_job(f'{i}'))
+    scheduler.put(1, make_job('10'))
+    jobs = get_jobs(scheduler)
+    assert ids(jobs) == [('0', 0), ('10', 0), ('1', 0), ('2', 0)]
+
+
+def test_scheduler_limits(profiles):
+    scheduler = PixivSync.SharedFetchScheduler(
+        profiles, max_per_illust=1, max_per_author=2)
+    scheduler.put(0, make_job('1', 0, 'a'))
+    scheduler.put(0, make_job('1', 1, 'a'))
+    scheduler.put(0, make_job('2', 0, 'a'))
+    scheduler.put(1, make_job('3', 0, 'a'))
+    scheduler.put(1, make_job('4', 0, 'b'))
+    first = get_jobs(scheduler)
+    # author `a` is shared by the profiles
+    assert ids(first) == [('1', 0), ('3', 0), ('4', 0)]
+    assert dict(scheduler._authors_in_flight) == {'a': 2, 'b': 1}
+
+    scheduler.on_failed(first[0])
+    assert ids(get_jobs(scheduler)) == [('1', 1)]
+    assert dict(scheduler._authors_in_flight) == {'a': 2, 'b': 1}
+
+
+def test_scheduler_per_illust_limit_is_per_profile(profiles):
+    scheduler = PixivSync.SharedFetchScheduler(profiles, max_per_illust=1)
+    scheduler.put(0, make_job('1', 0))
+    scheduler.put(1, make_job('1', 1))
+    assert ids(get_jobs(scheduler)) == [('1', 0), ('1', 1)]
+
+
+def test_scheduler_shared_url_is_downloaded_once(profiles):
+    scheduler = PixivSync.SharedFetchScheduler(profiles, max_per_illust=1)
+    scheduler.put(0, make_job('1', 0))
+    scheduler.put(1, make_job('1', 0))
+    scheduler.close()
+    jobs = get_jobs(scheduler)
+    # the job of profile 1 waits for the download of profile 0
+    assert ids(jobs) == [('1', 0)]
+    assert not scheduler.drained
+    # nor does it hold the limits while waiting
+    assert dict(scheduler._illusts_in_flight) == {(0, '1'): 1}
+
+    # which failed, so it gets its own attempt
+    scheduler.on_failed(jobs[0])
+    retry = get_jobs(scheduler)
+    assert ids(retry) == [('1', 0)] and retry[0] is not jobs[0]
+    scheduler.on_failed(retry[0])
+    assert scheduler.get() is None
+    assert scheduler.drained
+    assert not scheduler._illusts_in_flight and not scheduler._authors_in_flight
+
+
+def test_scheduler_cancel(profiles):
+    scheduler = PixivSync.SharedFetchScheduler(profiles)
+    scheduler.put(0, make_job('1', 0))
+    scheduler.put(1, make_job('1', 0))
+    job = scheduler.get()
+    scheduler.cancel()
+    assert scheduler.cancelled
+    # the waiting jobs are dropped, not queued again
+    scheduler.on_failed(job)
+    scheduler.put(0, make_job('2', 0))
+    assert scheduler.get() is None
+
+
+# ---- end to end ----
+@pytest.mark.parametrize('engine', ['thread', 'asyncio'])
+def test_fetch_images_with_limits(tmp_path, engine):
+    with ImageServer(image_size=1000) as server:
+        api = FakePixivAPI(server.base_url)
+        with PixivSync.SyncDB(str(tmp_path / 'db.json')) as sync_db:
+            fill_synthetic_db(sync_db, 30, 3, server.base_url)
+            n_images, _ = _count_images(sync_db)
+            PixivSync.fetch_images(
+                sync_db, str(tmp_path / 'images'), 4, engine=engine,
+                retry_backoff=.01, api=api, queue_size=5,
+                max_per_illust=1, max_per_author=2)
+            assert _count_images(sync_db) == (n_images, n_images)
+        assert server.n_requests == n_images
+
+
+def test_fetch_profile_images_with_limits(tmp_path):
+    with ImageServer(image_size=1000) as server:
+        api = FakePixivAPI(server.base_url)
+        profiles = []
+        for name, n_illusts in (('p0', 20), ('p1', 10)):
+            config = {'download.queue_size': 4, 'download.max_per_illust': 1,
+                      'download.max_per_author': 2,
+                      'download.retry_backoff': .01}
+            sync_db = PixivSync.SyncDB(str(tmp_path / f'{name}.json'))
+            # the illusts of p1 are also in p0
+            fill_synthetic_db(sync_db, n_illusts, 3, server.base_url)
+            profiles.append(PixivSync.SyncProfile(
+                name=name, config=config, sync_db=sync_db,
+                download_dir=str(tmp_path / name),
+                fetch_kwargs=PixivSync.get_fetch_kwargs(config)))
+        try:
+            PixivSync.fetch_profile_images(profiles, api=api)
+            counts = [_count_images(p.sync_db) for p in profiles]
+        finally:
+            for profile in profiles:
+                profile.sync_db.close()
+        assert all(n == fetched for n, fetched in counts)
+        # the shared images are downloaded once
+        assert server.n_requests == counts[0][0]
@@ -0,0 +1,147 @@
+import os
+
+import pytest
+
+import PixivSync
+from benchmark import make_synthetic_illust
+
+BASE_URL = 'http://127.0.0.1:1'
+
+
+def make_illust(illust_id: int):
+    return make_synthetic_illust(illust_id, n_authors=3, image_base_url=BASE_URL)
+
+
+def crash(sync_db: PixivSync.SyncDB):
+    # as if the process was killed: the DB is neither saved nor closed
+    sync_db._journal_file.close()
+    sync_db._journal_file = None
+
+
+@pytest.mark.parametrize('engine', ['json', 'sqlite'])
+def test_replay_after_crash(tmp_path, engine):
+    db_path = str(tmp_path / f'db.{engine}')
+    with PixivSync.SyncDB(db_path, engine=engine) as sync_db:
+        sync_db.update_illust('1', make_illust(1))
+        sync_db.update_illust('2', make_illust(2))
+
+    sync_db = PixivSync.SyncDB(db_path, engine=engine)
+    sync_db.update_illust('3', make_illust(3))
+    sync_db.update_illust('1', {'title': 'renamed'})
+    sync_db.set_illust_fetched('2', 0)
+    sync_db.update_image('2', 1, {'digest': 'abc', 'size': 10})
+    sync_db.set_hash('abc', {'path': 'x.jpg', 'refs': 1})
+    sync_db.update_user('7', {'name': 'user 7'})
+    crash(sync_db)
+    assert os.path.exists(sync_db.journal_path)
+
+    with PixivSync.SyncDB(db_path, engine=engine) as sync_db:
+        assert sorted(sync_db.get_illust_ids()) == ['1', '2', '3']
+        assert sync_db.get_illust('1')['title'] == 'renamed'
+        images = sync_db.get_illust('2')['images']
+        assert images[0]['fetched'] is True
+        assert images[1]['digest'] == 'abc' and images[1]['size'] == 10
+        assert sync_db.get_hash('abc') == {'path': 'x.jpg', 'refs': 1}
+        assert sync_db.get_user('7')['name'] == 'user 7'
+        assert sync_db.modified
+
+    # the journal is compacted by the save on exit
+    assert not os.path.exists(f'{db_path}.journal')
+    with PixivSync.SyncDB(db_path, engine=engine) as sync_db:
+        assert sorted(sync_db.get_illust_ids()) == ['1', '2', '3']
+        assert not sync_db.modified
+
+
+def test_replay_removed_image_field_and_hash(tmp_path):
+    db_path = str(tmp_path / 'db.json')
+    with PixivSync.SyncDB(db_path) as sync_db:
+        sync_db.update_illust('1', make_illust(1))
+        sync_db.update_image('1', 0, {'digest': 'abc'})
+        sync_db.set_hash('abc', {'path': 'x.jpg', 'refs': 1})
+
+    sync_db = PixivSync.SyncDB(db_path)
+    sync_db.update_image('1', 0, {'digest': None})
+    sync_db.set_hash('abc', None)
+    crash(sync_db)
+
+    with PixivSync.SyncDB(db_path) as sync_db:
+        assert 'digest' not in sync_db.get_illust('1')['images'][0]
+        assert sync_db.get_hash('abc') is None
+
+
+def test_truncated_last_entry_is_skipped(tmp_path):
+    db_path = str(tmp_path / 'db.json')
+    sync_db = PixivSync.SyncDB(db_path)
+    sync_db.update_illust('1', make_illust(1))
+    sync_db.update_illust('2', make_illust(2))
+    crash(sync_db)
+    with open(sync_db.journal_path, 'ab') as f:
+        f.write(b'["illust", "3", {"title": "trunc')
+
+    with PixivSync.SyncDB(db_path) as sync_db:
+        assert sorted(sync_db.get_illust_ids()) == ['1', '2']
+
+
+def test_read_only_replay(tmp_path):
+    db_path = str(tmp_path / 'db.json')
+    sync_db = PixivSync.SyncDB(db_path)
+    sync_db.update_illust('1', make_illust(1))
+    crash(sync_db)
+
+    with PixivSync.SyncDB(db_path, read_only=True) as sync_db:
+        assert sync_db.get_illust_ids() == ['1']
+        with pytest.raises(RuntimeError):
+            sync_db.update_illust('2', make_illust(2))
+    # the journal is left for the next writer
+    assert not os.path.exists(db_path)
+    assert os.path.exists(f'{db_path}.journal')
+
+
+def test_closed_db_refuses_writes(tmp_path):
+    sync_db = PixivSync.SyncDB(str(tmp_path / 'db.json'))
+    sync_db.update_illust('1', make_illust(1))
+    sync_db.save()
+    sync_db.close()
+    with pytest.raises(RuntimeError):
+        sync_db.set_illust_fetched('1', 0)
+
+
+def test_sqlite_compacts_every_n_entries(tmp_path):
+    db_path = str(tmp_path / 'db.sqlite')
+    with PixivSync.SyncDB(db_path, journal_compact_every=10) as sync_db:
+        for i in range(25):
+            sync_db.update_illust(str(i), make_illust(i))
+        assert sync_db._journal_size == 5
+        assert sync_db.modified
+
+
+def test_json_compacts_once_journal_outgrows_db(tmp_path):
+    db_path = str(tmp_path / 'db.json')
+    with PixivSync.SyncDB(db_path, journal_compact_every=10) as sync_db:
+        for i in range(100):
+            sync_db.update_illust(str(i), make_illust(i))
+    db_size = os.path.getsize(db_path)
+
+    with PixivSync.SyncDB(db_path, journal_compact_every=10) as sync_db:
+        # small changes of a large DB are not worth a full rewrite
+        for _ in range(50):
+            sync_db.set_illust_fetched('1', 0)
+        assert sync_db._journal_size == 50
+        # until the journal is as large as the DB
+        n_entries = 50
+        while sync_db._journal_size:
+            sync_db.set_illust_fetched('1', 0)
+            n_entries += 1
+        entry_size = len('["fetched", "1", 0, true]\n')
+        assert n_entries * entry_size >= db_size
+        assert sync_db._checkpointed
+
+
+def test_bulk_defers_compaction(tmp_path):
+    db_path = str(tmp_path / 'db.sqlite')
+    with PixivSync.SyncDB(db_path, journal_compact_every=10) as sync_db:
+        with sync_db.bulk():
+            for i in range(25):
+                sync_db.update_illust(str(i), make_illust(i))
+            assert sync_db._journal_size == 25
+        assert sync_db._journal_size == 0
@@ -0,0 +1,143 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+import PixivSync
+from benchmark import make_synthetic_illust
+
+BASE_URL = 'http://127.0.0.1:1'
+
+
+def make_illust(illust_id: int):
+    return make_synthetic_illust(illust_id, n_authors=3, image_base_url=BASE_URL)
+
+
+def write_config(tmp_path, db_name: str, backup: str = 'delta',
+                 keep: int = 10) -> str:
+    config_path = tmp_path / 'config.yml'
+    config_path.write_text(json.dumps({
+        'sync.db': str(tmp_path / db_name),
+        'sync.db.backup': backup,
+        'sync.db.backup.keep': keep,
+        'download.dir': str(tmp_path / 'images'),
+    }))
+    return str(config_path)
+
+
+def run_restore(config_path: str, *args):
+    return CliRunner().invoke(PixivSync.pixiv_sync,
+                              ['restore', '-C', config_path, *args])
+
+
+def open_db(config_path: str) -> PixivSync.SyncDB:
+    return PixivSync.open_sync_db(PixivSync.load_config_file(config_path))
+
+
+def make_history(config_path: str):
+    """Save three generations: illusts {1}, {1, 2}, then {2, 3}, 2 fetched."""
+    with open_db(config_path) as sync_db:
+        sync_db.update_illust('1', make_illust(1))
+    with open_db(config_path) as sync_db:
+        sync_db.update_illust('2', make_illust(2))
+        sync_db['last_sync'] = 'second'
+    with open_db(config_path) as sync_db:
+        sync_db.update_illust('3', make_illust(3))
+        sync_db.set_illust_fetched('2', 0)
+        del sync_db.data['illusts']['1']
+        sync_db.dirty.add(('illusts', '1'))
+
+
+@pytest.mark.parametrize('db_name', ['db.json', 'db.sqlite'])
+def test_delta_points_chain(tmp_path, db_name):
+    config_path = write_config(tmp_path, db_name)
+    make_history(config_path)
+    db_path = str(tmp_path / db_name)
+
+    points = PixivSync.DeltaBackups(db_path).list_points()
+    assert [p.rsplit('-', 1)[1] for p in points] == ['base', 'delta', 'delta']
+
+    backups = PixivSync.DeltaBackups(db_path)
+    assert sorted(backups.load(points[0])['illusts']) == ['1']
+    second = backups.load(points[1])
+    assert sorted(second['illusts']) == ['1', '2']
+    assert second['last_sync'] == 'second'
+    third = backups.load(points[2])
+    assert sorted(third['illusts']) == ['2', '3']
+    assert third['illusts']['2']['images'][0]['fetched'] is True
+
+
+@pytest.mark.parametrize('db_name', ['db.json', 'db.sqlite'])
+def test_restore_delta_point(tmp_path, db_name):
+    config_path = write_config(tmp_path, db_name)
+    make_history(config_path)
+    points = PixivSync.DeltaBackups(str(tmp_path / db_name)).list_points()
+
+    result = run_restore(config_path, points[1])
+    assert result.exit_code == 0, result.output
+    with open_db(config_path) as sync_db:
+        assert sorted(sync_db.get_illust_ids()) == ['1', '2']
+        assert sync_db.get_illust('2')['images'][0]['fetched'] is False
+        assert sync_db['last_sync'] == 'second'
+        # the restore is saved as a new generation, and backed up
+        assert sync_db.get('db_generation') == 4
+
+    # the restored DB is the next point of the chain
+    points = PixivSync.DeltaBackups(str(tmp_path / db_name)).list_points()
+    assert len(points) == 4
+    data = PixivSync.DeltaBackups(str(tmp_path / db_name)).load(points[-1])
+    assert sorted(data['illusts']) == ['1', '2']
+
+
+def test_restore_full_backup(tmp_path):
+    config_path = write_config(tmp_path, 'db.json', backup='full')
+    make_history(config_path)
+    db_path = str(tmp_path / 'db.json')
+    full_backups = PixivSync.list_full_backups(db_path)
+    assert len(full_backups) == 2
+    assert not PixivSync.DeltaBackups(db_path).list_points()
+
+    result = run_restore(config_path)
+    assert result.exit_code == 0, result.output
+    assert all(f'{name}  (full)' in result.output for name in full_backups)
+
+    result = run_restore(config_path, full_backups[0])
+    assert result.exit_code == 0, result.output
+    with open_db(config_path) as sync_db:
+        assert sync_db.get_illust_ids() == ['1']
+        assert 'last_sync' not in sync_db.data
+
+
+def test_sqlite_full_backup_falls_back_to_delta(tmp_path):
+    config_path = write_config(tmp_path, 'db.sqlite', backup='full')
+    make_history(config_path)
+    db_path = str(tmp_path / 'db.sqlite')
+    with open_db(config_path) as sync_db:
+        assert sync_db.backup == 'delta'
+    assert len(PixivSync.DeltaBackups(db_path).list_points()) == 3
+
+
+def test_restore_unknown_point(tmp_path):
+    config_path = write_config(tmp_path, 'db.json')
+    make_history(config_path)
+
+    result = run_restore(config_path, '999999-unknown-base')
+    assert result.exit_code != 0
+    assert 'Unknown restore point' in result.output
+    with pytest.raises(ValueError):
+        PixivSync.DeltaBackups(str(tmp_path / 'db.json')).load(
+            '999999-unknown-base')
+
+
+def test_old_chains_are_removed(tmp_path):
+    db_path = str(tmp_path / 'db.json')
+    for i in range(7):
+        with PixivSync.SyncDB(db_path, backup='delta', backup_keep=3) as sync_db:
+            sync_db.update_illust(str(i), make_illust(i))
+
+    backups = PixivSync.DeltaBackups(db_path, keep=3)
+    points = backups.list_points()
+    assert len(points) >= 3
+    assert points[0].endswith('-base')
+    assert sorted(backups.load(points[-1])['illusts']) == \
+        [str(i) for i in range(7)]
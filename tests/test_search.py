@@ -0,0 +1,125 @@
+import pytest
+
+import PixivSync
+from benchmark import FakePixivAPI
+
+parse = PixivSync._parse_search_query
+
+
+def term(field, value):
+    return ('term', field, value)
+
+
+@pytest.mark.parametrize('query,expected', [
+    ('cat', term(None, 'cat')),
+    ('tag:cat', term('tag', 'cat')),
+    ('title:"two words"', term('title', 'two words')),
+    ('-tag:dog', ('not', term('tag', 'dog'))),
+    ('NOT tag:dog', ('not', term('tag', 'dog'))),
+    ('tag:cat*', term('tag', 'cat*')),
+    ('cat dog', ('and', [term(None, 'cat'), term(None, 'dog')])),
+    ('cat AND dog', ('and', [term(None, 'cat'), term(None, 'dog')])),
+    ('cat OR dog', ('or', [term(None, 'cat'), term(None, 'dog')])),
+    # AND binds tighter than OR
+    ('a b OR c', ('or', [('and', [term(None, 'a'), term(None, 'b')]),
+                         term(None, 'c')])),
+    ('a (b OR c)', ('and', [term(None, 'a'),
+                            ('or', [term(None, 'b'), term(None, 'c')])])),
+    ('NOT (a OR b)', ('not', ('or', [term(None, 'a'), term(None, 'b')]))),
+    # the operators are case-sensitive, and are terms when quoted
+    ('or', term(None, 'or')),
+    ('"OR"', term(None, 'OR')),
+    ('  author:12  ', term('author', '12')),
+])
+def test_parse(query, expected):
+    assert parse(query) == expected
+
+
+@pytest.mark.parametrize('query', [
+    '', '(a', 'a)', 'a OR', 'AND', 'a ()', 'tag:"unclosed',
+])
+def test_parse_invalid(query):
+    with pytest.raises(ValueError):
+        parse(query)
+
+
+@pytest.fixture
+def index(tmp_path):
+    sync_db = PixivSync.SyncDB(str(tmp_path / 'db.json'))
+    illusts = {
+        '1': ('Black Cat', '10', 'Alice', ['cat', 'animal']),
+        '2': ('White Dog', '10', 'Alice', ['dog', 'animal']),
+        '3': ('猫の絵', '20', 'Bob', ['猫', 'cat']),
+        '4': ('Landscape', '30', 'Carol', ['scenery']),
+    }
+    for illust_id, (title, author_id, author_name, tags) in illusts.items():
+        sync_db.update_illust(illust_id, {
+            'title': title, 'author_id': author_id, 'author_name': author_name,
+            'tags': [{'name': t} for t in tags], 'images': [],
+        })
+    sync_db.update_illust('5', {'title': 'Deleted Cat', 'author_id': '10',
+                                'tags': [{'name': 'cat'}], '_deleted': True})
+    search_index = PixivSync.SearchIndex(str(tmp_path / 'index.sqlite'))
+    search_index.build(sync_db)
+    yield search_index
+    search_index.close()
+    sync_db.close()
+
+
+def search_ids(index, query):
+    return sorted(index.search(query)[0])
+
+
+@pytest.mark.parametrize('query,expected', [
+    ('tag:cat', ['1', '3']),
+    ('tag:CAT', ['1', '3']),
+    ('tag:animal -tag:dog', ['1']),
+    ('tag:animal NOT tag:dog', ['1']),
+    ('tag:dog OR tag:scenery', ['2', '4']),
+    ('author:10', ['1', '2']),
+    ('author:alice', ['1', '2']),
+    ('author:"alice" tag:dog', ['2']),
+    ('title:black', ['1']),
+    ('title:"white dog"', ['2']),
+    ('title:land*', ['4']),
+    ('title:猫の', ['3']),
+    ('title:絵', ['3']),
+    ('cat', ['1', '3']),
+    ('-tag:animal', ['3', '4']),
+    ('(author:bob OR author:carol) -tag:scenery', ['3']),
+    ('tag:missing', []),
+])
+def test_search(index, query, expected):
+    assert search_ids(index, query) == expected
+
+
+def test_search_limit_and_total(index):
+    ids, total = index.search('tag:cat OR tag:dog', limit=2)
+    assert ids == ['3', '2']
+    assert total == 3
+
+
+def test_search_unknown_field(index):
+    with pytest.raises(ValueError):
+        index.search('color:red')
+
+
+def test_search_listed_illusts(tmp_path):
+    api = FakePixivAPI('http://127.0.0.1:1', pages_per_author=1, page_size=5)
+    config = {'authors': ['1', '2'], 'favourites': []}
+    with PixivSync.SyncDB(str(tmp_path / 'db.json')) as sync_db:
+        PixivSync.update_list(sync_db, config, full=True, api=api)
+        search_index = PixivSync.SearchIndex(str(tmp_path / 'index.sqlite'))
+        search_index.build(sync_db)
+        sync_db.search_index = search_index
+
+        ids, total = search_index.search('author:1')
+        assert total == 5 and all(i.startswith('1') for i in ids)
+        assert search_index.search('author:"author 2"')[1] == 5
+        assert search_index.search('title:1000005')[0] == ['1000005']
+
+        # re-indexed when the DB is saved
+        sync_db.update_illust('1000005', {'title': 'renamed'})
+        sync_db.save()
+        assert search_index.search('title:renamed')[0] == ['1000005']
+        assert search_index.search('title:1000005')[0] == []